@@ -1,94 +1,272 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import uvicorn
-import torch
 import os
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
-from typing import List, Dict, AsyncGenerator
-from fastapi.responses import StreamingResponse
-import json
+from transformers import AsyncTextIteratorStreamer
+from typing import List, Dict, AsyncGenerator, Literal, Optional
+from fastapi.responses import JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
 import asyncio
-from threading import Thread
+import json
+import re
+import threading
+import time
+
+import config
+from engine import AdmissionRejected, BatchScheduler, GenerationRequest
+from loader import load_model
+from prefix_cache import PrefixCache
+from prompts import SYSTEM_PROMPTS, system_prompt_tokens
+from speculative import PromptLookupDraft
+from grammar import PlantUMLGrammar
+from sampling import SamplingParams
+from diagrams import DiagramExtractor
+from runtime import ModelRuntime
 
 # 定义请求体结构
 class ChatRequest(BaseModel):
     messages: List[Dict[str, str]]
+    # 是否对 plantuml 代码块做语法受限解码，未指定时使用 CONSTRAINED_DECODING
+    constrained: Optional[bool] = None
+    # 生成参数；未指定时与原先一致：最多 AUG_MAX_NEW_TOKENS 个 token，贪心解码
+    max_new_tokens: Optional[int] = Field(None, ge=1)
+    temperature: float = Field(0.0, ge=0.0, le=2.0)
+    top_p: float = Field(1.0, gt=0.0, le=1.0)
+    top_k: int = Field(0, ge=0)
+    seed: Optional[int] = None
+    # 停止串（输出中包含停止串本身）
+    stop: List[str] = Field(default_factory=list, max_length=8)
+    # 输出第一个完整的 ```plantuml ... @enduml``` 代码块后立即停止
+    stop_after_diagram: bool = False
+    # 响应格式：jsonl（每个片段一行 JSON，默认）或 sse（标准 Server-Sent Events，data 即文本增量）
+    stream_format: Literal["jsonl", "sse"] = "jsonl"
 
-app = FastAPI()
+    def sampling_params(self) -> SamplingParams:
+        return SamplingParams(
+            temperature=self.temperature,
+            top_p=self.top_p,
+            top_k=self.top_k,
+            seed=self.seed,
+            stop=self.stop,
+            stop_after_diagram=self.stop_after_diagram
+        )
 
-# 设置环境变量
-os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+# 设置环境变量（由 router.py 启动的副本已指定了各自的设备）
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '0')
 
-# 模型路径
-MODEL_PATH = "/root/autodl-tmp/aug/"
+# 模型路径（可通过 AUG_MODEL_PATH 覆盖）
+MODEL_PATH = config.MODEL_PATH or "/root/autodl-tmp/aug/"
 
-# 检查是否使用 GPU
-device = "cuda" if torch.cuda.is_available() else "cpu"
+# 排队期间检查队列位置的间隔（秒）
+QUEUE_POLL_INTERVAL = 0.25
 
-# 初始化 tokenizer 和模型
-tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_PATH,
-    torch_dtype=torch.bfloat16,
-    low_cpu_mem_usage=True,
-    trust_remote_code=True,
-    device_map="auto"
-).eval()
+# PlantUML 受限解码：1 默认开启，启动时编译语法约束；0 默认关闭，第一个要求约束的请求
+# 到来时在后台编译；off 完全关闭，不编译，也不接受要求约束的请求
+CONSTRAINED_DECODING_MODE = os.environ.get("AUG_CONSTRAINED_DECODING", "0")
+CONSTRAINED_DECODING = CONSTRAINED_DECODING_MODE == "1"
 
-async def generate_stream(messages: List[Dict[str, str]]) -> AsyncGenerator[str, None]:
-    """生成流式响应"""
-    try:
-        inputs = tokenizer.apply_chat_template(
-            messages,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_tensors="pt",
-            return_dict=True
+def build_grammar(tokenizer, device, eos_token_ids):
+    """规范化词表并编译语法约束"""
+    grammar = PlantUMLGrammar(tokenizer, device, eos_token_ids)
+    grammar.compile()
+    return grammar
+
+def build_runtime():
+    """加载模型并启动调度器，在 lifespan 的后台线程中执行"""
+    # 按配置选择设备、精度与量化方式，初始化 tokenizer 和模型
+    tokenizer, model, device = load_model(MODEL_PATH)
+
+    # 默认开启受限解码时在启动阶段编译语法约束，否则推迟到第一次需要时
+    grammar = None
+    if CONSTRAINED_DECODING:
+        eos_token_id = model.generation_config.eos_token_id
+        grammar = build_grammar(
+            tokenizer, device,
+            eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id]
         )
-        
-        inputs = {key: value.to(device) for key, value in inputs.items()}
-        streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True, skip_prompt=True)
-        
-        # 设置生成参数
-        gen_kwargs = {
-            "max_new_tokens": 5000,
-            "do_sample": True,
-            "top_k": 1,
-            "streamer": streamer
-        }
-        
-        # 在后台线程中运行模型生成
-        thread = Thread(target=model.generate, kwargs={**inputs, **gen_kwargs})
-        thread.start()
-        
+
+    # 所有请求共享同一个连续批处理解码循环
+    prefix_cache = PrefixCache(config.PREFIX_CACHE_MAX_BYTES, block_size=config.PREFIX_CACHE_BLOCK_SIZE)
+    scheduler = BatchScheduler(
+        model, tokenizer, device,
+        max_batch_size=config.MAX_BATCH_SIZE,
+        prefix_cache=prefix_cache,
+        draft=(
+            PromptLookupDraft(config.SPECULATIVE_TOKENS, config.SPECULATIVE_NGRAM)
+            if config.SPECULATIVE_TOKENS > 0 else None
+        ),
+        grammar=grammar,
+        compile_decode=config.TORCH_COMPILE,
+        max_queued_requests=config.MAX_QUEUED_REQUESTS,
+        max_queued_tokens=config.MAX_QUEUED_TOKENS,
+        retry_after=config.RETRY_AFTER
+    )
+
+    # 为固定的系统提示词预先计算 KV cache，所有会话共享
+    for prompt in SYSTEM_PROMPTS:
+        scheduler.precompute_prefix(system_prompt_tokens(tokenizer, prompt))
+
+    scheduler.start()
+    return tokenizer, scheduler
+
+runtime = ModelRuntime(build_runtime)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 模型在后台加载，服务立即开始监听
+    runtime.start()
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+_grammar_lock = threading.Lock()
+_grammar_thread = None
+
+def _compile_grammar(tokenizer, scheduler):
+    global _grammar_thread
+    try:
+        scheduler.grammar = build_grammar(tokenizer, scheduler.device, list(scheduler.eos_token_ids))
+    except Exception as e:
+        print(f"编译 PlantUML 语法约束失败: {str(e)}")
+        with _grammar_lock:
+            _grammar_thread = None
+
+def require_grammar():
+    """要求受限解码的请求需要已编译的语法约束；尚未编译时在后台开始编译并返回 503"""
+    global _grammar_thread
+    scheduler = runtime.scheduler
+    if scheduler.grammar is not None and scheduler.grammar.compiled:
+        return
+    if CONSTRAINED_DECODING_MODE == "off":
+        raise HTTPException(status_code=400, detail="服务未开启 PlantUML 受限解码")
+    with _grammar_lock:
+        if _grammar_thread is None:
+            _grammar_thread = threading.Thread(
+                target=_compile_grammar, args=(runtime.tokenizer, scheduler), name="grammar-compile", daemon=True
+            )
+            _grammar_thread.start()
+    raise HTTPException(status_code=503, detail="PlantUML 语法约束正在编译", headers={"Retry-After": "5"})
+
+def submit_generation(chat: ChatRequest) -> GenerationRequest:
+    """编码对话并交给调度器，与其他请求一起批量解码；等待队列已满时返回 429"""
+    constrained = CONSTRAINED_DECODING if chat.constrained is None else chat.constrained
+    if constrained:
+        require_grammar()
+    tokenizer = runtime.tokenizer
+    inputs = tokenizer.apply_chat_template(
+        chat.messages,
+        add_generation_prompt=True,
+        tokenize=True,
+        return_tensors="pt",
+        return_dict=True
+    )
+
+    streamer = AsyncTextIteratorStreamer(tokenizer, skip_special_tokens=True)
+    request = GenerationRequest(
+        inputs["input_ids"][0].tolist(),
+        streamer,
+        max_new_tokens=min(chat.max_new_tokens or config.MAX_NEW_TOKENS, config.MAX_NEW_TOKENS),
+        constrained=constrained,
+        sampling=chat.sampling_params()
+    )
+    try:
+        runtime.scheduler.submit(request)
+    except AdmissionRejected as e:
+        print(f"拒绝请求: {str(e)}")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    return request
+
+async def generate_stream(request: GenerationRequest) -> AsyncGenerator[Dict, None]:
+    """生成流式响应：排队期间报告队列位置（status 202，位置不变时定期重复作为心跳），
+    进入批次后输出文本片段，每个 plantuml 代码块闭合时额外输出一条 data.diagram
+
+    客户端断开时 Starlette 会取消这个生成器，此时在 finally 中取消调度器里的请求。
+    """
+    try:
+        last_position, last_sent = None, 0.0
+        while True:
+            position = runtime.scheduler.queue_position(request)
+            if not position:
+                break
+            now = time.monotonic()
+            if position != last_position or now - last_sent >= config.QUEUE_HEARTBEAT_INTERVAL:
+                yield {"status": 202, "data": {"queue_position": position}}
+                last_position, last_sent = position, now
+            await asyncio.sleep(QUEUE_POLL_INTERVAL)
+
         # 从streamer中获取生成的文本
-        for text in streamer:
+        extractor = DiagramExtractor()
+        async for text in request.streamer:
             if text:
                 # 直接yield每个文本片段
-                yield text
-                
+                yield {"status": 200, "data": {"content": text}}
+                # 代码块一闭合就发出图表事件，客户端可以提前开始渲染
+                for diagram in extractor.feed(text):
+                    yield {"status": 200, "data": {"diagram": diagram}}
+
+        if request.error:
+            yield {"status": 200, "data": {"content": f"错误: {request.error}"}}
+
     except Exception as e:
         print(f"生成过程发生错误: {str(e)}")
-        yield f"错误: {str(e)}"
+        yield {"status": 200, "data": {"content": f"错误: {str(e)}"}}
+
+    finally:
+        if not request.finished:
+            print("客户端已断开，取消生成")
+            runtime.scheduler.cancel(request)
+
+def sse_frame(chunk: Dict) -> str:
+    """把一个片段编码为 SSE 事件：文本增量为默认事件，排队位置为 queue 事件，图表为 diagram 事件
+
+    data 中的换行拆成多行 data:，客户端按规范用换行拼接回来；回车符在 SSE 中同样表示换行，一并拆分。
+    """
+    if chunk["status"] == 202:
+        return f"event: queue\ndata: {chunk['data']['queue_position']}\n\n"
+    if "diagram" in chunk["data"]:
+        return f"event: diagram\ndata: {json.dumps(chunk['data']['diagram'], ensure_ascii=False)}\n\n"
+    return "".join(f"data: {line}\n" for line in re.split(r"\r\n|\r|\n", chunk["data"]["content"])) + "\n"
+
+@app.get("/healthz")
+async def healthz():
+    """存活检查：进程能响应即返回 200"""
+    return runtime.health()
+
+@app.get("/readyz")
+async def readyz():
+    """就绪检查：模型加载完成后才返回 200"""
+    status, body = runtime.readiness()
+    return JSONResponse(status_code=status, content=body)
+
+@app.get("/stats")
+async def stats():
+    """调度器负载，router.py 据此选择副本"""
+    body = {"state": runtime.state}
+    if runtime.ready:
+        body.update(runtime.scheduler.stats())
+    return body
 
 @app.post("/")
 async def generate_response(request: ChatRequest):
+    runtime.require()
     if not request.messages:
         raise HTTPException(status_code=400, detail="消息列表不能为空")
     
     print(request.messages)
     
     print("收到请求，开始处理...")
-    
+
+    # 在开始流式响应之前提交，队列已满时客户端能直接收到 429
+    generation = submit_generation(request)
+
     async def response_stream():
-        async for text in generate_stream(request.messages):
+        if request.stream_format == "sse":
+            async for chunk in generate_stream(generation):
+                yield sse_frame(chunk)
+            yield "event: done\ndata:\n\n"
+            return
+        async for chunk in generate_stream(generation):
             # 为每个文本片段创建JSON响应
-            chunk = {
-                "status": 200,
-                "data": {
-                    "content": text
-                }
-            }
             yield json.dumps(chunk, ensure_ascii=False) + "\n"
     
     return StreamingResponse(
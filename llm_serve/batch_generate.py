@@ -0,0 +1,254 @@
+"""离线批量生成：把一批需求文档交给模型，输出 PlantUML 图表及渲染后的图片
+
+输入可以是目录（.docx / .txt / .md，例如 result/需求用例）或 JSONL 文件
+（每行 {"id": ..., "text": ...}，也可以直接给出 "messages"）。
+所有文档在进程内由同一个 BatchScheduler 连续批处理，按 prompt 长度排序后提交，
+长度相近的请求同时在批次中，左填充浪费更少。每个文档完成后立即写出结果
+并追加到 checkpoint 文件，中断后重新运行会跳过已完成的文档。
+
+用法：python batch_generate.py ../result/需求用例 -o ../result/diagrams
+"""
+import argparse
+import json
+import os
+import queue
+import re
+import sys
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from xml.etree import ElementTree
+
+import config
+from engine import BatchScheduler, GenerationRequest
+from loader import load_model
+from prefix_cache import PrefixCache
+from prompts import DEMO_SYSTEM_PROMPT, system_prompt_tokens
+from sampling import SamplingParams
+from speculative import PromptLookupDraft
+
+# 与 web_demo 共用渲染后端（HTTP PlantUML 服务器或本地 plantuml.jar）
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "web_demo"))
+
+DEFAULT_INSTRUCTION = "请根据以下需求文档，使用标准 PlantUML 语言绘制用例图、类图和时序图。"
+CHECKPOINT_FILE = "checkpoint.jsonl"
+INPUT_SUFFIXES = (".docx", ".txt", ".md")
+
+_DIAGRAM_RE = re.compile(r"```(?:plantuml|uml)\s*\n(.*?)```|(@startuml.*?@enduml)", re.DOTALL | re.IGNORECASE)
+_WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def read_docx(path: str) -> str:
+    """读取 .docx 正文中的段落文本（直接解析 word/document.xml，不依赖 python-docx）"""
+    with zipfile.ZipFile(path) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    paragraphs = []
+    for paragraph in root.iter(f"{_WORD_NS}p"):
+        text = "".join(node.text or "" for node in paragraph.iter(f"{_WORD_NS}t"))
+        if text.strip():
+            paragraphs.append(text)
+    return "\n".join(paragraphs)
+
+
+def load_items(source: str) -> List[Dict]:
+    """读取输入，返回 [{"id": ..., "text": ...} 或 {"id": ..., "messages": ...}]"""
+    items = []
+    if os.path.isdir(source):
+        for dirpath, _, filenames in os.walk(source):
+            for name in sorted(filenames):
+                if not name.endswith(INPUT_SUFFIXES) or name.startswith("~$"):
+                    continue
+                path = os.path.join(dirpath, name)
+                item_id = os.path.splitext(os.path.relpath(path, source))[0]
+                if name.endswith(".docx"):
+                    text = read_docx(path)
+                else:
+                    with open(path, encoding="utf-8") as f:
+                        text = f.read()
+                items.append({"id": item_id, "text": text})
+    else:
+        with open(source, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                item.setdefault("id", str(line_number))
+                items.append(item)
+    return items
+
+
+def build_messages(item: Dict, instruction: str) -> List[Dict[str, str]]:
+    if "messages" in item:
+        return item["messages"]
+    return [
+        {"role": "system", "content": DEMO_SYSTEM_PROMPT},
+        {"role": "user", "content": f"{instruction}\n\n{item['text']}"},
+    ]
+
+
+def extract_diagrams(text: str) -> List[str]:
+    return [(fenced or bare).strip() for fenced, bare in _DIAGRAM_RE.findall(text)]
+
+
+def _safe_name(item_id: str) -> str:
+    return re.sub(r"[^\w\-.]+", "_", str(item_id)).strip("_") or "item"
+
+
+def load_checkpoint(path: str) -> set:
+    done = set()
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 上次中断时写了一半的行
+                    continue
+                if entry.get("status") == "ok":
+                    done.add(entry["id"])
+    return done
+
+
+class _Completion:
+    """streamer 接口：生成结束时把请求放入完成队列"""
+
+    def __init__(self, completed: "queue.Queue", item: Dict):
+        self.completed = completed
+        self.item = item
+        self.request = None
+
+    def put(self, value):
+        pass
+
+    def end(self):
+        self.completed.put(self)
+
+
+def _render(backend, code: str, path: str, image_format: str):
+    from utils.uml import RenderError, minify_svg
+
+    try:
+        data = backend.render(code, image_format)
+        if image_format == "svg":
+            data = minify_svg(data)
+    except RenderError as e:
+        return f"渲染失败: {str(e)[:200]}"
+    except Exception as e:
+        return f"渲染错误: {str(e)}"
+    with open(path, "wb") as f:
+        f.write(data)
+    return None
+
+
+def write_result(item_id: str, response: str, output_dir: str, backend, image_format: str) -> Dict:
+    """写出完整回答、每张图表的 .puml 与渲染结果，返回写入 checkpoint 的记录"""
+    item_dir = os.path.join(output_dir, _safe_name(item_id))
+    os.makedirs(item_dir, exist_ok=True)
+    with open(os.path.join(item_dir, "response.md"), "w", encoding="utf-8") as f:
+        f.write(response)
+
+    diagrams = extract_diagrams(response)
+    errors = []
+    for i, code in enumerate(diagrams, 1):
+        with open(os.path.join(item_dir, f"diagram_{i}.puml"), "w", encoding="utf-8") as f:
+            f.write(code + "\n")
+        if backend is not None:
+            error = _render(backend, code, os.path.join(item_dir, f"diagram_{i}.{image_format}"), image_format)
+            if error:
+                errors.append({"diagram": i, "error": error})
+    return {"id": item_id, "status": "ok", "diagrams": len(diagrams), "render_errors": errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量为需求文档生成 PlantUML 图表")
+    parser.add_argument("input", help="需求文档目录（.docx/.txt/.md）或 JSONL 文件")
+    parser.add_argument("-o", "--output", required=True, help="输出目录")
+    parser.add_argument("--model", default=config.MODEL_PATH or "/root/autodl-tmp/aug/", help="模型路径")
+    parser.add_argument("--instruction", default=DEFAULT_INSTRUCTION, help="附加在每个需求文档前的指令")
+    parser.add_argument("--max-new-tokens", type=int, default=config.MAX_NEW_TOKENS)
+    parser.add_argument("--batch-size", type=int, default=config.MAX_BATCH_SIZE)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--format", default="png", choices=["png", "svg", "txt"], help="渲染格式（txt 为字符图）")
+    parser.add_argument("--no-render", action="store_true", help="只输出 .puml，不渲染图片")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint_path = os.path.join(args.output, CHECKPOINT_FILE)
+    done = load_checkpoint(checkpoint_path)
+    items = [item for item in load_items(args.input) if str(item["id"]) not in done]
+    print(f"共 {len(items) + len(done)} 个文档，已完成 {len(done)} 个，本次生成 {len(items)} 个")
+    if not items:
+        return
+
+    backend = None
+    if not args.no_render:
+        from utils.uml import get_render_backend
+        backend = get_render_backend()
+
+    tokenizer, model, device = load_model(args.model)
+    scheduler = BatchScheduler(
+        model, tokenizer, device,
+        max_batch_size=args.batch_size,
+        prefix_cache=PrefixCache(config.PREFIX_CACHE_MAX_BYTES, block_size=config.PREFIX_CACHE_BLOCK_SIZE),
+        draft=(
+            PromptLookupDraft(config.SPECULATIVE_TOKENS, config.SPECULATIVE_NGRAM)
+            if config.SPECULATIVE_TOKENS > 0 else None
+        ),
+        compile_decode=config.TORCH_COMPILE
+    )
+    scheduler.precompute_prefix(system_prompt_tokens(tokenizer, DEMO_SYSTEM_PROMPT))
+    scheduler.start()
+
+    # 按 prompt 长度排序后依次提交，同一批次中的序列长度相近
+    encoded = []
+    for item in items:
+        input_ids = tokenizer.apply_chat_template(
+            build_messages(item, args.instruction), add_generation_prompt=True, tokenize=True
+        )
+        encoded.append((list(input_ids), item))
+    encoded.sort(key=lambda pair: len(pair[0]))
+
+    completed = queue.Queue()
+    for input_ids, item in encoded:
+        completion = _Completion(completed, item)
+        completion.request = GenerationRequest(
+            input_ids, completion,
+            max_new_tokens=args.max_new_tokens,
+            sampling=SamplingParams(temperature=args.temperature, seed=args.seed)
+        )
+        scheduler.submit(completion.request)
+
+    # 渲染在线程池中进行，与仍在进行的生成重叠
+    started = time.perf_counter()
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint, \
+            ThreadPoolExecutor(max_workers=4, thread_name_prefix="batch-render") as executor:
+        pending = []
+        for _ in range(len(encoded)):
+            completion = completed.get()
+            request, item_id = completion.request, str(completion.item["id"])
+            if request.error:
+                print(f"[{item_id}] 生成失败: {request.error}")
+                checkpoint.write(json.dumps({"id": item_id, "status": "error", "error": request.error},
+                                            ensure_ascii=False) + "\n")
+                checkpoint.flush()
+                continue
+            response = tokenizer.decode(request.generated, skip_special_tokens=True)
+            print(f"[{item_id}] 生成完成: {len(request.generated)} tokens，"
+                  f"用时 {time.perf_counter() - started:.1f}s")
+            pending.append(executor.submit(write_result, item_id, response, args.output, backend, args.format))
+
+            # 先写完已渲染好的结果，保证 checkpoint 中的记录对应磁盘上完整的输出
+            for future in [f for f in pending if f.done()]:
+                pending.remove(future)
+                checkpoint.write(json.dumps(future.result(), ensure_ascii=False) + "\n")
+                checkpoint.flush()
+        for future in pending:
+            checkpoint.write(json.dumps(future.result(), ensure_ascii=False) + "\n")
+            checkpoint.flush()
+    print(f"全部完成，用时 {time.perf_counter() - started:.1f}s，结果保存在 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""推理后端配置
+
+全部通过环境变量设置，部署到不同机器（GPU / 纯 CPU）时无需修改代码。
+api.py、glm.py 与 batch_generate.py 都从这里读取，同一个变量在各服务中含义相同。
+"""
+import os
+
+# 模型路径；未设置时使用各服务脚本中的默认路径
+MODEL_PATH = os.environ.get("AUG_MODEL_PATH")
+
+# 推理设备：auto（有 GPU 时用 GPU）/ cuda / cpu
+DEVICE = os.environ.get("AUG_DEVICE", "auto")
+
+# 权重精度：auto（GPU 上 bfloat16，CPU 上 float32）/ bfloat16 / float16 / float32
+DTYPE = os.environ.get("AUG_DTYPE", "auto")
+
+# 仅权重量化：none / int8（torch 动态量化）/ int4（需要安装 torchao）
+QUANTIZE = os.environ.get("AUG_QUANTIZE", "none")
+
+# 量化后检查点的缓存目录；同一模型与量化方式只需量化一次
+QUANT_CACHE_DIR = os.environ.get(
+    "AUG_QUANT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "aug", "quantized")
+)
+
+# int4 量化的分组大小
+INT4_GROUP_SIZE = int(os.environ.get("AUG_INT4_GROUP_SIZE", "128"))
+
+# 是否用 torch.compile 编译单 token 解码步
+TORCH_COMPILE = os.environ.get("AUG_TORCH_COMPILE", "0") == "1"
+
+# CPU 推理使用的线程数，0 表示使用 torch 默认值
+CPU_THREADS = int(os.environ.get("AUG_CPU_THREADS", "0"))
+
+# 模型加载完成后预热生成的 token 数，0 表示不预热
+WARMUP_TOKENS = int(os.environ.get("AUG_WARMUP_TOKENS", "0"))
+
+# 单个请求最多生成的 token 数（请求中的 max_new_tokens 不能超过该值）
+MAX_NEW_TOKENS = int(os.environ.get("AUG_MAX_NEW_TOKENS", "5000"))
+
+# 同时参与解码的最大序列数
+MAX_BATCH_SIZE = int(os.environ.get("AUG_MAX_BATCH_SIZE", "32"))
+
+# 准入控制：等待队列中的最大请求数与 prompt token 总数（0 表示不限制），
+# 超出时返回 429，并建议客户端 RETRY_AFTER 秒后重试
+MAX_QUEUED_REQUESTS = int(os.environ.get("AUG_MAX_QUEUED_REQUESTS", "64"))
+MAX_QUEUED_TOKENS = int(os.environ.get("AUG_MAX_QUEUED_TOKENS", "131072"))
+RETRY_AFTER = int(os.environ.get("AUG_RETRY_AFTER", "2"))
+
+# 排队位置不变时重复发送 queue 事件的间隔（秒），避免客户端读超时
+QUEUE_HEARTBEAT_INTERVAL = float(os.environ.get("AUG_QUEUE_HEARTBEAT_INTERVAL", "5"))
+
+# 多轮对话前缀 KV cache 的显存上限（字节）与哈希块大小（token）
+PREFIX_CACHE_MAX_BYTES = int(os.environ.get("AUG_PREFIX_CACHE_MAX_BYTES", str(4 * 1024 ** 3)))
+PREFIX_CACHE_BLOCK_SIZE = int(os.environ.get("AUG_PREFIX_CACHE_BLOCK_SIZE", "32"))
+
+# 投机解码：每步最多验证的草稿 token 数（0 表示关闭）与查找草稿时匹配的最长 n-gram
+SPECULATIVE_TOKENS = int(os.environ.get("AUG_SPECULATIVE_TOKENS", "0"))
+SPECULATIVE_NGRAM = int(os.environ.get("AUG_SPECULATIVE_NGRAM", "3"))
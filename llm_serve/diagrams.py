@@ -0,0 +1,72 @@
+"""从流式输出中增量提取 PlantUML 图表
+
+每收到一段文本就按行推进，```plantuml（或 ```uml）代码块一闭合就立即给出图表，
+客户端可以在模型继续生成后面的说明文字时开始渲染。
+提取出的源码与 web_demo 在整条消息到达后按 ``` 切分得到的相同，渲染缓存可以直接命中。
+"""
+from typing import Dict, List
+
+from grammar import check_diagram
+
+_FENCE = "```"
+_FENCE_LANGUAGES = ("plantuml", "uml")
+
+
+def diagram_type(code: str) -> str:
+    """与 web_demo 中 split_message_parts 的判断规则一致"""
+    lower = code.lower()
+    if "class" in lower:
+        return "class"
+    if "usecase" in lower or "actor" in lower:
+        return "usecase"
+    if "participant" in lower or "->" in lower:
+        return "sequence"
+    return "unknown"
+
+
+class DiagramExtractor:
+    def __init__(self):
+        self._line = ""
+        self._in_block = False
+        self._block: List[str] = []
+        self._count = 0
+
+    def feed(self, text: str) -> List[Dict]:
+        """读入一段新文本，返回其中闭合的图表 [{"index", "code", "type", "well_formed"}]"""
+        diagrams = []
+        lines = (self._line + text).split("\n")
+        self._line = lines.pop()
+        for line in lines:
+            diagram = self._on_line(line)
+            if diagram is not None:
+                diagrams.append(diagram)
+        # 关闭代码块的 ``` 后面可能不再有换行（消息结尾），不必等到下一行
+        if self._in_block and _FENCE in self._line:
+            diagram = self._on_line(self._line)
+            self._line = ""
+            if diagram is not None:
+                diagrams.append(diagram)
+        return diagrams
+
+    def _on_line(self, line: str):
+        index = line.find(_FENCE)
+        if not self._in_block:
+            if index >= 0 and line[index + len(_FENCE):].strip().lower() in _FENCE_LANGUAGES:
+                self._in_block = True
+                self._block = []
+            return None
+        if index < 0:
+            self._block.append(line)
+            return None
+        self._block.append(line[:index])
+        self._in_block = False
+        code = "\n".join(self._block).strip()
+        if "@startuml" not in code.lower() or "@enduml" not in code.lower():
+            return None
+        self._count += 1
+        return {
+            "index": self._count,
+            "code": code,
+            "type": diagram_type(code),
+            "well_formed": check_diagram(code),
+        }
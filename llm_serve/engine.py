@@ -0,0 +1,528 @@
+"""连续批处理推理引擎
+
+所有请求进入同一个等待队列，由一个后台线程执行统一的解码循环：
+新请求在 token 步之间加入批次，生成结束的请求随即离开批次。
+配置了草稿生成器时，每一步把各行的草稿 token 一起送入模型验证，
+被拒绝的位置在 attention mask 中置 0，贪心解码结果与逐 token 解码一致。
+开启受限解码的请求在采样前按语法状态屏蔽 logits（这类请求不使用草稿）。
+每个请求有自己的采样参数与停止条件（见 sampling.py），随机采样的行同样不使用草稿。
+等待队列有请求数与 prompt token 总数上限，超出时 submit 直接拒绝，
+避免突发流量把所有请求都拖慢。客户端断开后 cancel() 把请求移出批次，空出的位置立即给等待中的请求。
+"""
+import inspect
+import threading
+from collections import deque
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from sampling import SamplingParams, StopMatcher, sample
+
+# KV cache 采用 legacy tuple 格式：每层 (key, value)，形状为 [batch, heads, seq, dim]
+_BATCH_DIM = 0
+_SEQ_DIM = 2
+
+
+class AdmissionRejected(Exception):
+    """等待队列已满，请求未被接纳"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GenerationRequest:
+    """调度器中的一次生成请求"""
+
+    def __init__(self, input_ids: List[int], streamer, max_new_tokens: int = 5000, constrained: bool = False,
+                 sampling: Optional[SamplingParams] = None):
+        self.input_ids = input_ids
+        self.streamer = streamer
+        self.max_new_tokens = max_new_tokens
+        self.constrained = constrained
+        self.sampling = sampling or SamplingParams()
+        self.generated: List[int] = []
+        self.error: Optional[str] = None
+        self.finished = False
+        # 下一步要送入模型的 token，以及它的位置编号
+        self.next_token: Optional[int] = None
+        self.position = 0
+        # prefill 时从前缀缓存中复用的 token 数
+        self.cached_tokens = 0
+        # 草稿生成器为该请求维护的状态
+        self.draft_state = None
+        # 受限解码的语法状态，None 表示不受约束
+        self.grammar_state = None
+        # 客户端已断开，解码循环会在下一步把它移出批次
+        self.cancelled = False
+        # 指定 seed 时该请求独占的随机数生成器，以及停止条件的匹配状态
+        self.generator = None
+        self.stop_matcher: Optional[StopMatcher] = None
+
+
+def _to_legacy(past):
+    """统一把模型返回的 KV cache 转成 legacy tuple 格式"""
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return tuple(tuple(layer) for layer in past)
+
+
+def _left_pad_past(past, length):
+    """在序列维左侧补零，使 KV cache 长度达到 length"""
+    pad = length - past[0][0].shape[_SEQ_DIM]
+    if pad <= 0:
+        return past
+    return tuple(tuple(F.pad(t, (0, 0, pad, 0)) for t in layer) for layer in past)
+
+
+def _left_pad_mask(mask, length):
+    pad = length - mask.shape[1]
+    if pad <= 0:
+        return mask
+    return F.pad(mask, (pad, 0))
+
+
+def _cat_past(a, b):
+    return tuple(
+        tuple(torch.cat([ta, tb], dim=_BATCH_DIM) for ta, tb in zip(la, lb))
+        for la, lb in zip(a, b)
+    )
+
+
+def _select_past(past, index):
+    return tuple(tuple(t.index_select(_BATCH_DIM, index) for t in layer) for layer in past)
+
+
+def _trim_past(past, start):
+    return tuple(tuple(t[:, :, start:] for t in layer) for layer in past)
+
+
+def _crop_past(past, length):
+    return tuple(tuple(t[:, :, :length] for t in layer) for layer in past)
+
+
+def _row_past(past, mask, row, length):
+    """取出批次中某一行前 length 个有效位置（mask 为 1）的 KV cache"""
+    columns = mask[row].nonzero().squeeze(1)[:length]
+    return tuple(
+        tuple(t.narrow(_BATCH_DIM, row, 1).index_select(_SEQ_DIM, columns) for t in layer)
+        for layer in past
+    )
+
+
+class BatchScheduler:
+    """把所有请求合并到一个解码循环中的调度器"""
+
+    def __init__(self, model, tokenizer, device, max_batch_size: int = 32, prefix_cache=None, draft=None, grammar=None,
+                 compile_decode: bool = False, max_queued_requests: int = 0, max_queued_tokens: int = 0,
+                 retry_after: int = 2):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.draft = draft
+        self.grammar = grammar
+
+        eos = model.generation_config.eos_token_id
+        if eos is None:
+            eos = []
+        self.eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+
+        # 只计算最后一个位置的 logits，避免 prefill 时产生 [seq, vocab] 的大张量
+        params = inspect.signature(model.forward).parameters
+        if "return_last_logit" in params:
+            self._logits_param = "return_last_logit"
+        elif "num_logits_to_keep" in params:
+            self._logits_param = "num_logits_to_keep"
+        else:
+            self._logits_param = None
+        self._last_logit_kwargs = self._logit_kwargs(1)
+
+        # 原生模型使用 Cache 对象，remote code 模型（如 GLM4）仍使用 tuple
+        self._use_cache_class = getattr(model, "_supports_cache_class", False)
+
+        # 单 token 解码步形状固定（只有批大小和 KV 长度变化），适合用 torch.compile 编译；
+        # prefill 与草稿验证的输入长度各不相同，仍以 eager 方式执行
+        self._decode_model = torch.compile(model, dynamic=True) if compile_decode else model
+
+        # 等待队列上限（0 表示不限制）与拒绝时建议客户端等待的秒数
+        self.max_queued_requests = max_queued_requests
+        self.max_queued_tokens = max_queued_tokens
+        self.retry_after = retry_after
+
+        self._waiting = deque()
+        self._queued_tokens = 0
+        self._cond = threading.Condition()
+        self._running: List[GenerationRequest] = []
+        self._past = None
+        self._attention_mask = None  # [batch, seq]，左侧填充位置为 0
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    @torch.inference_mode()
+    def precompute_prefix(self, tokens: List[int]):
+        """预先计算一段公共前缀的 KV cache，并作为常驻条目放入前缀缓存
+
+        需在 start() 之前调用，或确保解码循环空闲。
+        """
+        if self.prefix_cache is None or not tokens:
+            return
+        input_ids = torch.tensor([tokens], device=self.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            position_ids=torch.arange(len(tokens), device=self.device).unsqueeze(0),
+            use_cache=True,
+            **self._last_logit_kwargs,
+        )
+        self.prefix_cache.store(tokens, _to_legacy(outputs.past_key_values), pinned=True)
+
+    def submit(self, request: GenerationRequest):
+        """把请求放入等待队列，由解码循环在下一个 token 步接纳
+
+        队列已满时抛出 AdmissionRejected；队列为空时总是接纳，
+        即使单个请求的 prompt 超过 token 上限。
+        """
+        if request.constrained and self.grammar is not None and self.grammar.compiled:
+            request.grammar_state = self.grammar.initial_state
+        params = request.sampling
+        if not params.greedy and params.seed is not None:
+            request.generator = torch.Generator(device=self.device).manual_seed(params.seed)
+        if params.has_stop:
+            request.stop_matcher = StopMatcher(self.tokenizer, params.stop, params.stop_after_diagram)
+        tokens = len(request.input_ids)
+        with self._cond:
+            if self._waiting:
+                if self.max_queued_requests and len(self._waiting) >= self.max_queued_requests:
+                    raise AdmissionRejected(f"等待队列已满（{len(self._waiting)} 个请求）", self.retry_after)
+                if self.max_queued_tokens and self._queued_tokens + tokens > self.max_queued_tokens:
+                    raise AdmissionRejected(f"等待队列已满（{self._queued_tokens} tokens）", self.retry_after)
+            self._waiting.append(request)
+            self._queued_tokens += tokens
+            self._cond.notify()
+
+    def cancel(self, request: GenerationRequest):
+        """取消请求：仍在排队的直接移出队列，已在批次中的在下一个 token 步移出"""
+        if request.finished:
+            return
+        request.cancelled = True
+        with self._cond:
+            try:
+                self._waiting.remove(request)
+            except ValueError:
+                return
+            self._queued_tokens -= len(request.input_ids)
+        self._finish(request)
+
+    def queue_position(self, request: GenerationRequest) -> int:
+        """请求在等待队列中的位置（从 1 开始），已进入批次时返回 0"""
+        with self._cond:
+            for i, waiting in enumerate(self._waiting):
+                if waiting is request:
+                    return i + 1
+        return 0
+
+    def stats(self) -> dict:
+        """负载快照，供多副本路由选择副本；从其他线程读取，数值是近似的"""
+        running = list(self._running)
+        with self._cond:
+            waiting = list(self._waiting)
+        return {
+            "waiting": len(waiting),
+            "running": len(running),
+            # 批次中已占用 KV cache 的 token 数，加上等待 prefill 的 prompt 长度
+            "inflight_tokens": sum(r.position for r in running) + sum(len(r.input_ids) for r in waiting),
+        }
+
+    def _next_waiting(self, block: bool) -> Optional[GenerationRequest]:
+        with self._cond:
+            while block and not self._waiting:
+                self._cond.wait()
+            if not self._waiting:
+                return None
+            request = self._waiting.popleft()
+            self._queued_tokens -= len(request.input_ids)
+            return request
+
+    def _loop(self):
+        while True:
+            # 批次为空时阻塞等待，避免空转
+            if not self._running:
+                self._admit(self._next_waiting(block=True))
+            while len(self._running) < self.max_batch_size:
+                request = self._next_waiting(block=False)
+                if request is None:
+                    break
+                self._admit(request)
+            if self._running:
+                try:
+                    self._step()
+                except Exception as e:
+                    print(f"解码过程发生错误: {str(e)}")
+                    self._fail_batch(e)
+
+    def _admit(self, request: GenerationRequest):
+        """prefill 新请求并拼入批次；任何一步出错都不能让调度线程退出"""
+        if request.cancelled:
+            self._finish(request)
+            return
+        try:
+            past = self._prefill(request)
+        except Exception as e:
+            print(f"prefill 发生错误: {str(e)}")
+            self._fail(request, e)
+            return
+        if request.finished:
+            try:
+                self._save_prefix(request, past)
+            except Exception as e:
+                # 请求已经完成，只是没能写入前缀缓存
+                print(f"写入前缀缓存发生错误: {str(e)}")
+            return
+        try:
+            self._join(request, past)
+        except Exception as e:
+            # 拼接到一半时批次的 KV cache 与 mask 可能已经不一致，整个批次一起失败
+            print(f"加入批次发生错误: {str(e)}")
+            self._fail(request, e)
+            self._fail_batch(e)
+
+    def _fail_batch(self, error: Exception):
+        """运行批次中的所有请求以错误结束，并清空批次状态"""
+        for request in self._running:
+            self._fail(request, error)
+        self._running = []
+        self._past = None
+        self._attention_mask = None
+
+    @torch.inference_mode()
+    def _prefill(self, request: GenerationRequest):
+        """单独对新请求做 prefill，返回其 KV cache 并产出第一个 token"""
+        tokens = request.input_ids
+        length = len(tokens)
+        cached, past = 0, None
+        if self.prefix_cache is not None:
+            cached, past = self.prefix_cache.lookup(tokens)
+            if cached:
+                print(f"前缀缓存命中: {cached}/{length} tokens")
+        request.cached_tokens = cached
+
+        outputs = self.model(
+            input_ids=torch.tensor([tokens[cached:]], device=self.device),
+            attention_mask=torch.ones((1, length), dtype=torch.long, device=self.device),
+            position_ids=torch.arange(cached, length, device=self.device).unsqueeze(0),
+            past_key_values=self._model_cache(past) if past is not None else None,
+            use_cache=True,
+            **self._last_logit_kwargs,
+        )
+        request.position = length
+        self._emit(request, self._sample(outputs.logits[:, -1, :], [request])[0])
+        return _to_legacy(outputs.past_key_values)
+
+    def _join(self, request: GenerationRequest, past):
+        """把新序列的 KV cache 左填充对齐后拼入运行批次"""
+        mask = torch.ones((1, request.position), dtype=torch.long, device=self.device)
+        if self._past is None:
+            self._past, self._attention_mask = past, mask
+        else:
+            length = max(self._attention_mask.shape[1], mask.shape[1])
+            self._past = _cat_past(_left_pad_past(self._past, length), _left_pad_past(past, length))
+            self._attention_mask = torch.cat(
+                [_left_pad_mask(self._attention_mask, length), _left_pad_mask(mask, length)], dim=0
+            )
+        self._running.append(request)
+
+    def _logit_kwargs(self, count: int):
+        """只保留最后 count 个位置的 logits 所需的模型参数"""
+        if self._logits_param == "return_last_logit":
+            return {"return_last_logit": count == 1}
+        if self._logits_param == "num_logits_to_keep":
+            return {"num_logits_to_keep": count}
+        return {}
+
+    @torch.inference_mode()
+    def _step(self):
+        """对运行批次中的所有序列解码一个 token；有草稿时改为验证草稿"""
+        if any(r.cancelled for r in self._running):
+            # 释放已断开请求占用的批次位置，其 KV cache 照常存入前缀缓存
+            for request in self._running:
+                if request.cancelled and not request.finished:
+                    self._finish(request)
+            self._evict_finished()
+            if not self._running:
+                return
+
+        if self.draft is not None:
+            drafts = [
+                self.draft.propose(r, r.max_new_tokens - len(r.generated) - 1)
+                if r.grammar_state is None and r.sampling.greedy else []
+                for r in self._running
+            ]
+            if any(drafts):
+                self._verify(drafts)
+                self._evict_finished()
+                return
+
+        batch = self._running
+        input_ids = torch.tensor([[r.next_token] for r in batch], device=self.device)
+        position_ids = torch.tensor([[r.position] for r in batch], device=self.device)
+        attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((len(batch), 1))], dim=1
+        )
+        outputs = self._decode_model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._model_cache(self._past),
+            use_cache=True,
+            **self._last_logit_kwargs,
+        )
+        self._past = _to_legacy(outputs.past_key_values)
+        self._attention_mask = attention_mask
+
+        tokens = self._sample(outputs.logits[:, -1, :], batch)
+        for request, token in zip(batch, tokens):
+            request.position += 1
+            self._emit(request, token)
+        self._evict_finished()
+
+    def _verify(self, drafts: List[List[int]]):
+        """把 [next_token, 草稿...] 一次送入模型，逐行接受与贪心结果一致的最长草稿前缀
+
+        各行草稿长度不同，右侧不足的位置以 mask 0 填充；被拒绝草稿的 KV 同样置 0，
+        最后裁掉所有行都不再需要的右侧列。
+        """
+        batch = self._running
+        width = 1 + max(len(d) for d in drafts)
+        input_ids = torch.tensor(
+            [[r.next_token] + d + [r.next_token] * (width - 1 - len(d)) for r, d in zip(batch, drafts)],
+            device=self.device,
+        )
+        position_ids = torch.tensor(
+            [[r.position + j for j in range(width)] for r in batch], device=self.device
+        )
+        block_mask = torch.tensor(
+            [[1] * (1 + len(d)) + [0] * (width - 1 - len(d)) for d in drafts],
+            dtype=self._attention_mask.dtype,
+            device=self.device,
+        )
+        attention_mask = torch.cat([self._attention_mask, block_mask], dim=1)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._model_cache(self._past),
+            use_cache=True,
+            **self._logit_kwargs(width),
+        )
+        logits = outputs.logits[:, -width:, :]
+        # 受限解码与随机采样的行没有草稿，只取第一个位置
+        first = self._sample(logits[:, 0, :], batch)
+        predictions = logits.argmax(dim=-1).tolist()
+        for predicted, token in zip(predictions, first):
+            predicted[0] = token
+
+        kept = 1
+        for i, (request, draft, predicted) in enumerate(zip(batch, drafts, predictions)):
+            accepted = 0
+            while accepted < len(draft) and draft[accepted] == predicted[accepted]:
+                accepted += 1
+            emitted = 0
+            for token in predicted[:accepted + 1]:
+                self._emit(request, token)
+                emitted += 1
+                if request.finished:
+                    break
+            # KV 中有效的是 next_token 以及已输出的前 emitted - 1 个草稿
+            request.position += emitted
+            block_mask[i, emitted:] = 0
+            kept = max(kept, emitted)
+
+        length = self._attention_mask.shape[1] + kept
+        self._past = _crop_past(_to_legacy(outputs.past_key_values), length)
+        self._attention_mask = torch.cat([self._attention_mask, block_mask[:, :kept]], dim=1)
+
+    def _model_cache(self, past):
+        if self._use_cache_class:
+            return DynamicCache.from_legacy_cache(past)
+        return past
+
+    def _apply_grammar(self, logits, requests):
+        """按各行的语法状态就地屏蔽不允许的 token"""
+        if self.grammar is None:
+            return
+        for row, request in enumerate(requests):
+            if request.grammar_state is None:
+                continue
+            mask = self.grammar.mask(request.grammar_state, logits.shape[-1])
+            if mask is not None:
+                logits[row].masked_fill_(~mask, float("-inf"))
+
+    def _sample(self, logits, requests) -> List[int]:
+        self._apply_grammar(logits, requests)
+        # 默认贪心解码（与原先 do_sample=True, top_k=1 的设置等价），设置了 temperature 的行单独采样
+        tokens = logits.argmax(dim=-1).tolist()
+        for row, request in enumerate(requests):
+            if not request.sampling.greedy:
+                tokens[row] = sample(logits[row], request.sampling, request.generator)
+        return tokens
+
+    def _emit(self, request: GenerationRequest, token: int):
+        request.generated.append(token)
+        if request.grammar_state is not None:
+            request.grammar_state = self.grammar.advance(request.grammar_state, token)
+        if token in self.eos_token_ids:
+            self._finish(request)
+            return
+        request.streamer.put(torch.tensor([token]))
+        request.next_token = token
+        if len(request.generated) >= request.max_new_tokens:
+            self._finish(request)
+        elif request.stop_matcher is not None and request.stop_matcher.update(token):
+            self._finish(request)
+
+    def _finish(self, request: GenerationRequest):
+        request.finished = True
+        request.streamer.end()
+
+    def _fail(self, request: GenerationRequest, error: Exception):
+        request.error = str(error)
+        if not request.finished:
+            self._finish(request)
+
+    def _save_prefix(self, request: GenerationRequest, past):
+        """把已计算过 KV 的 token（prompt 加上已送入模型的生成结果）存入前缀缓存"""
+        if self.prefix_cache is None or request.error:
+            return
+        tokens = (request.input_ids + request.generated)[:request.position]
+        self.prefix_cache.store(tokens, past)
+
+    def _evict_finished(self):
+        """移除已完成的序列，并裁掉所有行都不再需要的左侧填充"""
+        keep = []
+        for i, request in enumerate(self._running):
+            if request.finished:
+                self._save_prefix(request, _row_past(self._past, self._attention_mask, i, request.position))
+            else:
+                keep.append(i)
+        if len(keep) == len(self._running):
+            return
+        if not keep:
+            self._running = []
+            self._past = None
+            self._attention_mask = None
+            return
+        index = torch.tensor(keep, device=self.device)
+        self._running = [self._running[i] for i in keep]
+        self._past = _select_past(self._past, index)
+        self._attention_mask = self._attention_mask.index_select(0, index)
+
+        start = int((self._attention_mask.sum(dim=0) > 0).nonzero()[0])
+        if start > 0:
+            self._past = _trim_past(self._past, start)
+            self._attention_mask = self._attention_mask[:, start:]
@@ -1,33 +1,64 @@
+import asyncio
 import os
-import torch
 import uvicorn
-from fastapi import FastAPI, Request
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from transformers import AsyncTextIteratorStreamer
 from pydantic import BaseModel
 from typing import List, Dict
 from fastapi.responses import JSONResponse
 
-# 设置环境变量
-os.environ['CUDA_VISIBLE_DEVICES'] = '0'
-
-# 模型路径
-MODEL_PATH = "/root/autodl-tmp/AUG/"
-
-# 检查是否使用 GPU
-device = "cuda" if torch.cuda.is_available() else "cpu"
-
-# 初始化 tokenizer 和模型
-tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_PATH,
-    torch_dtype=torch.bfloat16,
-    low_cpu_mem_usage=True,
-    trust_remote_code=True,
-    device_map="auto"  # 使用 accelerate 进行设备自动分配
-).eval()  # 删除 .to(device) 调用
+import config
+from engine import AdmissionRejected, BatchScheduler, GenerationRequest
+from loader import load_model
+from prefix_cache import PrefixCache
+from prompts import GLM_SYSTEM_PROMPT, system_prompt_tokens
+from speculative import PromptLookupDraft
+from runtime import ModelRuntime
+
+# 设置环境变量（由 router.py 启动的副本已指定了各自的设备）
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '0')
+
+# 模型路径（可通过 AUG_MODEL_PATH 覆盖）
+MODEL_PATH = config.MODEL_PATH or "/root/autodl-tmp/AUG/"
+
+# 生成期间检查客户端是否断开的间隔（秒）
+DISCONNECT_POLL_INTERVAL = 1.0
+
+def build_runtime():
+    """加载模型并启动调度器，在 lifespan 的后台线程中执行"""
+    # 按配置选择设备、精度与量化方式，初始化 tokenizer 和模型
+    tokenizer, model, device = load_model(MODEL_PATH)
+
+    # 与 api.py 相同的批处理调度器，系统提示词的 KV cache 在启动时预先计算
+    prefix_cache = PrefixCache(config.PREFIX_CACHE_MAX_BYTES, block_size=config.PREFIX_CACHE_BLOCK_SIZE)
+    scheduler = BatchScheduler(
+        model, tokenizer, device,
+        max_batch_size=config.MAX_BATCH_SIZE,
+        prefix_cache=prefix_cache,
+        draft=(
+            PromptLookupDraft(config.SPECULATIVE_TOKENS, config.SPECULATIVE_NGRAM)
+            if config.SPECULATIVE_TOKENS > 0 else None
+        ),
+        compile_decode=config.TORCH_COMPILE,
+        max_queued_requests=config.MAX_QUEUED_REQUESTS,
+        max_queued_tokens=config.MAX_QUEUED_TOKENS,
+        retry_after=config.RETRY_AFTER
+    )
+    scheduler.precompute_prefix(system_prompt_tokens(tokenizer, GLM_SYSTEM_PROMPT))
+    scheduler.start()
+    return tokenizer, scheduler
+
+runtime = ModelRuntime(build_runtime)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 模型在后台加载，服务立即开始监听
+    runtime.start()
+    yield
 
 # 创建 FastAPI 实例
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 gen_kwargs = {"max_length": 2500, "do_sample": True, "top_k": 1}
 
 # 定义请求体结构
@@ -35,9 +66,48 @@ class ChatRequest(BaseModel):
     prompt: str
     history: List[Dict[str, str]]  # 历史记录，以 role 和 content 对象列表的形式
 
+async def collect_response(http_request: Request, request_state: GenerationRequest) -> str:
+    """汇总生成的文本，期间定期检查客户端是否已断开，断开则从调度器中取消请求"""
+    chunks = []
+
+    async def collect():
+        async for text in request_state.streamer:
+            chunks.append(text)
+
+    task = asyncio.ensure_future(collect())
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if not task.done() and await http_request.is_disconnected():
+                print("客户端已断开，取消生成")
+                runtime.scheduler.cancel(request_state)
+                await task
+    finally:
+        if not request_state.finished:
+            runtime.scheduler.cancel(request_state)
+    return "".join(chunks)
+
+@app.get("/healthz")
+async def healthz():
+    return runtime.health()
+
+@app.get("/readyz")
+async def readyz():
+    status, body = runtime.readiness()
+    return JSONResponse(status_code=status, content=body)
+
+@app.get("/stats")
+async def stats():
+    body = {"state": runtime.state}
+    if runtime.ready:
+        body.update(runtime.scheduler.stats())
+    return body
+
 # API 路由处理 POST 请求
 @app.post("/")
-async def generate_response(request: ChatRequest):
+async def generate_response(request: ChatRequest, http_request: Request):
+    runtime.require()
+    tokenizer = runtime.tokenizer
     user_input = request.prompt
     history = request.history if request.history else []  # 如果没有历史，则初始化为空列表
 
@@ -46,7 +116,7 @@ async def generate_response(request: ChatRequest):
 
     # 合并历史记录和当前输入
     conversation_history = [
-        {"role": "system", "content": "你是AUG需求助手，你的任务是协助开发者进行需求建模。"}
+        {"role": "system", "content": GLM_SYSTEM_PROMPT}
     ]
 
     # 处理历史记录，使用 role 来保持一致性
@@ -62,18 +132,16 @@ async def generate_response(request: ChatRequest):
                                            return_dict=True
                                            )
 
-    # 移动 inputs 到模型所在的设备（accelerate 会处理设备分配）
-    inputs = {key: value.to(device) for key, value in inputs.items()}
-
     # 生成响应
-    gen_kwargs = {"max_new_tokens": 5000, "do_sample": True, "top_k": 1}
-
-    with torch.no_grad():
-        outputs = model.generate(**inputs, **gen_kwargs)
-        outputs = outputs[:, inputs['input_ids'].shape[1]:]
-
-    # 解码生成的文本
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    streamer = AsyncTextIteratorStreamer(tokenizer, skip_special_tokens=True)
+    request_state = GenerationRequest(inputs["input_ids"][0].tolist(), streamer, max_new_tokens=config.MAX_NEW_TOKENS)
+    try:
+        runtime.scheduler.submit(request_state)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    # 汇总生成的文本；客户端中途断开时取消生成
+    response = await collect_response(http_request, request_state)
 
     history.append({"role": "assistant", "content": response})
 
@@ -0,0 +1,388 @@
+"""PlantUML 受限解码
+
+模型输出的 ```plantuml 代码块内，逐 token 屏蔽会导致语法错误的候选：
+缺少 @startuml/@enduml、引号或括号未闭合、花括号块与 note 块不配对、
+代码块中途出现反引号、在图表结束前输出 EOS 等。代码块之外不做任何限制。
+
+字符级自动机的状态都是有限的、可哈希的元组。compile() 从初始状态出发枚举所有
+可达状态，得到状态转移表，再用张量运算让全部 token 同时在表上走完，一次性得到
+每个受限状态的 token 掩码；解码时只需按状态查表，不会在解码步骤中遍历词表。
+标题、注释、标签等自由文本不检查括号是否配对。
+"""
+import re
+import threading
+from typing import Iterable, List, Optional
+
+import torch
+
+# 允许嵌套的花括号块层数（package / rectangle / class 等）
+MAX_BLOCK_DEPTH = 8
+FENCE_LANGUAGES = ("plantuml", "uml")
+
+# 行首关键字：note 之后可能是多行注释块，标题类关键字之后的整行是自由文本
+_NOTE_KEYWORD = "note"
+_TEXT_KEYWORDS = ("title", "header", "footer", "caption")
+_LINE_KEYWORDS = (_NOTE_KEYWORD,) + _TEXT_KEYWORDS
+
+# 关键字中出现的字母需要保留原样，其余字母、数字和非 ASCII 字符在自动机中不作区分
+_KEYWORD_LETTERS = set("plantumlstartumlendumlnoteend" + "".join(_TEXT_KEYWORDS))
+_WORD_CHAR = "b"
+_CONTROL_CHAR = "\x00"
+_BYTE_TOKEN_RE = re.compile(r"^<0x([0-9A-Fa-f]{2})>$")
+
+
+def _canonical(ch: str) -> str:
+    if ch in " \t\r":
+        return " "
+    if ch != "\n" and (ord(ch) < 32 or ord(ch) == 127):
+        return _CONTROL_CHAR
+    lower = ch.lower()
+    if lower in _KEYWORD_LETTERS:
+        return lower
+    if ch.isalnum() or ch == "_" or ord(ch) > 127:
+        return _WORD_CHAR
+    return ch
+
+
+def _is_prefix(text: str, targets: Iterable[str]) -> bool:
+    return any(t.startswith(text) for t in targets)
+
+
+# ===== 字符级自动机 =====
+# ("text", k)          代码块之外；k 为行首已读到的反引号数，-1 表示行中
+# ("lang", s)          读取 ``` 之后的语言标记
+# ("code", k)          其他语言的代码块
+# ("start", s)         等待 @startuml
+# ("body", depth, sub) 图表正文；sub 为当前行的解析进度
+# ("note", depth, sub) 多行 note 块
+# ("after", k)         @enduml 之后，等待关闭代码块
+
+INITIAL_STATE = ("text", 0)
+
+
+def _text_step(kind, k, ch):
+    if ch == "\n":
+        return (kind, 0)
+    if ch == "`" and k >= 0:
+        if k == 2:
+            return ("lang", "") if kind == "text" else ("text", -1)
+        return (kind, k + 1)
+    return (kind, -1)
+
+
+def _lang_step(s, ch):
+    if ch == "\n":
+        return ("start", "") if s.strip() in FENCE_LANGUAGES else ("code", 0)
+    if ch == " ":
+        return ("lang", s if s.endswith(" ") or s == "x" else s + " ")
+    if s != "x" and not s.endswith(" ") and _is_prefix(s + ch, FENCE_LANGUAGES):
+        return ("lang", s + ch)
+    return ("lang", "x")
+
+
+def _start_step(s, ch):
+    if s == "@startuml":
+        if ch == "\n":
+            return ("body", 0, "ls")
+        return None if ch == "`" else ("start", s)
+    if s == "" and ch in " \n":
+        return ("start", "")
+    if "@startuml".startswith(s + ch):
+        return ("start", s + ch)
+    return None
+
+
+def _statement_step(depth, sub, ch):
+    """普通语句行：sub = ("st", mode, brace, note)
+
+    mode: n 普通 / q 引号内 / p 括号内 / g 行内花括号 / l 冒号后的标签
+    brace: 行内出现了尚未闭合的 {，行尾时开启新块
+    note: 1 表示以 note 开头且可能是多行 note，2 表示已确定为单行 note
+    """
+    _, mode, brace, note = sub
+    if ch == "`":
+        return None
+    if ch == "\n":
+        if mode in "qpg":
+            return None
+        if brace:
+            return ("body", depth + 1, "ls") if depth < MAX_BLOCK_DEPTH else None
+        if note == 1:
+            return ("note", depth, "ls")
+        return ("body", depth, "ls")
+    if mode == "l":
+        return ("body", depth, sub)
+    if mode == "q":
+        return ("body", depth, ("st", "n", brace, note)) if ch == '"' else ("body", depth, sub)
+    if mode == "p":
+        return ("body", depth, ("st", "n", brace, note)) if ch == ")" else ("body", depth, sub)
+    if mode == "g":
+        return ("body", depth, ("st", "n", 0, note)) if ch == "}" else ("body", depth, sub)
+    if brace:
+        if ch == " ":
+            return ("body", depth, sub)
+        if ch == "}":
+            return ("body", depth, ("st", "n", 0, note))
+        return ("body", depth, ("st", "g", 0, note))
+    if ch == '"':
+        return ("body", depth, ("st", "q", 0, 2 if note else 0))
+    if ch == "(":
+        return ("body", depth, ("st", "p", 0, note))
+    if ch == ":":
+        return ("body", depth, ("st", "l", 0, 0))
+    if ch == "{":
+        return ("body", depth, ("st", "n", 1, note))
+    if ch in ")}":
+        return None
+    return ("body", depth, sub)
+
+
+_STATEMENT = ("st", "n", 0, 0)
+
+
+def _body_step(depth, sub, ch):
+    if isinstance(sub, tuple):
+        return _statement_step(depth, sub, ch)
+    if sub == "ls":
+        if ch in " \n":
+            return ("body", depth, "ls")
+        if ch == "'":
+            return ("body", depth, "cmt")
+        if ch == "@":
+            return ("body", depth, "@")
+        if ch == "}":
+            return ("body", depth - 1, "close") if depth > 0 else None
+        if _is_prefix(ch, _LINE_KEYWORDS):
+            return ("body", depth, "kw:" + ch)
+        return _statement_step(depth, _STATEMENT, ch)
+    # 注释与标题类关键字之后的文本：到行尾之前不做检查
+    if sub == "cmt":
+        if ch == "\n":
+            return ("body", depth, "ls")
+        return None if ch == "`" else ("body", depth, "cmt")
+    if sub == "close":
+        if ch == " ":
+            return ("body", depth, "close")
+        return ("body", depth, "ls") if ch == "\n" else None
+    if sub.startswith("@"):
+        if sub == "@enduml":
+            if ch == " ":
+                return ("body", depth, sub)
+            return ("after", 0) if ch == "\n" and depth == 0 else None
+        return ("body", depth, sub + ch) if "@enduml".startswith(sub + ch) else None
+    # sub == "kw:" + 已读到的行首关键字前缀
+    prefix = sub[3:]
+    if ch == " " and prefix in _LINE_KEYWORDS:
+        if prefix == _NOTE_KEYWORD:
+            return ("body", depth, ("st", "n", 0, 1))
+        return ("body", depth, "cmt")
+    if _is_prefix(prefix + ch, _LINE_KEYWORDS):
+        return ("body", depth, "kw:" + prefix + ch)
+    return _statement_step(depth, _STATEMENT, ch)
+
+
+_END_NOTE = ("end note", "endnote")
+
+
+def _note_step(depth, sub, ch):
+    if ch == "`":
+        return None
+    if sub == "txt":
+        return ("note", depth, "ls" if ch == "\n" else "txt")
+    if sub == "ls":
+        if ch in " \n":
+            return ("note", depth, "ls")
+        return ("note", depth, "end:e") if ch == "e" else ("note", depth, "txt")
+    # sub == "end:" + 已读到的 end note 前缀，完整匹配后以 $ 标记
+    prefix = sub[4:]
+    if prefix.endswith("$") or prefix in _END_NOTE:
+        if ch == "\n":
+            return ("body", depth, "ls")
+        if ch == " ":
+            return ("note", depth, "end:" + prefix.rstrip("$") + "$")
+        return ("note", depth, "txt")
+    if _is_prefix(prefix + ch, _END_NOTE):
+        return ("note", depth, "end:" + prefix + ch)
+    return ("note", depth, "ls" if ch == "\n" else "txt")
+
+
+def _after_step(k, ch):
+    if ch == "`":
+        return ("text", -1) if k == 2 else ("after", k + 1)
+    if k == 0 and ch in " \n":
+        return ("after", 0)
+    return None
+
+
+def step(state, ch):
+    """读入一个规范化后的字符，返回新状态；不合法时返回 None"""
+    kind = state[0]
+    if ch == _CONTROL_CHAR:
+        # 控制字符只允许出现在代码块之外
+        return state if is_free(state) else None
+    if kind in ("text", "code"):
+        return _text_step(kind, state[1], ch)
+    if kind == "lang":
+        return _lang_step(state[1], ch)
+    if kind == "start":
+        return _start_step(state[1], ch)
+    if kind == "body":
+        return _body_step(state[1], state[2], ch)
+    if kind == "note":
+        return _note_step(state[1], state[2], ch)
+    return _after_step(state[1], ch)
+
+
+def is_free(state) -> bool:
+    """代码块之外的状态不限制输出"""
+    return state[0] in ("text", "lang", "code")
+
+
+def check_diagram(code: str) -> bool:
+    """检查一段 @startuml ... @enduml 源码能否被自动机完整接受（引号、括号、块是否配对等）"""
+    state = ("start", "")
+    for ch in code.strip() + "\n":
+        state = step(state, _canonical(ch))
+        if state is None:
+            return False
+    return state[0] == "after"
+
+
+# ===== token 级 =====
+
+def _token_text(tokenizer, token_id: int) -> Optional[str]:
+    token = tokenizer.convert_ids_to_tokens(token_id)
+    if token is None:
+        return None
+    if isinstance(token, bytes):
+        return token.decode("utf-8", errors="replace")
+    byte_match = _BYTE_TOKEN_RE.match(token)
+    if byte_match:
+        value = int(byte_match.group(1), 16)
+        return chr(value) if value < 128 else "�"
+    if "▁" in token:
+        # sentencepiece 用 ▁ 表示空格，单独转换时开头的空格会被去掉
+        return token.replace("▁", " ")
+    return tokenizer.convert_tokens_to_string([token])
+
+
+class PlantUMLGrammar:
+    """把字符级自动机编译到 tokenizer 词表上，得到每个受限状态的 token 掩码
+
+    构造时只规范化词表；compile() 才计算掩码（可以放到后台线程中执行），
+    完成之前 compiled 为 False，调度器不会对请求启用约束。
+    """
+
+    initial_state = INITIAL_STATE
+
+    def __init__(self, tokenizer, device, special_token_ids: Iterable[int] = ()):
+        self.device = device
+        self.eos_token_ids = [i for i in special_token_ids if i is not None]
+        special = set(tokenizer.all_special_ids) | set(self.eos_token_ids)
+        special |= {i for i, t in getattr(tokenizer, "added_tokens_decoder", {}).items() if t.special}
+
+        # 规范化后的 token 文本；特殊 token 为 None，在代码块内不允许出现
+        self._texts: List[Optional[str]] = []
+        for token_id in range(len(tokenizer)):
+            text = None if token_id in special else _token_text(tokenizer, token_id)
+            self._texts.append("".join(_canonical(ch) for ch in text) if text else None)
+
+        self._transitions = {}
+        self._rows = {}
+        self._masks = None
+        self._lock = threading.Lock()
+
+    @property
+    def compiled(self) -> bool:
+        return self._masks is not None
+
+    def _step(self, state, ch):
+        key = (state, ch)
+        if key not in self._transitions:
+            self._transitions[key] = step(state, ch)
+        return self._transitions[key]
+
+    def advance(self, state, token_id: int):
+        """输出 token 后的新状态；返回 None 表示放弃约束"""
+        if state is None:
+            return None
+        text = self._texts[token_id] if token_id < len(self._texts) else None
+        if text is None:
+            return state if is_free(state) else None
+        for ch in text:
+            state = self._step(state, ch)
+            if state is None:
+                return None
+        return state
+
+    @torch.inference_mode()
+    def compile(self, chunk_size: int = 4096):
+        """枚举可达状态并一次性计算所有受限状态的掩码；重复调用直接返回"""
+        with self._lock:
+            if self._masks is not None:
+                return
+
+            # 词表中出现的全部规范化字符，可达状态只可能经由这些字符到达
+            alphabet = sorted({ch for text in self._texts if text for ch in text} | {"\n"})
+            char_index = {ch: i for i, ch in enumerate(alphabet)}
+            states, index = [INITIAL_STATE], {INITIAL_STATE: 0}
+            table = []
+            while len(table) < len(states):
+                state = states[len(table)]
+                row = []
+                for ch in alphabet:
+                    next_state = self._step(state, ch)
+                    if next_state is None:
+                        row.append(-1)
+                        continue
+                    if next_state not in index:
+                        index[next_state] = len(states)
+                        states.append(next_state)
+                    row.append(index[next_state])
+                table.append(row)
+
+            # 转移表多出一个死状态行和一个填充列（填充字符不改变状态）
+            dead, pad = len(states), len(alphabet)
+            transitions = torch.tensor(table, dtype=torch.long)
+            transitions[transitions < 0] = dead
+            transitions = torch.cat([transitions, torch.arange(len(states)).unsqueeze(1)], dim=1)
+            transitions = torch.cat([transitions, torch.full((1, pad + 1), dead, dtype=torch.long)])
+
+            constrained = [i for i, state in enumerate(states) if not is_free(state)]
+            masks = torch.zeros((len(constrained), len(self._texts)), dtype=torch.bool)
+            start = torch.tensor(constrained, dtype=torch.long)
+
+            # 按长度排序后分块，让每块的填充尽量少
+            token_ids = sorted((i for i, text in enumerate(self._texts) if text), key=lambda i: len(self._texts[i]))
+            for offset in range(0, len(token_ids), chunk_size):
+                chunk = token_ids[offset:offset + chunk_size]
+                width = len(self._texts[chunk[-1]])
+                chars = torch.full((len(chunk), width), pad, dtype=torch.long)
+                for row, token_id in enumerate(chunk):
+                    text = self._texts[token_id]
+                    chars[row, :len(text)] = torch.tensor([char_index[ch] for ch in text])
+                # current[t, s]：从第 s 个受限状态出发读入 token t 的前若干字符后的状态
+                current = start.expand(len(chunk), -1)
+                for position in range(width):
+                    current = transitions[current, chars[:, position:position + 1]]
+                masks[:, chunk] = (current != dead).T
+
+            # 没有任何 token 可选时（例如块嵌套已到上限）强制结束生成，而不是放弃约束
+            empty = ~masks.any(dim=1)
+            if empty.any() and self.eos_token_ids:
+                masks[empty.nonzero().squeeze(1).unsqueeze(1), torch.tensor(self.eos_token_ids)] = True
+
+            self._rows = {states[i]: row for row, i in enumerate(constrained)}
+            self._masks = masks.to(self.device)
+            print(f"PlantUML 语法约束编译完成: {len(states)} 个状态，{len(constrained)} 个受限状态")
+
+    def mask(self, state, vocab_size: int):
+        """state 下允许的 token 掩码 [vocab_size]；代码块之外返回 None（不限制）"""
+        if is_free(state):
+            return None
+        masks = self._masks
+        if masks.shape[1] < vocab_size:
+            # 模型的输出维度可能大于词表，多出的位置不允许
+            masks = torch.nn.functional.pad(masks, (0, vocab_size - masks.shape[1]))
+            self._masks = masks
+        return masks[self._rows[state], :vocab_size]
@@ -0,0 +1,172 @@
+"""按 config 中的设置加载模型：选择设备与精度，并可选地做仅权重量化
+
+量化后的权重以 state_dict 形式缓存到磁盘，之后启动时先在 meta 设备上搭出
+模型骨架，再用 mmap 方式载入缓存，跳过加载全精度权重和重新量化的过程。
+"""
+import hashlib
+import os
+import tempfile
+
+import torch
+from torch import nn
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+
+import config
+
+_DTYPES = {"bfloat16": torch.bfloat16, "float16": torch.float16, "float32": torch.float32}
+# 输出层保持原精度，避免量化误差直接作用在 logits 上
+_SKIP_QUANTIZE = ("lm_head", "output_layer")
+
+
+def select_device() -> str:
+    if config.DEVICE == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return config.DEVICE
+
+
+def _select_dtype(device: str, quantize: str):
+    if quantize == "int8":
+        # 动态量化在 float32 激活上计算
+        return torch.float32
+    if quantize == "int4":
+        return torch.bfloat16
+    if config.DTYPE == "auto":
+        return torch.bfloat16 if device == "cuda" else torch.float32
+    return _DTYPES[config.DTYPE]
+
+
+def _quantizable(name: str) -> bool:
+    return not name.endswith(_SKIP_QUANTIZE)
+
+
+def _use_safetensors(model_path: str):
+    """目录中有 safetensors 权重时强制使用它：按 mmap 方式读取，不经过 pickle 反序列化"""
+    if any(name.endswith(".safetensors") for name in os.listdir(model_path)):
+        return True
+    return None
+
+
+def _cache_path(model_path: str, quantize: str, device: str) -> str:
+    """缓存文件名包含模型路径、权重文件修改时间与量化参数的哈希"""
+    hasher = hashlib.sha1()
+    for part in (os.path.abspath(model_path), quantize, device, str(config.INT4_GROUP_SIZE), torch.__version__):
+        hasher.update(part.encode("utf-8"))
+    for name in sorted(os.listdir(model_path)):
+        if name.endswith((".safetensors", ".bin")):
+            mtime = os.path.getmtime(os.path.join(model_path, name))
+            hasher.update(f"{name}:{mtime}".encode("utf-8"))
+    base = os.path.basename(os.path.normpath(model_path))
+    return os.path.join(config.QUANT_CACHE_DIR, f"{base}-{quantize}-{hasher.hexdigest()[:12]}.pt")
+
+
+def _quantize_int8(model):
+    names = {name for name, m in model.named_modules() if isinstance(m, nn.Linear) and _quantizable(name)}
+    return torch.ao.quantization.quantize_dynamic(model, names, dtype=torch.qint8, inplace=True)
+
+
+def _int8_skeleton(model):
+    """把骨架中的 Linear 换成动态量化 Linear，使其能直接载入缓存的 state_dict"""
+    for name, module in list(model.named_modules()):
+        if isinstance(module, nn.Linear) and _quantizable(name):
+            parent_name, _, child = name.rpartition(".")
+            parent = model.get_submodule(parent_name) if parent_name else model
+            setattr(parent, child, torch.ao.nn.quantized.dynamic.Linear(
+                module.in_features, module.out_features,
+                bias_=module.bias is not None, dtype=torch.qint8
+            ))
+
+
+def _quantize_int4(model, device: str):
+    try:
+        from torchao.quantization import quantize_, int4_weight_only
+        from torchao.dtypes import Int4CPULayout
+    except ImportError as e:
+        raise RuntimeError("int4 量化需要安装 torchao") from e
+    kwargs = {"group_size": config.INT4_GROUP_SIZE}
+    if device == "cpu":
+        kwargs["layout"] = Int4CPULayout()
+    quantize_(
+        model, int4_weight_only(**kwargs),
+        filter_fn=lambda m, fqn: isinstance(m, nn.Linear) and _quantizable(fqn)
+    )
+    return model
+
+
+def _save_atomic(state_dict, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            torch.save(state_dict, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"保存量化缓存失败: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _load_quantized(model_path: str, device: str, dtype, quantize: str):
+    path = _cache_path(model_path, quantize, device)
+    if os.path.exists(path):
+        from accelerate import init_empty_weights
+
+        print(f"加载量化缓存: {path}")
+        model_config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+        with init_empty_weights():
+            model = AutoModelForCausalLM.from_config(model_config, torch_dtype=dtype, trust_remote_code=True)
+        if quantize == "int8":
+            _int8_skeleton(model)
+        state_dict = torch.load(path, mmap=True, weights_only=False)
+        model.load_state_dict(state_dict, assign=True)
+        try:
+            model.generation_config = GenerationConfig.from_pretrained(model_path)
+        except OSError:
+            pass
+        return model
+
+    print(f"量化模型（{quantize}），首次启动需要较长时间...")
+    model = AutoModelForCausalLM.from_pretrained(
+        model_path,
+        torch_dtype=dtype,
+        low_cpu_mem_usage=True,
+        use_safetensors=_use_safetensors(model_path),
+        trust_remote_code=True
+    )
+    if quantize == "int8":
+        model = _quantize_int8(model)
+    elif quantize == "int4":
+        model = _quantize_int4(model.to(device), device)
+    else:
+        raise ValueError(f"未知的量化方式: {quantize}")
+    _save_atomic(model.state_dict(), path)
+    return model
+
+
+def load_model(model_path: str):
+    """返回 (tokenizer, model, device)"""
+    device = select_device()
+    quantize = config.QUANTIZE
+    if quantize == "int8" and device != "cpu":
+        # 动态量化的算子只有 CPU 实现，模型与输入都必须留在 CPU 上
+        if config.DEVICE != "auto":
+            raise ValueError(f"int8 动态量化只支持 CPU 推理，请设置 AUG_DEVICE=cpu（当前为 {config.DEVICE}）")
+        print("int8 动态量化只支持 CPU 推理，改用 CPU")
+        device = "cpu"
+    if device == "cpu" and config.CPU_THREADS > 0:
+        torch.set_num_threads(config.CPU_THREADS)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    dtype = _select_dtype(device, quantize)
+    if quantize == "none":
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=dtype,
+            low_cpu_mem_usage=True,
+            use_safetensors=_use_safetensors(model_path),
+            trust_remote_code=True,
+            device_map="auto" if device == "cuda" else None  # GPU 上使用 accelerate 进行设备自动分配
+        )
+    else:
+        model = _load_quantized(model_path, device, dtype, quantize)
+    print(f"模型已加载: device={device}, dtype={dtype}, quantize={quantize}")
+    return tokenizer, model.eval(), device
@@ -0,0 +1,136 @@
+"""按 token 前缀复用 KV cache
+
+多轮对话每次都会重发完整历史，前面的 token 与上一轮完全相同。
+这里把每个请求结束时的 KV cache 存下来，并在每个块边界上登记前缀哈希；
+新请求只需找到最长的已缓存前缀，再 prefill 剩下的部分。
+固定的系统提示词在启动时预先计算并常驻（pinned），不参与 LRU 淘汰。
+"""
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_SEQ_DIM = 2
+
+
+class _Entry:
+    __slots__ = ("past", "length", "nbytes", "keys", "pinned")
+
+    def __init__(self, past, length, nbytes, keys, pinned=False):
+        self.past = past
+        self.length = length
+        self.nbytes = nbytes
+        self.keys = keys
+        self.pinned = pinned
+
+
+def _prefix_hashes(tokens: List[int], lengths: Iterable[int]) -> Dict[int, bytes]:
+    """一次遍历计算 tokens 在各个长度处的前缀哈希"""
+    data = array("I", tokens).tobytes()
+    hasher = hashlib.blake2b(digest_size=16)
+    hashes = {}
+    offset = 0
+    for length in sorted(set(lengths)):
+        hasher.update(data[offset * 4:length * 4])
+        offset = length
+        hashes[length] = hasher.copy().digest()
+    return hashes
+
+
+def _past_nbytes(past) -> int:
+    return sum(t.numel() * t.element_size() for layer in past for t in layer)
+
+
+def _narrow_past(past, length):
+    return tuple(tuple(t.narrow(_SEQ_DIM, 0, length) for t in layer) for layer in past)
+
+
+class PrefixCache:
+    """以前缀哈希为键、按占用字节数做 LRU 淘汰的 KV cache 存储"""
+
+    def __init__(self, max_bytes: int, block_size: int = 32):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.nbytes = 0
+        self.pinned_nbytes = 0
+        self._pinned_lengths = set()
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._index: Dict[bytes, Tuple[int, int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _boundaries(self, length: int) -> List[int]:
+        return list(range(self.block_size, length + 1, self.block_size))
+
+    def lookup(self, tokens: List[int]) -> Tuple[int, Optional[tuple]]:
+        """返回 (命中长度, KV cache)；至少留下一个 token 给 prefill 计算 logits"""
+        limit = len(tokens) - 1
+        candidates = self._boundaries(limit)
+        candidates += [n for n in self._pinned_lengths if n <= limit]
+        candidates = sorted(set(candidates))
+        if not candidates:
+            return 0, None
+        hashes = _prefix_hashes(tokens, candidates)
+        with self._lock:
+            for length in reversed(candidates):
+                hit = self._index.get(hashes[length])
+                if hit is None:
+                    continue
+                entry_id, _ = hit
+                entry = self._entries[entry_id]
+                self._entries.move_to_end(entry_id)
+                return length, _narrow_past(entry.past, length)
+        return 0, None
+
+    def store(self, tokens: List[int], past, pinned: bool = False):
+        """保存一条序列的 KV cache（batch 维为 1，长度与 tokens 一致）
+
+        pinned 条目按完整长度登记，常驻内存，不计入 max_bytes。
+        """
+        boundaries = self._boundaries(len(tokens))
+        if pinned and len(tokens) not in boundaries:
+            boundaries.append(len(tokens))
+        if not boundaries:
+            return
+        hashes = _prefix_hashes(tokens, boundaries)
+        length = boundaries[-1]
+        with self._lock:
+            # 已有条目覆盖了同样的前缀，只刷新 LRU 顺序
+            hit = self._index.get(hashes[length])
+            if hit is not None and (not pinned or self._entries[hit[0]].pinned):
+                self._entries.move_to_end(hit[0])
+                return
+
+        # 拷贝出独立的张量，避免切片视图让整个批次的 cache 无法释放
+        past = tuple(tuple(t.narrow(_SEQ_DIM, 0, length).clone() for t in layer) for layer in past)
+        nbytes = _past_nbytes(past)
+        if not pinned and nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            keys = [hashes[b] for b in boundaries]
+            self._entries[entry_id] = _Entry(past, length, nbytes, keys, pinned)
+            if pinned:
+                self.pinned_nbytes += nbytes
+                self._pinned_lengths.add(length)
+            else:
+                self.nbytes += nbytes
+            for b, key in zip(boundaries, keys):
+                # 常驻条目的索引不被覆盖，避免其前缀随普通条目一起被淘汰
+                current = self._index.get(key)
+                if current is not None and self._entries[current[0]].pinned:
+                    continue
+                self._index[key] = (entry_id, b)
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            entry_id = next(i for i, e in self._entries.items() if not e.pinned)
+            entry = self._entries.pop(entry_id)
+            self.nbytes -= entry.nbytes
+            for key in entry.keys:
+                if self._index.get(key, (None,))[0] == entry_id:
+                    del self._index[key]
@@ -0,0 +1,38 @@
+"""所有会话共用的固定系统提示词
+
+服务启动时会为这里的提示词预先计算 KV cache，新请求直接复用，
+不必再为相同的开头部分做 prefill。
+"""
+from typing import List
+
+# web_demo/demo.py 中 main() 发送的澄清式对话提示词
+DEMO_SYSTEM_PROMPT = (
+    "Use clarifying dialogues, such as:User: Generate a Class Diagram.  "
+    "Output: Please tell me more detailed information, such as attributes, methods, and so on. "
+    "You are AUG, an automated requirements modeling tool. Your task is to assist users with "
+    "requirements modeling. (Please use standard PlantUML language for drawing)."
+)
+
+# glm.py 为每个请求添加的系统消息
+GLM_SYSTEM_PROMPT = "你是AUG需求助手，你的任务是协助开发者进行需求建模。"
+
+SYSTEM_PROMPTS = [DEMO_SYSTEM_PROMPT, GLM_SYSTEM_PROMPT]
+
+
+def system_prompt_tokens(tokenizer, prompt: str) -> List[int]:
+    """返回系统提示词在对话模板中的 token 前缀
+
+    取"仅系统消息"与"系统消息加一条用户消息"两种渲染结果的公共前缀，
+    保证得到的 token 一定是真实请求的前缀。
+    """
+    system = [{"role": "system", "content": prompt}]
+    only_system = tokenizer.apply_chat_template(system, tokenize=True)
+    with_user = tokenizer.apply_chat_template(
+        system + [{"role": "user", "content": ""}], tokenize=True
+    )
+    length = 0
+    for a, b in zip(only_system, with_user):
+        if a != b:
+            break
+        length += 1
+    return list(only_system[:length])
@@ -0,0 +1,291 @@
+"""多副本路由：启动 N 个模型进程，并把请求转发给负载最低的副本
+
+每个副本是一个独立的 uvicorn 进程（默认运行 api:app），可以每块 GPU 一个，
+也可以在 CPU 上按核心划分多个。路由进程定期读取各副本的 /stats，
+按排队深度与在途 token 数选择副本；同一会话尽量留在上一次处理它的副本上，
+以便命中该副本前缀缓存中的多轮对话 KV cache。
+
+用法：AUG_ROUTER_DEVICES=0,1 python router.py（两块 GPU 各一个副本）
+      AUG_ROUTER_DEVICES=cpu,cpu,cpu,cpu python router.py（四个 CPU 副本）
+"""
+import asyncio
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 每个副本使用的设备：GPU 编号或 cpu，逗号分隔
+ROUTER_DEVICES = [d.strip() for d in os.environ.get("AUG_ROUTER_DEVICES", "0").split(",") if d.strip()]
+
+# 副本运行的应用与监听端口（依次递增）
+ROUTER_WORKER_APP = os.environ.get("AUG_ROUTER_WORKER_APP", "api:app")
+ROUTER_BASE_PORT = int(os.environ.get("AUG_ROUTER_BASE_PORT", "7100"))
+
+# 轮询各副本 /stats 的间隔（秒）
+ROUTER_POLL_INTERVAL = float(os.environ.get("AUG_ROUTER_POLL_INTERVAL", "0.5"))
+
+# 会话粘滞：记录的会话数上限；粘滞副本比最空闲副本多出的在途请求超过该值时改派
+ROUTER_STICKY_SIZE = int(os.environ.get("AUG_ROUTER_STICKY_SIZE", "10000"))
+ROUTER_STICKY_SLACK = int(os.environ.get("AUG_ROUTER_STICKY_SLACK", "4"))
+
+_SERVE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Worker:
+    """一个模型副本进程及路由侧记录的负载"""
+
+    def __init__(self, index: int, device: str, port: int, cores: Optional[List[int]] = None):
+        self.index = index
+        self.device = device
+        self.port = port
+        self.cores = cores
+        self.url = f"http://127.0.0.1:{port}"
+        self.process: Optional[subprocess.Popen] = None
+        self.ready = False
+        self.stats: Dict = {}
+        # 经由路由转发、尚未结束的请求数（比轮询到的 stats 更及时）
+        self.active = 0
+
+    def _env(self):
+        env = dict(os.environ)
+        if self.device == "cpu":
+            env["AUG_DEVICE"] = "cpu"
+            env["CUDA_VISIBLE_DEVICES"] = ""
+            if self.cores:
+                env["AUG_CPU_THREADS"] = str(len(self.cores))
+        else:
+            env["AUG_DEVICE"] = "cuda"
+            env["CUDA_VISIBLE_DEVICES"] = self.device
+        return env
+
+    def spawn(self):
+        cores = self.cores
+
+        def pin_cores():
+            # 每个 CPU 副本绑定到互不重叠的核心上，避免线程互相抢占
+            if cores and hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, cores)
+
+        self.ready = False
+        self.stats = {}
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", ROUTER_WORKER_APP, "--host", "127.0.0.1", "--port", str(self.port)],
+            cwd=_SERVE_DIR,
+            env=self._env(),
+            preexec_fn=pin_cores if cores else None
+        )
+        print(f"启动副本 {self.index}: device={self.device}, port={self.port}, pid={self.process.pid}")
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def load(self):
+        """排队深度优先，其次比较在途 token 数"""
+        return self.active, self.stats.get("inflight_tokens", 0)
+
+    def describe(self) -> dict:
+        return {
+            "index": self.index,
+            "device": self.device,
+            "url": self.url,
+            "ready": self.ready,
+            "active": self.active,
+            "stats": self.stats,
+        }
+
+
+def _cpu_partitions(count: int) -> List[List[int]]:
+    """把当前进程可用的核心平均分给 count 个 CPU 副本"""
+    if count == 0:
+        return []
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    size = max(1, len(cores) // count)
+    return [cores[i * size:(i + 1) * size] or cores for i in range(count)]
+
+
+def _create_workers() -> List[Worker]:
+    partitions = iter(_cpu_partitions(sum(1 for d in ROUTER_DEVICES if d == "cpu")))
+    workers = []
+    for i, device in enumerate(ROUTER_DEVICES):
+        cores = next(partitions) if device == "cpu" else None
+        workers.append(Worker(i, device, ROUTER_BASE_PORT + i, cores))
+    return workers
+
+
+def conversation_key(request: Request, body: dict) -> Optional[str]:
+    """会话标识：优先使用 X-Conversation-Id 请求头，否则取对话开头两条消息的哈希
+
+    多轮对话中开头的消息保持不变，同一会话的后续请求会得到相同的键。
+    """
+    header = request.headers.get("x-conversation-id")
+    if header:
+        return header
+    messages = body.get("messages") or body.get("history")
+    if not isinstance(messages, list) or not messages:
+        return None
+    head = json.dumps(messages[:2], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(head.encode("utf-8")).hexdigest()
+
+
+class Router:
+    def __init__(self, workers: List[Worker]):
+        self.workers = workers
+        self._sticky: "OrderedDict[str, Worker]" = OrderedDict()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._poll_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=10.0))
+        for worker in self.workers:
+            worker.spawn()
+        self._poll_task = asyncio.create_task(self._poll_loop())
+
+    async def stop(self):
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+        for worker in self.workers:
+            if worker.alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                try:
+                    worker.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    worker.process.kill()
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.gather(*(self._poll(worker) for worker in self.workers))
+            await asyncio.sleep(ROUTER_POLL_INTERVAL)
+
+    async def _poll(self, worker: Worker):
+        if not worker.alive():
+            # 副本进程退出后重新拉起，期间不再向它派发请求
+            print(f"副本 {worker.index} 已退出（code={worker.process.returncode}），重新启动")
+            worker.spawn()
+            return
+        try:
+            response = await self._client.get(f"{worker.url}/stats", timeout=2.0)
+            worker.stats = response.json()
+            worker.ready = worker.stats.get("state") == "ready"
+        except (httpx.HTTPError, ValueError):
+            # 进程刚启动、尚未开始监听
+            worker.ready = False
+
+    def choose(self, key: Optional[str]) -> Worker:
+        ready = [w for w in self.workers if w.ready]
+        if not ready:
+            raise HTTPException(status_code=503, detail="没有可用的模型副本", headers={"Retry-After": "5"})
+        least = min(ready, key=Worker.load)
+        if key is None:
+            return least
+        worker = self._sticky.get(key)
+        if worker is None or not worker.ready or worker.active - least.active > ROUTER_STICKY_SLACK:
+            worker = least
+        self._sticky[key] = worker
+        self._sticky.move_to_end(key)
+        while len(self._sticky) > ROUTER_STICKY_SIZE:
+            self._sticky.popitem(last=False)
+        return worker
+
+    async def forward(self, request: Request):
+        raw = await request.body()
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="请求体不是合法的 JSON")
+        worker = self.choose(conversation_key(request, body if isinstance(body, dict) else {}))
+
+        tried = set()
+        while True:
+            worker.active += 1
+            try:
+                upstream = await self._client.send(
+                    self._client.build_request(
+                        "POST", f"{worker.url}/", content=raw,
+                        headers={"content-type": "application/json"}
+                    ),
+                    stream=True
+                )
+            except httpx.HTTPError as e:
+                worker.active -= 1
+                worker.ready = False
+                raise HTTPException(status_code=502, detail=f"副本 {worker.index} 不可用: {str(e)}")
+            # 副本的等待队列已满时改派到其他就绪副本，全部满时把 429 返回给客户端
+            tried.add(worker)
+            others = [w for w in self.workers if w.ready and w not in tried]
+            if upstream.status_code != 429 or not others:
+                break
+            await upstream.aclose()
+            worker.active -= 1
+            worker = min(others, key=Worker.load)
+
+        async def relay():
+            try:
+                async for chunk in upstream.aiter_raw():
+                    yield chunk
+            finally:
+                worker.active -= 1
+                await upstream.aclose()
+
+        headers = {
+            name: value for name, value in upstream.headers.items()
+            if name.lower() in ("content-type", "cache-control", "x-accel-buffering", "retry-after")
+        }
+        return StreamingResponse(relay(), status_code=upstream.status_code, headers=headers)
+
+
+router = Router(_create_workers())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await router.start()
+    yield
+    await router.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "workers": sum(1 for w in router.workers if w.alive())}
+
+
+@app.get("/readyz")
+async def readyz():
+    """至少有一个副本就绪即可接收请求"""
+    ready = sum(1 for w in router.workers if w.ready)
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready_workers": ready, "workers": len(router.workers)}
+    )
+
+
+@app.get("/stats")
+async def stats():
+    return {"workers": [w.describe() for w in router.workers]}
+
+
+@app.post("/")
+async def generate_response(request: Request):
+    return await router.forward(request)
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=6006)
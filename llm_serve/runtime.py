@@ -0,0 +1,106 @@
+"""服务运行时：在后台线程中加载模型，使进程启动后立即可以响应健康检查
+
+加载 tokenizer、读取权重、预计算系统提示词 KV cache 都在 FastAPI lifespan
+启动的后台线程中完成；加载期间 /healthz 返回 200（进程存活），
+/readyz 返回 503，负载均衡据此在滚动重启时把流量留给其他节点。
+"""
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+from fastapi import HTTPException
+
+import config
+from engine import BatchScheduler, GenerationRequest
+
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+
+
+class _WarmupStreamer:
+    """丢弃输出，只记录生成是否结束"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+    def put(self, value):
+        pass
+
+    def end(self):
+        self.done.set()
+
+
+class ModelRuntime:
+    """持有 tokenizer 与调度器，并记录加载状态
+
+    build 在后台线程中执行，返回 (tokenizer, scheduler)，调度器需已启动。
+    """
+
+    def __init__(self, build: Callable[[], Tuple[object, BatchScheduler]]):
+        self._build = build
+        self.state = LOADING
+        self.error: Optional[str] = None
+        self.tokenizer = None
+        self.scheduler: Optional[BatchScheduler] = None
+        self.load_seconds: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._load, name="model-loader", daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        started = time.perf_counter()
+        try:
+            tokenizer, scheduler = self._build()
+            if config.WARMUP_TOKENS > 0:
+                _warmup(tokenizer, scheduler, config.WARMUP_TOKENS)
+        except Exception as e:
+            print(f"模型加载失败: {str(e)}")
+            self.error = str(e)
+            self.state = FAILED
+            return
+        self.tokenizer = tokenizer
+        self.scheduler = scheduler
+        self.load_seconds = time.perf_counter() - started
+        self.state = READY
+        print(f"模型就绪，用时 {self.load_seconds:.1f}s")
+
+    @property
+    def ready(self) -> bool:
+        return self.state == READY
+
+    def require(self):
+        """请求处理前调用：模型未就绪时返回 503"""
+        if self.state == READY:
+            return
+        detail = "模型加载中，请稍后重试" if self.state == LOADING else f"模型加载失败: {self.error}"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
+
+    def health(self) -> dict:
+        return {"status": "ok", "state": self.state}
+
+    def readiness(self) -> Tuple[int, dict]:
+        body = {"state": self.state}
+        if self.error:
+            body["error"] = self.error
+        if self.load_seconds is not None:
+            body["load_seconds"] = round(self.load_seconds, 1)
+        return (200 if self.state == READY else 503), body
+
+
+def _warmup(tokenizer, scheduler: BatchScheduler, max_new_tokens: int):
+    """跑一次很短的生成，提前完成 CUDA kernel 选择与 torch.compile 编译"""
+    input_ids = tokenizer.apply_chat_template(
+        [{"role": "user", "content": "@startuml"}],
+        add_generation_prompt=True,
+        tokenize=True
+    )
+    streamer = _WarmupStreamer()
+    request = GenerationRequest(list(input_ids), streamer, max_new_tokens=max_new_tokens)
+    scheduler.submit(request)
+    streamer.done.wait()
+    if request.error:
+        raise RuntimeError(f"预热生成失败: {request.error}")
@@ -0,0 +1,124 @@
+"""单个请求的采样参数与停止条件
+
+默认参数（temperature=0）即贪心解码，与调度器原先的行为一致；
+temperature > 0 时在该行上按 top_k / top_p 截断后采样，指定 seed 时结果可复现。
+停止条件在每个 token 输出后检查，命中时已输出的文本包含停止串本身。
+"""
+from typing import List, Optional, Sequence
+
+import torch
+
+_FENCE = "```"
+_FENCE_LANGUAGES = ("plantuml", "uml")
+# 一行超过这么多 token 仍未换行时不再整行解码，只保留末尾用于匹配停止串
+_MAX_LINE_TOKENS = 256
+
+
+class SamplingParams:
+    __slots__ = ("temperature", "top_p", "top_k", "seed", "stop", "stop_after_diagram")
+
+    def __init__(self, temperature: float = 0.0, top_p: float = 1.0, top_k: int = 0, seed: Optional[int] = None,
+                 stop: Sequence[str] = (), stop_after_diagram: bool = False):
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.seed = seed
+        self.stop = [s for s in stop if s]
+        # 第一个完整的 ```plantuml ... @enduml``` 代码块结束后停止
+        self.stop_after_diagram = stop_after_diagram
+
+    @property
+    def greedy(self) -> bool:
+        return self.temperature <= 0
+
+    @property
+    def has_stop(self) -> bool:
+        return bool(self.stop) or self.stop_after_diagram
+
+
+def sample(logits, params: SamplingParams, generator=None) -> int:
+    """从单行 logits（[vocab]）中按 temperature / top_k / top_p 采样一个 token"""
+    logits = logits.float() / params.temperature
+    if 0 < params.top_k < logits.shape[-1]:
+        kth = torch.topk(logits, params.top_k).values[-1]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    if params.top_p < 1.0:
+        sorted_logits, order = torch.sort(logits, descending=True)
+        probs = torch.softmax(sorted_logits, dim=-1)
+        # 去掉累计概率已超过 top_p 之后的 token，概率最高的 token 总会保留
+        remove = probs.cumsum(dim=-1) - probs > params.top_p
+        sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+        logits = torch.full_like(logits, float("-inf")).scatter(0, order, sorted_logits)
+    probs = torch.softmax(logits, dim=-1)
+    return torch.multinomial(probs, 1, generator=generator).item()
+
+
+class StopMatcher:
+    """逐 token 检查停止串和"第一个图表结束"条件
+
+    按行增量解码：只解码当前行的 token，遇到换行后把该行交给图表状态机，
+    之前的文本只保留末尾若干字符用于跨行匹配停止串。
+    """
+
+    def __init__(self, tokenizer, stop: List[str], stop_after_diagram: bool):
+        self.tokenizer = tokenizer
+        self.stop = stop
+        self.stop_after_diagram = stop_after_diagram
+        self._window = max((len(s) for s in stop), default=0)
+        self._tail = ""
+        self._tokens: List[int] = []
+        # 当前 token 缓冲中已处理过的完整行数
+        self._lines_done = 0
+        # 当前行开头已被截断（超长行），不再作为代码块边界识别
+        self._truncated = False
+        # text / diagram（```plantuml 之后）/ ended（@enduml 之后，等待关闭代码块）
+        self._diagram = "text"
+        self._fenced = False
+
+    def update(self, token: int) -> bool:
+        """输出一个 token 后调用，返回是否应停止生成"""
+        self._tokens.append(token)
+        text = self.tokenizer.decode(self._tokens, skip_special_tokens=True)
+        if text.endswith("\ufffd"):
+            # 多字节字符尚未完整
+            return False
+        if self.stop and any(s in self._tail + text for s in self.stop):
+            return True
+
+        lines = text.split("\n")
+        if self.stop_after_diagram:
+            for line in lines[self._lines_done:-1]:
+                if self._on_line(line, complete=True):
+                    return True
+                self._truncated = False
+            if self._on_line(lines[-1], complete=False):
+                return True
+        self._lines_done = len(lines) - 1
+
+        if lines[-1] == "" or len(self._tokens) > _MAX_LINE_TOKENS:
+            if lines[-1]:
+                self._truncated = True
+            self._tail = (self._tail + text)[-self._window:] if self._window else ""
+            self._tokens = []
+            self._lines_done = 0
+        return False
+
+    def _on_line(self, line: str, complete: bool) -> bool:
+        if self._truncated:
+            return False
+        stripped = line.strip()
+        if self._diagram == "text":
+            if complete and stripped.startswith(_FENCE) and stripped[len(_FENCE):].strip() in _FENCE_LANGUAGES:
+                self._diagram, self._fenced = "diagram", True
+            elif complete and stripped.lower().startswith("@startuml"):
+                self._diagram, self._fenced = "diagram", False
+            return False
+        if self._diagram == "diagram":
+            if stripped.lower() == "@enduml":
+                if not self._fenced:
+                    return True
+                if complete:
+                    self._diagram = "ended"
+            return False
+        # @enduml 之后遇到关闭代码块的 ``` 即停止，不必等到换行
+        return stripped == _FENCE
@@ -0,0 +1,56 @@
+"""基于提示词查找（prompt lookup）的投机解码草稿
+
+PlantUML 输出高度模式化，且大量复用对话中已出现的类名、属性和箭头写法。
+这里在每个请求已有的 token（提示词 + 已生成内容）中查找与当前结尾相同的
+n-gram，把它上一次出现之后的若干 token 作为草稿，由模型在一次前向中统一验证。
+"""
+from typing import List
+
+
+class _NgramIndex:
+    """单个请求的 n-gram 索引：n-gram -> 其最近一次出现之后的位置"""
+    __slots__ = ("tokens", "index", "max_ngram")
+
+    def __init__(self, max_ngram: int):
+        self.tokens: List[int] = []
+        self.index = {}
+        self.max_ngram = max_ngram
+
+    def extend(self, input_ids: List[int], generated: List[int]):
+        """把尚未登记的 token 追加进索引"""
+        prompt_length = len(input_ids)
+        for i in range(len(self.tokens), prompt_length + len(generated)):
+            self._append(input_ids[i] if i < prompt_length else generated[i - prompt_length])
+
+    def _append(self, token: int):
+        # 以当前末尾结束的 n-gram 即将拥有后继 token，此时才登记
+        length = len(self.tokens)
+        for n in range(1, min(self.max_ngram, length) + 1):
+            self.index[tuple(self.tokens[length - n:])] = length
+        self.tokens.append(token)
+
+    def lookup(self, num_tokens: int) -> List[int]:
+        """优先匹配更长的 n-gram，返回其后继的最多 num_tokens 个 token"""
+        for n in range(min(self.max_ngram, len(self.tokens)), 0, -1):
+            start = self.index.get(tuple(self.tokens[-n:]))
+            if start is not None:
+                return self.tokens[start:start + num_tokens]
+        return []
+
+
+class PromptLookupDraft:
+    """从请求自身的上下文中生成草稿 token"""
+
+    def __init__(self, num_tokens: int = 8, max_ngram: int = 3):
+        self.num_tokens = num_tokens
+        self.max_ngram = max_ngram
+
+    def propose(self, request, limit: int) -> List[int]:
+        """为请求给出至多 limit 个草稿 token（可能为空）"""
+        limit = min(limit, self.num_tokens)
+        if limit <= 0:
+            return []
+        if request.draft_state is None:
+            request.draft_state = _NgramIndex(self.max_ngram)
+        request.draft_state.extend(request.input_ids, request.generated)
+        return request.draft_state.lookup(limit)
@@ -0,0 +1,263 @@
+"""PlantUML 渲染池：启动多个本地 picoweb 进程，并把渲染请求转发给最空闲的实例
+
+单个 picoweb 实例基本只能用满一个核心，高峰期会成为瓶颈。渲染池对外监听原来的
+8888 端口，接口与 picoweb 相同（/png/...、/svg/...、/txt/...），web_demo 无需修改配置。
+每个请求转发给在途请求最少的实例；定期用一张极小的图表检查各实例，
+进程退出或连续多次检查超时（JVM 卡住）时重新启动。
+
+用法：AUG_PUML_POOL_SIZE=4 python pool.py
+"""
+import asyncio
+import os
+import shlex
+import subprocess
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+
+_SERVE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 实例数量，默认每个核心一个
+PUML_POOL_SIZE = int(os.environ.get("AUG_PUML_POOL_SIZE", str(os.cpu_count() or 1)))
+PUML_POOL_PORT = int(os.environ.get("AUG_PUML_POOL_PORT", "8888"))
+# 各实例监听的端口（依次递增，只绑定 127.0.0.1）
+PUML_BASE_PORT = int(os.environ.get("AUG_PUML_BASE_PORT", "8900"))
+PUML_JAR = os.environ.get("AUG_PUML_JAR", os.path.join(_SERVE_DIR, "plantuml.jar"))
+PUML_JAVA = os.environ.get("AUG_PUML_JAVA", "java")
+PUML_JAVA_OPTS = shlex.split(os.environ.get("AUG_PUML_JAVA_OPTS", ""))
+
+# 单次渲染超时（秒）
+PUML_RENDER_TIMEOUT = float(os.environ.get("AUG_PUML_RENDER_TIMEOUT", "30"))
+# 健康检查的间隔与超时（秒），连续失败多少次后重启实例
+PUML_HEALTH_INTERVAL = float(os.environ.get("AUG_PUML_HEALTH_INTERVAL", "5"))
+PUML_HEALTH_TIMEOUT = float(os.environ.get("AUG_PUML_HEALTH_TIMEOUT", "5"))
+PUML_HEALTH_FAILURES = int(os.environ.get("AUG_PUML_HEALTH_FAILURES", "3"))
+# JVM 启动需要时间，启动后这么久内检查失败不计入重启条件
+PUML_START_TIMEOUT = float(os.environ.get("AUG_PUML_START_TIMEOUT", "60"))
+
+# 健康检查用的图表（"Bob -> Alice : hello" 的编码），txt 格式渲染最快
+HEALTH_PROBE_PATH = "/txt/SyfFKj2rKt3CoKnELR1Io4ZDoSa70000"
+# 延迟滑动平均的权重
+LATENCY_EWMA_ALPHA = 0.2
+
+
+class Instance:
+    """一个 picoweb 进程及渲染池侧记录的负载与延迟"""
+
+    def __init__(self, index: int, port: int):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.process: Optional[subprocess.Popen] = None
+        self.started = 0.0
+        self.ready = False
+        # 启动后是否至少通过过一次健康检查
+        self.healthy_once = False
+        self.health_failures = 0
+        # 正在该实例上渲染的请求数
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.restarts = 0
+        self.latency = 0.0
+        self.last_latency = 0.0
+
+    def spawn(self):
+        self.ready = False
+        self.healthy_once = False
+        self.health_failures = 0
+        self.started = time.monotonic()
+        self.process = subprocess.Popen(
+            [
+                PUML_JAVA, *PUML_JAVA_OPTS, "-Djava.awt.headless=true",
+                "-jar", PUML_JAR, f"-picoweb:{self.port}:127.0.0.1"
+            ],
+            cwd=_SERVE_DIR,
+            stdout=subprocess.DEVNULL
+        )
+        print(f"启动 PlantUML 实例 {self.index}: port={self.port}, pid={self.process.pid}")
+
+    def kill(self):
+        """结束进程并等待退出（阻塞），在事件循环中应通过 asyncio.to_thread 调用"""
+        if self.alive():
+            self.process.kill()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                pass
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def load(self):
+        """在途请求数优先，其次比较平均延迟"""
+        return self.outstanding, self.latency
+
+    def record_latency(self, seconds: float):
+        self.last_latency = seconds
+        if self.latency == 0.0:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_EWMA_ALPHA * (seconds - self.latency)
+
+    def describe(self) -> dict:
+        return {
+            "index": self.index,
+            "url": self.url,
+            "pid": self.process.pid if self.process is not None else None,
+            "ready": self.ready,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "restarts": self.restarts,
+            "latency_ms": round(self.latency * 1000, 1),
+            "last_latency_ms": round(self.last_latency * 1000, 1),
+        }
+
+
+class RenderPool:
+    def __init__(self, instances: List[Instance]):
+        self.instances = instances
+        self._client: Optional[httpx.AsyncClient] = None
+        self._health_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(PUML_RENDER_TIMEOUT, connect=2.0),
+            limits=httpx.Limits(max_keepalive_connections=4 * len(self.instances))
+        )
+        for instance in self.instances:
+            instance.spawn()
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+        await asyncio.gather(*(asyncio.to_thread(instance.kill) for instance in self.instances))
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def restart(self, instance: Instance, reason: str):
+        print(f"PlantUML 实例 {instance.index} {reason}，重新启动")
+        # 等待进程退出期间不再分配请求，也不阻塞事件循环上的其他请求
+        instance.ready = False
+        await asyncio.to_thread(instance.kill)
+        instance.restarts += 1
+        instance.spawn()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self._check(instance) for instance in self.instances))
+            await asyncio.sleep(PUML_HEALTH_INTERVAL)
+
+    async def _check(self, instance: Instance):
+        if not instance.alive():
+            await self.restart(instance, f"已退出（code={instance.process.returncode}）")
+            return
+        try:
+            response = await self._client.get(f"{instance.url}{HEALTH_PROBE_PATH}", timeout=PUML_HEALTH_TIMEOUT)
+            healthy = response.status_code == 200
+        except httpx.HTTPError:
+            healthy = False
+
+        if healthy:
+            instance.ready = True
+            instance.healthy_once = True
+            instance.health_failures = 0
+            return
+        instance.ready = False
+        if not instance.healthy_once and time.monotonic() - instance.started < PUML_START_TIMEOUT:
+            # JVM 仍在启动
+            return
+        instance.health_failures += 1
+        if instance.health_failures >= PUML_HEALTH_FAILURES:
+            await self.restart(instance, f"连续 {instance.health_failures} 次健康检查失败")
+
+    def choose(self, exclude=()) -> Optional[Instance]:
+        ready = [i for i in self.instances if i.ready and i not in exclude]
+        return min(ready, key=Instance.load) if ready else None
+
+    async def render(self, path: str, query: str) -> Response:
+        tried = set()
+        while True:
+            instance = self.choose(tried)
+            if instance is None:
+                if tried:
+                    raise HTTPException(status_code=502, detail="所有 PlantUML 实例均不可用")
+                raise HTTPException(status_code=503, detail="没有可用的 PlantUML 实例", headers={"Retry-After": "2"})
+            tried.add(instance)
+
+            url = f"{instance.url}/{path}" + (f"?{query}" if query else "")
+            instance.outstanding += 1
+            instance.requests += 1
+            started = time.perf_counter()
+            try:
+                response = await self._client.get(url)
+            except httpx.TimeoutException:
+                # 大图也可能超时，交给健康检查判断实例是否卡住
+                instance.errors += 1
+                raise HTTPException(status_code=504, detail=f"PlantUML 实例 {instance.index} 渲染超时")
+            except httpx.HTTPError:
+                # 连接失败：实例可能刚崩溃，换一个实例重试
+                instance.errors += 1
+                instance.ready = False
+                continue
+            finally:
+                instance.outstanding -= 1
+            instance.record_latency(time.perf_counter() - started)
+
+            headers = {
+                name: value for name, value in response.headers.items()
+                if name.lower() in ("content-type", "cache-control", "etag", "last-modified")
+            }
+            return Response(content=response.content, status_code=response.status_code, headers=headers)
+
+
+pool = RenderPool([Instance(i, PUML_BASE_PORT + i) for i in range(PUML_POOL_SIZE)])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await pool.start()
+    yield
+    await pool.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "instances": sum(1 for i in pool.instances if i.alive())}
+
+
+@app.get("/readyz")
+async def readyz():
+    """至少有一个实例就绪即可接收请求"""
+    ready = sum(1 for i in pool.instances if i.ready)
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready_instances": ready, "instances": len(pool.instances)}
+    )
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "outstanding": sum(i.outstanding for i in pool.instances),
+        "instances": [i.describe() for i in pool.instances],
+    }
+
+
+@app.get("/{path:path}")
+async def render(path: str, request: Request):
+    return await pool.render(path, request.url.query)
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=PUML_POOL_PORT)
@@ -3,6 +3,8 @@ from utils.uml import (
     get_existing_classes,
     get_name_mapping,
 )
+from utils.uml_ast import parse_uml
+from utils import uml_edit
 
 def render_class_diagram_editor(code_key, message_idx, current_code):
     """Render class diagram editor"""
@@ -156,35 +158,8 @@ def render_add_class(code_key, message_idx, current_code):
             st.error(f"Class name '{class_name}' already exists")
             return
             
-        lines = current_code.split('\n')
-        new_class = f"\nclass {class_name} {{\n"
-        
-        # Add attributes
-        for attr in attrs_list:
-            if attr["name"].strip():
-                new_class += f"  {attr['visibility']}{attr['name']}"
-                if attr["type"].strip():
-                    new_class += f": {attr['type']}"
-                new_class += "\n"
-        
-        # Add methods
-        for method in methods_list:
-            if method["name"].strip():
-                new_class += f"  {method['visibility']}{method['name']}"
-                new_class += "("
-                if method["params"].strip():
-                    new_class += method["params"]
-                new_class += ")"
-                if method["return_type"].strip():
-                    new_class += f": {method['return_type']}"
-                new_class += "\n"
-        
-        new_class += "}\n"
-        
-        insert_pos = next(i for i, line in enumerate(lines) 
-            if '@enduml' in line.lower())
-        lines.insert(insert_pos, new_class)
-        st.session_state[code_key] = '\n'.join(lines)
+        result = uml_edit.add_class(current_code, class_name, attrs_list, methods_list)
+        st.session_state[code_key] = result.code
         st.success(f"Class '{class_name}' has been added")
         st.rerun()
 
@@ -212,49 +187,11 @@ def render_modify_class(code_key, message_idx, current_code):
             del st.session_state[f"modify_methods_list_{message_idx}"]
         st.session_state[f"last_modified_class_{message_idx}"] = class_to_modify
     
-    # Parse current class information
-    lines = current_code.split('\n')
-    class_content = []
-    in_class = False
-    for line in lines:
-        if line.strip().startswith(f'class {class_to_modify}'):
-            in_class = True
-            continue
-        if in_class:
-            if line.strip() == '}':
-                break
-            if line.strip():
-                class_content.append(line.strip())
-    
-    # Separate attributes and methods
-    attributes = []
-    methods = []
-    for item in class_content:
-        if '(' in item:  # Method
-            vis = item[0] if item[0] in ['+', '-', '#'] else '+'
-            name = item[1:item.index('(')] if item[0] in ['+', '-', '#'] else item[:item.index('(')]
-            params = item[item.index('(')+1:item.index(')')]
-            return_type = item[item.index(')')+2:] if ': ' in item else ""
-            methods.append({
-                "visibility": vis,
-                "name": name.strip(),
-                "return_type": return_type,
-                "params": params
-            })
-        else:  # Attribute
-            vis = item[0] if item[0] in ['+', '-', '#'] else '+'
-            try:
-                name = item[1:item.index(': ')] if ': ' in item else item[1:]
-                type_ = item[item.index(': ')+2:] if ': ' in item else ""
-            except:
-                # Handle special cases
-                name = item[1:] if item else ""
-                type_ = ""
-            attributes.append({
-                "visibility": vis,
-                "name": name.strip(),
-                "type": type_
-            })
+    # Read current class information from the parsed diagram
+    diagram = parse_uml(current_code)
+    class_def = diagram.get_class(class_to_modify)
+    attributes = [m.to_dict() for m in class_def.attributes] if class_def else []
+    methods = [m.to_dict() for m in class_def.methods] if class_def else []
     
     # Initialize session state (only on first load)
     if f"modify_attrs_list_{message_idx}" not in st.session_state:
@@ -374,88 +311,9 @@ def render_modify_class(code_key, message_idx, current_code):
             st.error(f"Class name '{new_class_name}' already exists")
             return
 
-        # Delete original class definition
-        new_lines = []
-        skip_class = False
-        relationships = []  # Store all relationships
-        
-        for line in lines:
-            line_stripped = line.strip()
-            
-            # Skip original class definition
-            if line_stripped.startswith(f'class {class_to_modify}'):
-                skip_class = True
-                continue
-            if skip_class and line_stripped == '}':
-                skip_class = False
-                continue
-            
-            # Collect and temporarily skip related relationships
-            if any(rel in line_stripped for rel in ['<|--', '--|>', '--', '--*', '*--', '--o', 'o--']):
-                # Check if it contains the class name to be modified
-                if class_to_modify in line_stripped:
-                    relationships.append(line)
-                    continue
-            
-            if not skip_class:
-                new_lines.append(line)
-        
-        # Add modified class
-        insert_pos = next((i for i, line in enumerate(new_lines) 
-            if '@enduml' in line.lower()), len(new_lines))
-        
-        # Add modified class definition
-        new_class = f"\nclass {new_class_name} {{\n"
-        
-        # Add attributes
-        for attr in attrs_list:
-            if attr["name"].strip():
-                new_class += f"  {attr['visibility']}{attr['name']}"
-                if attr["type"].strip():
-                    new_class += f": {attr['type']}"
-                new_class += "\n"
-        
-        # Add methods
-        for method in methods_list:
-            if method["name"].strip():
-                new_class += f"  {method['visibility']}{method['name']}"
-                new_class += "("
-                if method["params"].strip():
-                    new_class += method["params"]
-                new_class += ")"
-                if method["return_type"].strip():
-                    new_class += f": {method['return_type']}"
-                new_class += "\n"
-        
-        new_class += "}\n"
-        
-        # Insert modified class
-        new_lines.insert(insert_pos, new_class)
-        
-        # Update and add relationships
-        for relationship in relationships:
-            updated_relationship = relationship
-            
-            # Handle quoted and unquoted cases
-            if f'"{class_to_modify}"' in updated_relationship:
-                updated_relationship = updated_relationship.replace(f'"{class_to_modify}"', f'"{new_class_name}"')
-            else:
-                # Handle various relationship patterns
-                patterns = [
-                    (f'{class_to_modify} ', f'{new_class_name} '),
-                    (f' {class_to_modify} ', f' {new_class_name} '),
-                    (f' {class_to_modify}"', f' {new_class_name}"'),
-                    (f'"{class_to_modify} ', f'"{new_class_name} '),
-                    (f' {class_to_modify}:', f' {new_class_name}:'),
-                    (f'({class_to_modify})', f'({new_class_name})'),
-                    (f' {class_to_modify}$', f' {new_class_name}'),
-                ]
-                for old, new in patterns:
-                    updated_relationship = updated_relationship.replace(old, new)
-            
-            new_lines.insert(insert_pos, updated_relationship)
-        
-        st.session_state[code_key] = '\n'.join(new_lines)
+        # Replace the class block in place and rename references in relationships
+        result = uml_edit.modify_class(current_code, class_to_modify, new_class_name, attrs_list, methods_list)
+        st.session_state[code_key] = result.code
         
         # Clear modification state
         if f"modify_attrs_list_{message_idx}" in st.session_state:
@@ -477,33 +335,11 @@ def render_delete_class(code_key, message_idx, current_code):
         )
         
         if st.button("Delete Class", key=f"delete_class_btn_{message_idx}", type="primary"):
-            lines = current_code.split('\n')
-            new_lines = []
-            skip_class = False
-            class_found = False
+            # Remove the class block and every relationship that references it
+            result = uml_edit.delete_class(current_code, class_to_delete)
             
-            for line in lines:
-                line_stripped = line.strip()
-                
-                if line_stripped.startswith(f'class {class_to_delete}'):
-                    skip_class = True
-                    class_found = True
-                    continue
-                
-                if skip_class and line_stripped == '}':
-                    skip_class = False
-                    continue
-                
-                if any(pattern.format(class_to_delete) in line_stripped for pattern in [
-                    '{}', '{}--', '--{}', '{}--|>', '<|--{}', '{}--*', '*--{}', '{}--o', 'o--{}'
-                ]):
-                    continue
-                
-                if not skip_class:
-                    new_lines.append(line)
-            
-            if class_found:
-                st.session_state[code_key] = '\n'.join(new_lines)
+            if result is not None:
+                st.session_state[code_key] = result.code
                 st.success(f"Class '{class_to_delete}' and its relationships have been deleted")
                 st.rerun()
             else:
@@ -550,8 +386,6 @@ def render_add_relationship(code_key, message_idx, current_code):
         label = st.text_input("Relationship Label (Optional)", key=f"label_{message_idx}")
         
         if st.button("Add Relationship", key=f"add_relation_{message_idx}", type="primary"):
-            lines = current_code.split('\n')
-            
             # Get source and target aliases (if any)
             source_alias = next((alias for alias, name in name_map.items() if name == source), source)
             target_alias = next((alias for alias, name in name_map.items() if name == target), target)
@@ -571,46 +405,8 @@ def render_add_relationship(code_key, message_idx, current_code):
                 relation_str += f' : {label}'
             relation_str += '\n'
             
-            # Find all class definition start and end positions
-            class_positions = []  # Store start and end positions of each class
-            in_class = False
-            class_start = -1
-            for i, line in enumerate(lines):
-                line_stripped = line.strip()
-                if line_stripped.startswith('class '):
-                    in_class = True
-                    class_start = i
-                elif line_stripped == '}' and in_class:
-                    in_class = False
-                    class_positions.append((class_start, i))
-            
-            # Find the first independent attribute or method definition position (outside class definitions)
-            method_start_pos = len(lines)
-            for i, line in enumerate(lines):
-                line_stripped = line.strip()
-                # Ensure not inside any class definition
-                if not any(start <= i <= end for start, end in class_positions):
-                    if (line_stripped.startswith('+') or 
-                        line_stripped.startswith('-') or 
-                        line_stripped.startswith('#')) or \
-                       ('(' in line_stripped and ')' in line_stripped):
-                        method_start_pos = i
-                        break
-            
-            # Choose appropriate insertion position: after the last class definition, but before the first independent method/attribute
-            if class_positions:
-                last_class_end = max(pos[1] for pos in class_positions)
-                insert_pos = min(last_class_end + 1, method_start_pos)
-                
-                # Ensure insertion position not inside any class
-                while any(start <= insert_pos <= end for start, end in class_positions):
-                    insert_pos = max(pos[1] + 1 for pos in class_positions if pos[1] >= insert_pos)
-            else:
-                insert_pos = next(i for i, line in enumerate(lines) 
-                    if '@enduml' in line.lower())
-            
-            lines.insert(insert_pos, relation_str)
-            st.session_state[code_key] = '\n'.join(lines)
+            result = uml_edit.add_relationship(current_code, relation_str)
+            st.session_state[code_key] = result.code
             st.success("Relationship has been added")
             st.rerun()
     else:
@@ -620,24 +416,13 @@ def render_delete_relationship(code_key, message_idx, current_code):
     """Render delete relationship interface"""
     existing_classes = get_existing_classes(current_code)
     if existing_classes:
+        diagram = parse_uml(current_code)
         relations = []
-        lines = current_code.split('\n')
-        for line in lines:
-            line_stripped = line.strip()
-            # Check if it contains class name and relationship symbols
-            has_class = any(f'"{c}"' in line_stripped or f' {c} ' in line_stripped 
-                          or line_stripped.startswith(f'{c} ')
-                          or line_stripped.endswith(f' {c}')
-                          for c in existing_classes)
-            
-            # Check if it contains relationship symbols
-            has_relation = any(rel in line_stripped for rel in [
-                '--', '--|>', '<|--', '--*', '*--', '--o', 'o--'
-            ])
-            
-            if has_class and has_relation:
+        for relationship in diagram.relationships:
+            # Only relationships between known classes
+            if relationship.source in existing_classes or relationship.target in existing_classes:
                 # Remove extra spaces and standardize spaces
-                normalized_line = ' '.join(line_stripped.split())
+                normalized_line = ' '.join(relationship.text.split())
                 if normalized_line not in relations:  # Avoid duplicates
                     relations.append(normalized_line)
         
@@ -656,13 +441,8 @@ def render_delete_relationship(code_key, message_idx, current_code):
             )
             
             if st.button("Delete Relationship", key=f"delete_relation_btn_{message_idx}", type="primary"):
-                # Standardize relationship to delete
-                normalized_to_delete = ' '.join(relation_to_delete.split())
-                # Keep lines that don't match
-                new_lines = [line for line in lines 
-                           if ' '.join(line.strip().split()) != normalized_to_delete]
-                
-                st.session_state[code_key] = '\n'.join(new_lines)
+                result = uml_edit.delete_relationship(current_code, relation_to_delete)
+                st.session_state[code_key] = result.code
                 st.success("Relationship has been deleted")
                 st.rerun()
         else:
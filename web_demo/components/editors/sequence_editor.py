@@ -5,6 +5,8 @@ from utils.uml import (
     get_existing_participants,
     get_name_mapping
 )
+from utils.uml_ast import parse_uml
+from utils import uml_edit
 
 def render_sequence_diagram_editor(code_key, message_idx, current_code):
     """Render sequence diagram editor"""
@@ -64,18 +66,8 @@ def render_add_participant(code_key, message_idx, current_code):
             st.error("Please enter participant name")
             return
 
-        lines = current_code.split('\n')
-        participant_str = f'\n{participant_type[0]} "{participant_name}"'
-        if description.strip():
-            participant_str += f' as {participant_name.replace(" ", "_")}\n'
-            participant_str += f'note over {participant_name.replace(" ", "_")}: {description}\n'
-        else:
-            participant_str += '\n'
-        
-        insert_pos = next((i for i, line in enumerate(lines) 
-            if '@enduml' in line.lower()), len(lines)-1)
-        lines.insert(insert_pos, participant_str)
-        st.session_state[code_key] = '\n'.join(lines)
+        result = uml_edit.add_participant(current_code, participant_type[0], participant_name, description)
+        st.session_state[code_key] = result.code
         st.success(f"Participant '{participant_name}' has been added")
         st.rerun()
 
@@ -95,82 +87,8 @@ def render_delete_participant(code_key, message_idx, current_code):
             key=f"delete_participant_btn_{code_key}_{message_idx}", 
             type="primary"
         ):
-            lines = current_code.split('\n')
-            new_lines = []
-            skip_note = False
-            
-            # Get all possible identifiers for the participant (original name and aliases)
-            participant_aliases = set()  # Use set to avoid duplicates
-            participant_aliases.add(participant_to_delete)
-            
-            # Find all possible aliases
-            for line in lines:
-                line_stripped = line.strip()
-                # Check if it's a participant definition line
-                if any(line_stripped.startswith(prefix) for prefix in [
-                    'participant ', 'actor ', 'boundary ', 
-                    'control ', 'entity ', 'database '
-                ]):
-                    # If it contains the participant name to delete
-                    if f'"{participant_to_delete}"' in line_stripped:
-                        # Check for alias
-                        if ' as ' in line_stripped:
-                            alias = line_stripped.split(' as ')[-1].strip()
-                            participant_aliases.add(alias)
-                            # Also add underscore version
-                            participant_aliases.add(alias.replace(" ", "_"))
-            
-            # Add variants of original name
-            participant_aliases.add(participant_to_delete.replace(" ", "_"))
-            
-            # Add quoted versions of all names
-            quoted_aliases = {f'"{alias}"' for alias in participant_aliases}
-            participant_aliases.update(quoted_aliases)
-            
-            for line in lines:
-                line_stripped = line.strip()
-                should_skip = False
-                
-                # Check if it's a participant definition line
-                if any(line_stripped.startswith(prefix) for prefix in [
-                    'participant ', 'actor ', 'boundary ', 
-                    'control ', 'entity ', 'database '
-                ]):
-                    if any(alias in line_stripped for alias in participant_aliases):
-                        should_skip = True
-                        continue
-                
-                # Check note blocks
-                if line_stripped.startswith('note over'):
-                    if any(alias in line_stripped for alias in participant_aliases):
-                        skip_note = True
-                        should_skip = True
-                elif skip_note:
-                    if line_stripped.endswith('end note'):
-                        skip_note = False
-                    should_skip = True
-                
-                # Check activate/deactivate lines
-                if any(f'{action} {alias}' in line_stripped 
-                      for action in ['activate', 'deactivate']
-                      for alias in participant_aliases):
-                    should_skip = True
-                
-                # Check message lines
-                if any(pattern.format(alias) in line_stripped 
-                      for alias in participant_aliases
-                      for pattern in [
-                          '{}', '{} ->', '-> {}', '{} -->', '--> {}',
-                          '{} ->>', '->> {}', '{} -->>', '-->> {}',
-                          '{} ->o', '->o {}', '{} ->x', '->x {}'
-                      ]):
-                    should_skip = True
-                
-                # Keep the line if it shouldn't be skipped
-                if not should_skip:
-                    new_lines.append(line)
-            
-            st.session_state[code_key] = '\n'.join(new_lines)
+            result = uml_edit.delete_participant(current_code, participant_to_delete)
+            st.session_state[code_key] = result.code
             st.success(f"Participant '{participant_to_delete}' and related content have been deleted")
             st.rerun()
     else:
@@ -232,61 +150,32 @@ def render_add_message(code_key, message_idx, current_code):
                 st.error("Please enter message content")
                 return
 
-            lines = current_code.split('\n')
-            message_lines = []
-            
             # Get source and target aliases (if any)
             source_alias = next((alias for alias, name in name_map.items() if name == source), source)
             target_alias = next((alias for alias, name in name_map.items() if name == target), target)
             
-            if activate:
-                message_lines.append(f'activate "{target_alias}"')
-            
-            message_lines.append(f'"{source_alias}" {message_type[0]} "{target_alias}": {message_text}')
-            
-            if deactivate:
-                message_lines.append(f'deactivate "{target_alias}"')
-            
-            insert_pos = next(i for i, line in enumerate(lines) 
-                if '@enduml' in line.lower())
-            lines[insert_pos:insert_pos] = message_lines
-            
-            st.session_state[code_key] = '\n'.join(lines)
+            result = uml_edit.add_message(
+                current_code, source_alias, message_type[0], target_alias,
+                message_text, activate, deactivate
+            )
+            st.session_state[code_key] = result.code
             st.success("Message has been added")
             st.rerun()
 
 def render_delete_message(code_key, message_idx, current_code):
     """Render delete message interface"""
-    name_map = get_name_mapping(current_code)  # Get name mapping
+    diagram = parse_uml(current_code)
+    name_map = diagram.name_map  # Get name mapping
     messages = []
-    lines = current_code.split('\n')
-    
-    # Create reverse mapping (original name to alias)
-    reverse_map = {v: k for k, v in name_map.items()}
     
-    for line in lines:
-        line_stripped = line.strip()
-        if any(arrow in line_stripped for arrow in ['->', '-->', '->>', '-->>>', '->o', '->x']):
-            if ':' in line_stripped:  # Make sure it's a message line
-                # Parse message line
-                parts = line_stripped.split(':')
-                message_part = parts[0]
-                content_part = ':'.join(parts[1:])
-                
-                # Extract source and target
-                message_parts = message_part.split()
-                if len(message_parts) >= 3:
-                    source = message_parts[0].strip('"')
-                    arrow = message_parts[1]
-                    target = message_parts[2].strip('"')
-                    
-                    # Use original names (if mapped)
-                    source_display = name_map.get(source, source)
-                    target_display = name_map.get(target, target)
-                    
-                    # Build display message
-                    display_message = f'"{source_display}" {arrow} "{target_display}"{content_part}'
-                    messages.append((display_message, line_stripped))
+    for message in diagram.messages:
+        # Use original names (if mapped)
+        source_display = name_map.get(message.source, message.source)
+        target_display = name_map.get(message.target, message.target)
+        
+        # Build display message
+        display_message = f'"{source_display}" {message.arrow} "{target_display}": {message.label}'
+        messages.append((display_message, message.line))
     
     if messages:
         message_to_delete = st.selectbox(
@@ -308,9 +197,9 @@ def render_delete_message(code_key, message_idx, current_code):
             type="primary"
         ):
             # Find corresponding original line to delete
-            original_line = next(m[1] for m in messages if m[0] == message_to_delete)
-            new_lines = [line for line in lines if line.strip() != original_line]
-            st.session_state[code_key] = '\n'.join(new_lines)
+            message_line = next(m[1] for m in messages if m[0] == message_to_delete)
+            result = uml_edit.delete_line(current_code, message_line)
+            st.session_state[code_key] = result.code
             st.success("Message has been deleted")
             st.rerun()
     else:
@@ -1,5 +1,7 @@
 import streamlit as st
 from utils.uml import get_uml_diagram, create_usecase_template, get_existing_actors, get_existing_usecases, get_name_mapping
+from utils.uml_ast import parse_uml
+from utils import uml_edit
 import re
 import time
 
@@ -51,20 +53,8 @@ def render_add_actor(code_key, message_idx, current_code):
             st.error("Please enter actor name")
             return
 
-        lines = current_code.split('\n')
-        actor_str = f'\nactor "{actor_name}"'
-        if description.strip():
-            actor_str += f' as {actor_name.replace(" ", "_")}\n'
-            actor_str += f'note right of {actor_name.replace(" ", "_")}\n'
-            actor_str += f'  {description}\n'
-            actor_str += 'end note\n'
-        else:
-            actor_str += '\n'
-        
-        insert_pos = next((i for i, line in enumerate(lines) 
-            if '@enduml' in line.lower()), len(lines)-1)
-        lines.insert(insert_pos, actor_str)
-        st.session_state[code_key] = '\n'.join(lines)
+        result = uml_edit.add_actor(current_code, actor_name, description)
+        st.session_state[code_key] = result.code
         st.success(f"Actor '{actor_name}' has been added")
         st.rerun()
 
@@ -82,20 +72,8 @@ def render_add_usecase(code_key, message_idx, current_code):
             st.error("Please enter use case name")
             return
 
-        lines = current_code.split('\n')
-        usecase_str = f'\nusecase "{usecase_name}"'
-        if description.strip():
-            usecase_str += f' as {usecase_name.replace(" ", "_")}\n'
-            usecase_str += f'note right of {usecase_name.replace(" ", "_")}\n'
-            usecase_str += f'  {description}\n'
-            usecase_str += 'end note\n'
-        else:
-            usecase_str += '\n'
-        
-        insert_pos = next((i for i, line in enumerate(lines) 
-            if '@enduml' in line.lower()), len(lines)-1)
-        lines.insert(insert_pos, usecase_str)
-        st.session_state[code_key] = '\n'.join(lines)
+        result = uml_edit.add_usecase(current_code, usecase_name, description)
+        st.session_state[code_key] = result.code
         st.success(f"Use case '{usecase_name}' has been added")
         st.rerun()
 
@@ -110,17 +88,8 @@ def render_delete_actor(code_key, message_idx, current_code):
         )
         
         if st.button("Delete Actor", key=f"delete_actor_btn_{message_idx}", type="primary"):
-            lines = current_code.split('\n')
-            new_lines = []
-            for line in lines:
-                line_stripped = line.strip()
-                if (not line_stripped.startswith(f'actor {actor_to_delete}') and 
-                    not any(pattern.format(actor_to_delete) in line_stripped for pattern in [
-                        '{}', '{} -->', '--> {}', '{} <|--', '--|> {}'
-                    ])):
-                    new_lines.append(line)
-            
-            st.session_state[code_key] = '\n'.join(new_lines)
+            result = uml_edit.delete_actor(current_code, actor_to_delete)
+            st.session_state[code_key] = result.code
             st.success(f"Actor '{actor_to_delete}' and related relationships have been deleted")
             st.rerun()
     else:
@@ -141,80 +110,8 @@ def render_delete_usecase(code_key, message_idx, current_code):
             key=f"delete_usecase_btn_{code_key}_{message_idx}", 
             type="primary"
         ):
-            lines = current_code.split('\n')
-            new_lines = []
-            skip_note = False
-            
-            # Get all possible identifiers for the use case (original name and aliases)
-            usecase_aliases = set()
-            usecase_aliases.add(usecase_to_delete)
-            
-            # Find use case aliases
-            for line in lines:
-                line_stripped = line.strip()
-                if line_stripped.startswith('usecase '):
-                    if f'"{usecase_to_delete}"' in line_stripped and ' as ' in line_stripped:
-                        alias = line_stripped.split(' as ')[-1].strip()
-                        usecase_aliases.add(alias)
-            
-            # Add quoted versions
-            quoted_aliases = {f'"{alias}"' for alias in usecase_aliases}
-            usecase_aliases.update(quoted_aliases)
-            
-            for line in lines:
-                line_stripped = line.strip()
-                should_skip = False
-                
-                # Check if it's a use case definition line
-                if line_stripped.startswith('usecase '):
-                    if any(alias in line_stripped for alias in usecase_aliases):
-                        should_skip = True
-                        continue
-                
-                # Check if it's a relationship line
-                # Extend relationship detection patterns to include all possible forms
-                if any(pattern in line_stripped for pattern in ['-->', '.>', '--|>', '-']):
-                    # Extract relationship source and target, support more formats
-                    # Match the following formats:
-                    # 1. "source" --> "target"
-                    # 2. source --> target
-                    # 3. actor --> UC1
-                    relation_patterns = [
-                        r'(["\w]+)\s*(?:-->|\.>|--\|>)\s*(["\w]+)',  # Standard format
-                        r'"([^"]+)"\s*(?:-->|\.>|--\|>)\s*"([^"]+)"',  # Quoted format
-                        r'(\w+)\s*(?:-->|\.>|--\|>)\s*(\w+)'  # Unquoted format
-                    ]
-                    
-                    for pattern in relation_patterns:
-                        relation_match = re.match(pattern, line_stripped)
-                        if relation_match:
-                            source = relation_match.group(1).strip('"')
-                            target = relation_match.group(2).strip('"')
-                            
-                            # Check if source or target matches the use case to delete
-                            if (source in usecase_aliases or 
-                                target in usecase_aliases or 
-                                source.strip('"') in usecase_aliases or 
-                                target.strip('"') in usecase_aliases):
-                                should_skip = True
-                                print(f"Skipping relationship line: {line_stripped}")  # Debug output
-                                break
-                
-                # Check note blocks
-                if line_stripped.startswith('note '):
-                    if any(alias in line_stripped for alias in usecase_aliases):
-                        skip_note = True
-                        should_skip = True
-                elif skip_note:
-                    if line_stripped == 'end note':
-                        skip_note = False
-                    should_skip = True
-                
-                # Keep the line if it shouldn't be skipped
-                if not should_skip:
-                    new_lines.append(line)
-            
-            st.session_state[code_key] = '\n'.join(new_lines)
+            result = uml_edit.delete_usecase(current_code, usecase_to_delete)
+            st.session_state[code_key] = result.code
             st.success(f"Use case '{usecase_to_delete}' and related content have been deleted")
             st.rerun()
     else:
@@ -278,88 +175,44 @@ def render_add_usecase_relation(code_key, message_idx, current_code):
                 relation += f" {target_original}"
                 
                 # Insert new relationship before @enduml
-                lines = current_code.split('\n')
-                insert_index = next(i for i, line in enumerate(lines) if '@enduml' in line)
-                lines.insert(insert_index, relation)
+                result = uml_edit.add_usecase_relation(current_code, relation)
                 
                 # Update code
-                st.session_state[code_key] = '\n'.join(lines)
+                st.session_state[code_key] = result.code
                 st.success(f"Relationship added: {relation}")
                 st.rerun()
 
 def render_delete_usecase_relation(code_key, message_idx, current_code):
     """Render delete relationship interface"""
     relations = []
-    lines = current_code.split('\n')
+    diagram = parse_uml(current_code)
     
     # Get complete name mapping for all use cases
     usecase_names = {}
-    for line in lines:
-        line_stripped = line.strip()
-        if line_stripped.startswith('usecase '):
-            if ' as ' in line_stripped:
-                parts = line_stripped.split(' as ')
-                name_part = parts[0].strip()
-                alias = parts[1].strip()
-                name_match = re.search(r'"([^"]+)"', name_part)
-                if name_match:
-                    full_name = name_match.group(1)
-                    usecase_names[alias] = full_name
-            else:
-                name_match = re.search(r'"([^"]+)"', line_stripped)
-                if name_match:
-                    full_name = name_match.group(1)
-                    usecase_names[full_name] = full_name
-    
-    print("Use case name mapping:", usecase_names)
+    for usecase in diagram.usecases:
+        usecase_names[usecase.alias or usecase.name] = usecase.name
     
-    for line in lines:
-        line_stripped = line.strip()
-        print("Processing line:", line_stripped)
+    for relationship in diagram.relationships:
+        source = relationship.source
+        target = relationship.target
         
-        # Check if contains relationship
-        if '-->' in line_stripped or '.>' in line_stripped or '--|>' in line_stripped:
-            # Use regex to extract relationship source and target
-            # Match formats: source --> target or "source" --> "target"
-            relation_match = re.match(r'(["\w]+)\s*(?:-->|\.>|--\|>)\s*(["\w]+)', line_stripped)
-            
-            if relation_match:
-                source = relation_match.group(1).strip('"')
-                target = relation_match.group(2).strip('"')
-                
-                print(f"Found relationship: {source} -> {target}")
-                
-                # Replace use case aliases with full names
-                display_source = usecase_names.get(source, source)
-                display_target = usecase_names.get(target, target)
-                
-                print(f"Source: {source} -> {display_source}")
-                print(f"Target: {target} -> {display_target}")
-                
-                # Build display relationship text
-                # Keep original format, just replace names
-                display_line = line_stripped
-                
-                # Replace target (consider both quoted and unquoted cases)
-                if target in usecase_names:
-                    display_line = re.sub(
-                        rf'\b{target}\b',
-                        display_target,
-                        display_line
-                    )
-                
-                # Replace source
-                if source in usecase_names:
-                    display_line = re.sub(
-                        rf'\b{source}\b',
-                        display_source,
-                        display_line
-                    )
-                
-                print("Display line:", display_line)
-                relations.append((display_line, line_stripped))
-    
-    print("Found relationships:", relations)
+        # Replace use case aliases with full names
+        display_source = usecase_names.get(source, source)
+        display_target = usecase_names.get(target, target)
+        
+        # Build display relationship text
+        # Keep original format, just replace names
+        display_line = relationship.text
+        
+        # Replace target (consider both quoted and unquoted cases)
+        if target in usecase_names:
+            display_line = re.sub(rf'\b{re.escape(target)}\b', display_target, display_line)
+        
+        # Replace source
+        if source in usecase_names:
+            display_line = re.sub(rf'\b{re.escape(source)}\b', display_source, display_line)
+        
+        relations.append((display_line, relationship.line))
     
     if relations:
         relation_to_delete = st.selectbox(
@@ -379,9 +232,9 @@ def render_delete_usecase_relation(code_key, message_idx, current_code):
             key=f"delete_relation_btn_{code_key}_{message_idx}", 
             type="primary"
         ):
-            original_line = next(r[1] for r in relations if r[0] == relation_to_delete)
-            new_lines = [line for line in lines if line.strip() != original_line]
-            st.session_state[code_key] = '\n'.join(new_lines)
+            relation_line = next(r[1] for r in relations if r[0] == relation_to_delete)
+            result = uml_edit.delete_line(current_code, relation_line)
+            st.session_state[code_key] = result.code
             st.success("Relationship has been deleted")
             st.rerun()
     else:
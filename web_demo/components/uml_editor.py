@@ -1,9 +1,20 @@
 import streamlit as st
-from utils.uml import get_uml_diagram, get_diagram_type
+from utils.blob_server import blob_url
+from utils.render_cache import render_cache
+from utils.uml import PREVIEW_FORMAT, DebouncedRenderer, get_diagram_type, peek_uml_diagram
 from components.editors.class_editor import render_class_diagram_editor
 from components.editors.usecase_editor import render_usecase_diagram_editor
 from components.editors.sequence_editor import render_sequence_diagram_editor
 
+# 后台渲染未完成时，预览区域检查渲染结果的间隔（秒）
+PREVIEW_POLL_INTERVAL = 0.5
+
+def get_preview_renderer():
+    """当前会话的防抖渲染器（code_key 只在会话内唯一）"""
+    if "preview_renderer" not in st.session_state:
+        st.session_state.preview_renderer = DebouncedRenderer()
+    return st.session_state.preview_renderer
+
 def render_uml_editor(code_key, message_idx):
     """渲染 UML 编辑器组件"""
     current_code = st.session_state[code_key]
@@ -56,6 +67,17 @@ def render_uml_editor(code_key, message_idx):
             box-shadow: 0 2px 4px rgba(0,0,0,0.2);
             transform: translateY(-1px);
         }
+        
+        /* 图表渲染完成前的占位框 */
+        .preview-skeleton {
+            height: 300px;
+            display: flex;
+            align-items: center;
+            justify-content: center;
+            color: #888;
+            background-color: rgba(128,128,128,0.1);
+            border-radius: 4px;
+        }
         </style>
     """, unsafe_allow_html=True)
     
@@ -87,10 +109,9 @@ def render_uml_editor(code_key, message_idx):
             # 检查代码是否发生变化
             if new_code != current_code:
                 st.session_state[code_key] = new_code
-                # 立即重新渲染图表
-                diagram_data = get_uml_diagram(new_code)
-                if diagram_data:
-                    st.rerun()
+                # 安静期过后在后台渲染最新版本，预览列稍后自动更新
+                get_preview_renderer().schedule(code_key, new_code, PREVIEW_FORMAT)
+                current_code = new_code
         else:
             # 可视化编辑器
             diagram_type = get_diagram_type(current_code)
@@ -109,22 +130,78 @@ def render_uml_editor(code_key, message_idx):
         # 显示当前的 PlantUML 代码
         with st.expander("📝 View PlantUML Code", expanded=False):
             st.code(current_code, language='java')
-            
-        # 显示图像预览
-        diagram_data = get_uml_diagram(current_code)
-        if diagram_data:
-            st.image(diagram_data['url'], width=600)
-            
-            # 下载按钮
-            download_filename = f"uml_diagram_{message_idx}.{diagram_data['format']}"
-            download_link = f'''
-            <div style="text-align: center;">
-                <a href="data:image/{diagram_data["format"]};base64,{diagram_data["data"]}" 
-                   download="{download_filename}">
-                    <button class="download-button">Download Diagram</button>
-                </a>
-            </div>
-            '''
-            st.markdown(download_link, unsafe_allow_html=True)
+        render_preview(code_key, message_idx)
+
+
+def render_preview(code_key, message_idx):
+    """显示图表预览，渲染在后台线程中进行，不阻塞页面其余部分
+
+    渲染未完成时先显示上一次成功的图片（或占位框），由 fragment 定时检查，
+    完成后整页重新运行一次以替换为新图片并停止轮询。
+    """
+    last_preview_key = f"last_preview_{code_key}_{message_idx}"
+    renderer = get_preview_renderer()
+
+    def peek():
+        # 防抖等待期间不提交渲染，由计时器在安静期结束后提交
+        return peek_uml_diagram(
+            st.session_state[code_key], PREVIEW_FORMAT, submit=not renderer.scheduled(code_key)
+        )
+
+    status, _ = peek()
+    polling = status == 'pending'
+
+    def preview():
+        status, diagram_data = peek()
+        if polling and status != 'pending':
+            st.rerun()
+        
+        if status == 'ready':
+            st.session_state[last_preview_key] = diagram_data
+        elif status == 'failed':
+            st.error("Failed to generate UML diagram, please check the code syntax")
+            return
         else:
-            st.error("Failed to generate UML diagram, please check the code syntax")
\ No newline at end of file
+            diagram_data = st.session_state.get(last_preview_key)
+            if diagram_data is None:
+                st.markdown('<div class="preview-skeleton">Rendering diagram...</div>', unsafe_allow_html=True)
+                return
+            st.caption("Rendering the latest changes...")
+        
+        format = diagram_data['format']
+        download_filename = f"uml_diagram_{message_idx}.{format}"
+        # 图片服务的地址按浏览器打开页面时的主机名推断
+        origin = st.context.headers.get('Origin')
+        image_url = blob_url(diagram_data['key'], origin=origin)
+        if image_url is None or format == 'txt':
+            # 图片服务未启用或浏览器无法访问时由 Streamlit 传输图片数据；字符图直接显示文本
+            content = render_cache.get(diagram_data['key'])
+            if content is None:
+                st.warning("Diagram is no longer cached, please re-render")
+                return
+            if format == 'txt':
+                st.code(content.decode('utf-8'), language=None)
+            else:
+                st.image(content.decode('utf-8') if format == 'svg' else content, width=600)
+            st.download_button("Download Diagram", content, file_name=download_filename)
+            return
+        
+        # 浏览器从图片服务加载并缓存图片，页面中只有链接
+        st.image(image_url, width=600)
+        
+        # 下载按钮：PNG 在第一次下载时才由图片服务渲染
+        png_url = blob_url(f"{diagram_data['hash']}.png", download=f"uml_diagram_{message_idx}.png", origin=origin)
+        svg_url = blob_url(f"{diagram_data['hash']}.svg", download=f"uml_diagram_{message_idx}.svg", origin=origin)
+        download_link = f'''
+        <div style="text-align: center;">
+            <a href="{png_url}">
+                <button class="download-button">Download PNG</button>
+            </a>
+            <a href="{svg_url}">
+                <button class="download-button">Download SVG</button>
+            </a>
+        </div>
+        '''
+        st.markdown(download_link, unsafe_allow_html=True)
+
+    st.fragment(preview, run_every=PREVIEW_POLL_INTERVAL if polling else None)()
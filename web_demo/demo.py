@@ -1,4 +1,3 @@
-import asyncio
 import streamlit as st
 import uuid
 import re
@@ -6,16 +5,23 @@ import httpx
 import sys
 import os
 import json
+import time
 from datetime import datetime
 
 # 添加项目根目录到 Python 路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from components.uml_editor import render_uml_editor
+from utils.http_client import create_client, stream_with_retry
+from utils.render_cache import cache_key, render_cache
+from utils.uml import PREVIEW_FORMAT, submit_render
 
 # Constants
 DEFAULT_USER_ID = str(uuid.uuid4())
-llm_serve_url = "http://36.50.226.35:17169"
+# 模型服务地址；使用 llm_serve/router.py 多副本部署时指向路由进程
+llm_serve_url = os.environ.get("AUG_LLM_SERVE_URL", "http://36.50.226.35:17169")
+# 流式显示时两次刷新之间的最短间隔（秒）
+STREAM_FRAME_INTERVAL = 1 / 15
 
 if 'messages' not in st.session_state:
     st.session_state.messages = []
@@ -73,108 +79,160 @@ def reset_chat():
         if key in st.session_state:
             del st.session_state[key]
 
+def split_message_parts(role, content, message_idx):
+    """把消息拆分为文本段和 UML 代码段
+
+    返回 [("text", 文本, None)] 或 [("uml", 代码, code_key)] 组成的列表
+    """
+    result = []
+    parts = re.split(r'(```[\s\S]*?```)', content, flags=re.DOTALL)
+    
+    for i, part in enumerate(parts):
+        stripped_part = part.strip()
+        if stripped_part.startswith('```') and stripped_part.endswith('```'):
+            code = stripped_part.strip('`').strip()
+            first_line = code.split('\n')[0] if '\n' in code else ''
+            
+            if first_line.lower() in ['plantuml', 'uml']:
+                # 提取实际的 UML 代码
+                code = '\n'.join(code.split('\n')[1:])
+                
+                # 根据图表类型生成不同的 key
+                diagram_type = "unknown"
+                if '@startuml' in code.lower() and '@enduml' in code.lower():
+                    if 'class' in code.lower():
+                        diagram_type = "class"
+                    elif 'usecase' in code.lower() or 'actor' in code.lower():
+                        diagram_type = "usecase"
+                    elif 'participant' in code.lower() or '->' in code.lower():
+                        diagram_type = "sequence"
+                
+                # 使用图表类型作为 key 的一部分
+                unique_key = f"{role}_{message_idx}_{i}_{diagram_type}"
+                result.append(("uml", code, f"code_{unique_key}"))
+        else:
+            if stripped_part:
+                result.append(("text", stripped_part, None))
+    return result
+
+def prefetch_diagrams(messages, start_idx=0):
+    """在绘制页面前把所有消息中的图表提交到后台并发渲染，不等待结果"""
+    codes = []
+    for idx, message in enumerate(messages, start_idx):
+        for kind, code, code_key in split_message_parts(message["role"], message["content"], idx):
+            if kind != "uml":
+                continue
+            # 已编辑过的图表以 session_state 中的代码为准
+            code = st.session_state.get(code_key, code)
+            if '@startuml' in code.lower() and '@enduml' in code.lower():
+                codes.append(code)
+    for code in dict.fromkeys(codes):
+        # 每次 rerun 都会走到这里，已渲染过的图表不再提交
+        if not render_cache.contains(cache_key(code, PREVIEW_FORMAT)):
+            submit_render(code, PREVIEW_FORMAT)
+
 def create_message_container(role, content, message_idx):
     with st.chat_message(role):
-        parts = re.split(r'(```[\s\S]*?```)', content, flags=re.DOTALL)
-        
-        for i, part in enumerate(parts):
-            stripped_part = part.strip()
-            if stripped_part.startswith('```') and stripped_part.endswith('```'):
-                code = stripped_part.strip('`').strip()
-                first_line = code.split('\n')[0] if '\n' in code else ''
+        for kind, part, code_key in split_message_parts(role, content, message_idx):
+            if kind == "uml":
+                # 确保代码被正确存储在 session_state 中
+                if code_key not in st.session_state:
+                    st.session_state[code_key] = part
                 
-                if first_line.lower() in ['plantuml', 'uml']:
-                    # 提取实际的 UML 代码
-                    code = '\n'.join(code.split('\n')[1:])
-                    
-                    # 根据图表类型生成不同的 key
-                    diagram_type = "unknown"
-                    if '@startuml' in code.lower() and '@enduml' in code.lower():
-                        if 'class' in code.lower():
-                            diagram_type = "class"
-                        elif 'usecase' in code.lower() or 'actor' in code.lower():
-                            diagram_type = "usecase"
-                        elif 'participant' in code.lower() or '->' in code.lower():
-                            diagram_type = "sequence"
-                    
-                    # 使用图表类型作为 key 的一部分
-                    unique_key = f"{role}_{message_idx}_{i}_{diagram_type}"
-                    code_key = f"code_{unique_key}"
-                    
-                    # 确保代码被正确存储在 session_state 中
-                    if code_key not in st.session_state:
-                        st.session_state[code_key] = code
-                    
-                    if '@startuml' in code.lower() and '@enduml' in code.lower():
-                        render_uml_editor(code_key, message_idx)
+                if '@startuml' in part.lower() and '@enduml' in part.lower():
+                    render_uml_editor(code_key, message_idx)
             else:
-                if stripped_part:
-                    st.markdown(stripped_part)
+                st.markdown(part)
 
 def create_empty_response_container():
     """创建一个空的响应容器并返回它"""
     # 只创建一个空的占位符，不创建聊天息
     return st.empty()
 
-async def get_bot_response(messages_history, placeholder):
-    timeout = httpx.Timeout(30.0, connect=60.0)
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        try:
-            response = await client.post(
-                llm_serve_url,
-                json={'messages': messages_history},
-                timeout=timeout
-            )
-            
-            full_content = ""
-            buffer = ""
-            
+def iter_sse(response):
+    """解析 Server-Sent Events，逐个返回 (event, data)"""
+    event, data_lines = "message", []
+    for line in response.iter_lines():
+        if not line:
+            if data_lines or event != "message":
+                yield event, "\n".join(data_lines)
+            event, data_lines = "message", []
+        elif line.startswith(":"):
+            continue
+        else:
+            field, _, value = line.partition(":")
+            if value.startswith(" "):
+                value = value[1:]
+            if field == "event":
+                event = value
+            elif field == "data":
+                data_lines.append(value)
+
+@st.cache_resource
+def get_llm_client():
+    """LLM 服务的连接池客户端，跨 Streamlit rerun 与会话复用"""
+    return create_client(timeout=httpx.Timeout(30.0, connect=60.0))
+
+def get_bot_response(messages_history, placeholder):
+    client = get_llm_client()
+    chunks = []
+    try:
+        # 连接失败或服务繁忙（429/503）时在开始流式读取之前退避重试
+        with stream_with_retry(
+            client,
+            "POST",
+            llm_serve_url,
+            json={'messages': messages_history, 'stream_format': 'sse'}
+        ) as response:
+            if response.status_code in (429, 503):
+                # 服务繁忙或模型仍在加载
+                retry_after = response.headers.get('retry-after', '')
+                error_msg = f"服务繁忙，请 {retry_after} 秒后重试" if retry_after else "服务繁忙，请稍后重试"
+                placeholder.error(error_msg)
+                return None, error_msg
+            if response.status_code != 200:
+                response.read()
+                error_msg = f"服务器错误 ({response.status_code}): {response.text}"
+                placeholder.error(error_msg)
+                return None, error_msg
+
+            last_render = 0.0
+
             # 创建临时的聊天消息容器用于流式显示
             with placeholder.chat_message("assistant"):
                 message_placeholder = st.empty()
-                
-                async for chunk in response.aiter_bytes():
-                    try:
-                        buffer += chunk.decode('utf-8')
-                        
-                        while '\n' in buffer:
-                            line, buffer = buffer.split('\n', 1)
-                            if not line.strip():
-                                continue
-                            
-                            try:
-                                data = json.loads(line)
-                                if isinstance(data, dict):
-                                    if data.get('status') == 200:
-                                        content = data.get('data', {}).get('content', '')
-                                        if content:
-                                            full_content += content
-                                            # 使用占位符更新内容
-                                            message_placeholder.markdown(full_content + "▌")
-                                            await asyncio.sleep(0.05)
-                                            
-                                    elif data.get('status') == 500:
-                                        error_msg = data.get('error', '未知错误')
-                                        print(f"服务错误: {error_msg}")
-                                        message_placeholder.markdown(f"服务器错误: {error_msg}")
-                                        return None, error_msg
-                            except json.JSONDecodeError as e:
-                                print(f"JSON解析错误: {str(e)}, 行内容: {line}")
-                                continue
-                    except UnicodeDecodeError as e:
-                        print(f"解码错误: {str(e)}")
-                        continue
-                
-                # 最后一次更新，移除光标
+
+                for event, data in iter_sse(response):
+                    if event == "message":
+                        chunks.append(data)
+                        # 按固定帧率合并刷新，不再每个片段都重绘整段 markdown
+                        now = time.monotonic()
+                        if now - last_render >= STREAM_FRAME_INTERVAL:
+                            message_placeholder.markdown("".join(chunks) + "▌")
+                            last_render = now
+                    elif event == "diagram":
+                        # 服务端检测到闭合的图表，趁模型继续生成时提前渲染，消息结束时直接命中缓存
+                        submit_render(json.loads(data)["code"], PREVIEW_FORMAT)
+                    elif event == "queue":
+                        # 请求仍在排队
+                        if not chunks:
+                            message_placeholder.markdown(f"排队中，前面还有 {int(data) - 1} 个请求...")
+                    elif event == "done":
+                        break
+
+                # 最后一帧间隔内到达的文本在这里补画，同时移除光标
+                full_content = "".join(chunks)
                 message_placeholder.markdown(full_content)
-                await asyncio.sleep(0.1)  # 短暂延迟确保最后的内容显示完成
                 return full_content, None
-                    
-        except Exception as e:
-            print(f"API请求错误: {str(e)}")
-            with placeholder.chat_message("assistant"):
-                st.error(f"发生错误: {str(e)}")
-            return None, str(e)
+                
+    except Exception as e:
+        print(f"API请求错误: {str(e)}")
+        with placeholder.chat_message("assistant"):
+            if chunks:
+                # 流中途出错：保留已收到（包括最后一帧尚未绘制）的文本，再显示错误
+                st.markdown("".join(chunks))
+            st.error(f"发生错误: {str(e)}")
+        return None, str(e)
 
 def main():
     # 在 header 区域添加按钮
@@ -404,6 +462,9 @@ def main():
             <div class="subtitle">Automated UML Generation</div>
         """, unsafe_allow_html=True)
     else:
+        # 先并发渲染全部图表，再绘制历史消息
+        prefetch_diagrams(st.session_state.messages)
+        
         # 显示所历史消息
         for idx, message in enumerate(st.session_state.messages):
             create_message_container(message["role"], message["content"], idx)
@@ -490,28 +551,23 @@ def main():
                 # 创建时占位符用于流式显示
                 temp_placeholder = create_empty_response_container()
                 
-                async def run_conversation():
-                    try:
-                        response, error = await get_bot_response(messages_history, temp_placeholder)
-                        return response, error
-                    except Exception as e:
-                        return None, f"处理响应时出错: {str(e)}"
-
-                # 运行异步任务获取完整响应
-                final_response, error = asyncio.run(run_conversation())
-                
+                # 获取完整响应（流式显示在占位符中）
+                try:
+                    final_response, error = get_bot_response(messages_history, temp_placeholder)
+                except Exception as e:
+                    final_response, error = None, f"处理响应时出错: {str(e)}"
+                    st.error(f"Error: {error}")
                 
-                # 清除临时占位符
-                temp_placeholder.empty()
                 
                 if final_response:
+                    # 清除临时占位符；出错时占位符里保留已收到的文本和错误信息
+                    temp_placeholder.empty()
                     print(f"收到完整响应: {final_response}")
                     # 将完整响应添到消息历史
                     st.session_state.messages.append({"role": "assistant", "content": final_response})
+                    prefetch_diagrams(st.session_state.messages[-1:], len(st.session_state.messages)-1)
                     # 创建新的消息容器并渲染代码段
                     create_message_container("assistant", final_response, len(st.session_state.messages)-1)
-                elif error:
-                    st.error(f"Error: {error}")
 
         except Exception as e:
             st.error(f"Error getting response from API: {str(e)}")
@@ -0,0 +1,66 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.uml_ast import parse_uml
+
+
+def test_floating_note_does_not_swallow_following_lines():
+    code = """@startuml
+note "Shared note" as N1
+class User {
+  +name: String
+}
+class Order
+User "1" --> "*" Order : places
+N1 .. User
+@enduml"""
+    diagram = parse_uml(code)
+    assert [c.name for c in diagram.classes] == ['User', 'Order']
+    assert [(r.source, r.target) for r in diagram.relationships][0] == ('User', 'Order')
+    assert len(diagram.notes) == 1
+    assert diagram.notes[0].end == diagram.notes[0].line
+
+
+def test_multiline_note_is_closed_by_end_note():
+    code = """@startuml
+class User
+note top of User
+  first line
+  second line
+end note
+class Order
+@enduml"""
+    diagram = parse_uml(code)
+    assert [c.name for c in diagram.classes] == ['User', 'Order']
+    assert diagram.notes[0].text.endswith('first line\nsecond line')
+    assert diagram.notes[0].end == 5
+
+
+def test_aliased_multiline_note_is_a_block():
+    code = """@startuml
+class User
+note as N1
+  class of users -> admins
+endnote
+N1 .. User
+@enduml"""
+    diagram = parse_uml(code)
+    assert [c.name for c in diagram.classes] == ['User']
+    assert diagram.notes[0].end == 4
+    assert [(r.source, r.target) for r in diagram.relationships] == [('N1', 'User')]
+
+
+def test_note_on_quoted_target_is_a_block():
+    code = """@startuml
+class BigClass
+note right of "BigClass"
+  class of users -> admins
+end note
+class Order
+@enduml"""
+    diagram = parse_uml(code)
+    assert [c.name for c in diagram.classes] == ['BigClass', 'Order']
+    assert diagram.notes[0].end == 4
+    assert diagram.relationships == []
@@ -0,0 +1,93 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import uml_edit
+from utils.uml_ast import _parse, _source_hash, parse_uml
+from utils.uml_edit import Patch, apply_patches
+
+CLASS_DIAGRAM = """@startuml
+class User {
+  +name: String
+  +login(): bool
+}
+note right of User
+  class of users -> admins
+end note
+class Order {
+  -id: int
+}
+User "1" --> "*" Order : places
+@enduml"""
+
+SEQUENCE_DIAGRAM = """@startuml
+participant "Web Server" as WS
+actor User
+User -> WS: request
+activate WS
+note over WS: handles it
+WS --> User: response
+deactivate WS
+@enduml"""
+
+# 插入的片段保持块完整，编辑后的源码大多没有未闭合的块，走增量解析
+_FRAGMENTS = [
+    ["class Extra {", "  +field: int", "}"], ["note left of Order", "  Order --> User", "end note"],
+    ["note as N1", "  class of users", "endnote"], ["Order --> User"], ['participant "Db" as DB'],
+    ["WS -> DB: query"], [""], ["' comment"], ["usecase Checkout"], ["class Plain"], ["  +field: int"],
+]
+
+
+def _dump(diagram):
+    def node(n):
+        values = {slot: getattr(n, slot) for slot in type(n).__slots__}
+        if 'members' in values:
+            values['members'] = [node(m) for m in values['members']]
+        return values
+    return {
+        'lines': diagram.lines,
+        'type': diagram.diagram_type,
+        'name_map': diagram.name_map,
+        'open_block': diagram.open_block,
+        **{name: [node(n) for n in getattr(diagram, name)]
+           for name in ('classes', 'relationships', 'participants', 'actors', 'usecases', 'notes')},
+    }
+
+
+def _assert_matches_full_parse(code):
+    assert _dump(parse_uml(code)) == _dump(_parse(code, _source_hash(code)))
+
+
+def test_edit_reports_changed_spans():
+    result = uml_edit.add_class(CLASS_DIAGRAM, "Item", [], [])
+    end = CLASS_DIAGRAM.split('\n').index('@enduml')
+    assert result.changed
+    assert result.spans == [(end, end, len("\nclass Item {\n}\n".split('\n')))]
+    _assert_matches_full_parse(result.code)
+
+
+def test_edit_inside_class_body_reparses_the_block():
+    result = uml_edit.modify_class(CLASS_DIAGRAM, "User", "Customer",
+                                   [{"visibility": "-", "name": "email", "type": "str"}], [])
+    diagram = parse_uml(result.code)
+    assert [c.name for c in diagram.classes] == ['Customer', 'Order']
+    assert [(r.source, r.target) for r in diagram.relationships] == [('Customer', 'Order')]
+    _assert_matches_full_parse(result.code)
+
+
+def test_random_patches_match_full_parse():
+    rng = random.Random(0)
+    for base in (CLASS_DIAGRAM, SEQUENCE_DIAGRAM):
+        code = base
+        for _ in range(300):
+            lines = code.split('\n')
+            start = rng.randrange(len(lines) + 1)
+            end = min(len(lines), start + rng.choice((0, 0, 1, 2)))
+            new = [line for _ in range(rng.choice((0, 1, 2))) for line in rng.choice(_FRAGMENTS)]
+            if start == end and not new:
+                continue
+            parse_uml(code)
+            code = apply_patches(code, [Patch(start, end, new)]).code
+            _assert_matches_full_parse(code)
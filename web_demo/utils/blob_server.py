@@ -0,0 +1,196 @@
+"""渲染结果的静态文件服务
+
+渲染后的图片按缓存键（规范化源码的哈希 + 格式）存放在渲染缓存中，键由内容决定，
+同一个键对应的图片永远不变。这里用一个轻量的 HTTP 服务按键提供这些图片，
+响应带有长期缓存头和 ETag，浏览器只需下载一次；页面中只放图片链接，
+不再把 base64 数据内联进每条消息。
+
+SVG 与 txt 按 Accept-Encoding 返回 brotli（安装了 brotli 时）或 gzip 压缩的版本，
+压缩结果同样写入渲染缓存，每张图只压缩一次。请求的格式尚未渲染过时
+（例如预览用 SVG、下载时才需要 PNG），按缓存中记下的源码当场渲染。
+
+多个 Streamlit 进程共用同一个缓存目录时，端口已被占用即认为其他进程已在提供服务。
+
+图片链接的地址取自 AUG_BLOB_PUBLIC_URL；未设置时按浏览器访问页面所用的主机名
+（Streamlit 会话的 Origin）拼出 http://<主机名>:<端口>。页面经 HTTPS 访问、
+又没有显式配置地址时无法安全地链接到本服务，调用方退回到由 Streamlit 传输图片。
+"""
+import gzip
+import importlib.util
+import os
+import re
+import threading
+from concurrent.futures import CancelledError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+from utils.render_cache import render_cache
+
+# 监听地址与端口，端口为 0 时不启动服务，页面退回到由 Streamlit 直接传输图片
+BLOB_HOST = os.environ.get("AUG_BLOB_HOST", "0.0.0.0")
+BLOB_PORT = int(os.environ.get("AUG_BLOB_PORT", "8502"))
+# 浏览器访问图片服务的地址（经反向代理或 HTTPS 访问时需要设置），未设置时按页面的主机名推断
+BLOB_PUBLIC_URL = os.environ.get("AUG_BLOB_PUBLIC_URL", "").rstrip("/")
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "txt": "text/plain; charset=utf-8",
+}
+_KEY_RE = re.compile(r"^/blob/(([0-9a-f]{64})\.(png|svg|txt))$")
+
+# 只压缩文本格式，PNG 本身已经是压缩过的
+COMPRESSIBLE_FORMATS = ("svg", "txt")
+# 未安装 brotli 时只提供 gzip
+BROTLI_AVAILABLE = importlib.util.find_spec("brotli") is not None
+
+
+def _compress(data, encoding):
+    if encoding == "br":
+        import brotli
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def compressed(key, data, encoding):
+    """渲染结果的压缩版本，以 <键>.<编码> 缓存"""
+    compressed_key = f"{key}.{encoding}"
+    content = render_cache.get(compressed_key)
+    if content is None:
+        content = _compress(data, encoding)
+        render_cache.put(compressed_key, content)
+    return content
+
+
+def load_blob(key, source_hash, format):
+    """从渲染缓存读取图片；缓存中只有源码时按需渲染该格式"""
+    data = render_cache.get(key)
+    if data is None:
+        source = render_cache.get(f"{source_hash}.puml")
+        if source is not None:
+            from utils.uml import get_uml_diagram, submit_render
+            code = source.decode("utf-8")
+            try:
+                rendered = submit_render(code, format).result()
+            except CancelledError:
+                # 共享的渲染任务被取消（例如线程池关闭），在当前线程直接渲染
+                rendered = get_uml_diagram(code, format)
+            if rendered is not None:
+                data = render_cache.get(key)
+    return data
+
+
+def _accepted_encoding(header):
+    accepted = {part.split(";", 1)[0].strip() for part in header.split(",")}
+    if BROTLI_AVAILABLE and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class BlobHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def _serve(self, send_body):
+        path, _, query = self.path.partition("?")
+        match = _KEY_RE.match(path)
+        if not match:
+            self.send_error(404)
+            return
+        key, source_hash, format = match.groups()
+        data = load_blob(key, source_hash, format)
+        if data is None:
+            self.send_error(404)
+            return
+
+        encoding = None
+        if format in COMPRESSIBLE_FORMATS:
+            encoding = _accepted_encoding(self.headers.get("Accept-Encoding", ""))
+            if encoding:
+                data = compressed(key, data, encoding)
+        # 不同编码的响应内容不同，ETag 也要区分
+        etag = f'"{key}.{encoding}"' if encoding else f'"{key}"'
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES[format])
+        self.send_header("Content-Length", str(len(data)))
+        if format in COMPRESSIBLE_FORMATS:
+            self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("ETag", etag)
+        # 同一个键的内容不会变化
+        self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        # 跨域链接上的 download 属性会被浏览器忽略，改由响应头指定下载文件名
+        filename = parse_qs(query).get("download")
+        if filename:
+            self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(filename[0])}")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+# 本进程或其他进程是否已在提供服务
+_serving = False
+
+
+def start_blob_server():
+    """在后台线程中启动图片服务（每个进程只尝试一次），返回服务是否可用"""
+    global _server, _serving
+    with _server_lock:
+        if _serving or BLOB_PORT == 0:
+            return _serving
+        try:
+            _server = ThreadingHTTPServer((BLOB_HOST, BLOB_PORT), BlobHandler)
+        except OSError as e:
+            print(f"图片服务端口 {BLOB_PORT} 已被占用，假定由其他进程提供服务: {str(e)}")
+        else:
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="blob-server", daemon=True).start()
+            print(f"图片服务已启动: {BLOB_HOST}:{BLOB_PORT}")
+        _serving = True
+        return _serving
+
+
+def public_base_url(origin=None):
+    """浏览器访问图片服务的根地址；origin 为浏览器打开页面时的 Origin（如 http://host:8501）
+
+    未显式配置且无法推断出可用的地址（没有 Origin，或页面经 HTTPS 访问）时返回 None。
+    """
+    if BLOB_PUBLIC_URL:
+        return BLOB_PUBLIC_URL
+    if not origin:
+        return None
+    parts = urlsplit(origin)
+    # 本服务只提供 HTTP，HTTPS 页面引用它会被浏览器当作混合内容拦截
+    if parts.scheme != "http" or not parts.hostname:
+        return None
+    host = f"[{parts.hostname}]" if ":" in parts.hostname else parts.hostname
+    return f"http://{host}:{BLOB_PORT}"
+
+
+def blob_url(key, download=None, origin=None):
+    """缓存键对应的图片地址，download 给出时浏览器会以该文件名下载；图片服务不可用时返回 None"""
+    base = public_base_url(origin)
+    if base is None or not start_blob_server():
+        return None
+    url = f"{base}/blob/{key}"
+    if download:
+        url += f"?download={quote(download)}"
+    return url
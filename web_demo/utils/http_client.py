@@ -0,0 +1,115 @@
+"""进程内共享的 HTTP 客户端
+
+LLM 服务与 PlantUML 服务器的请求都走带连接池的 httpx.Client：keep-alive 复用连接，
+安装了 h2 时启用 HTTP/2。连接失败、超时以及 429/502/503/504 响应按指数退避
+（带随机抖动）重试，服务端给出 Retry-After 时以它为准。
+
+流式 POST（LLM 生成）不是幂等的：请求一旦发出，服务端可能已经开始生成，
+因此只在连接阶段出错（请求尚未送达）或服务端明确拒绝（429/503）时重试。
+
+httpx.Client 是线程安全的，Streamlit 各个会话线程可以共用同一个实例。
+"""
+import contextlib
+import importlib.util
+import os
+import random
+import threading
+import time
+
+import httpx
+
+# 连接池上限与空闲连接保留时间（秒）
+HTTP_MAX_CONNECTIONS = int(os.environ.get("AUG_HTTP_MAX_CONNECTIONS", "32"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("AUG_HTTP_MAX_KEEPALIVE", "16"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("AUG_HTTP_KEEPALIVE_EXPIRY", "30"))
+# 重试次数，以及退避的初始与最大等待时间（秒）
+HTTP_RETRIES = int(os.environ.get("AUG_HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.environ.get("AUG_HTTP_BACKOFF", "0.5"))
+HTTP_BACKOFF_MAX = float(os.environ.get("AUG_HTTP_BACKOFF_MAX", "8"))
+
+# 未安装 h2 时 httpx 无法使用 HTTP/2
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+RETRY_STATUS = {429, 502, 503, 504}
+_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.ReadTimeout, httpx.RemoteProtocolError)
+# 流式请求只重试请求确定没有送达服务端的错误，以及服务端未处理就拒绝的状态码
+STREAM_RETRY_STATUS = {429, 503}
+_CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def create_client(timeout=None):
+    """创建带连接池的客户端；Streamlit 中应放在 st.cache_resource 里复用"""
+    return httpx.Client(
+        http2=HTTP2_AVAILABLE,
+        timeout=timeout or httpx.Timeout(30.0, connect=10.0),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def shared_client():
+    """进程内唯一的客户端，供不依赖 Streamlit 的模块（如渲染后端）使用"""
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = create_client()
+        return _shared_client
+
+
+def backoff_delay(attempt, retry_after=None):
+    """第 attempt 次重试前的等待时间：优先使用 Retry-After，否则为带完全抖动的指数退避"""
+    if retry_after:
+        try:
+            return min(float(retry_after), HTTP_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF * 2 ** attempt))
+
+
+def request_with_retry(client, method, url, retries=HTTP_RETRIES, **kwargs):
+    """发送请求，遇到可重试的错误或状态码时退避重试；返回最后一次的响应"""
+    for attempt in range(retries + 1):
+        try:
+            response = client.request(method, url, **kwargs)
+        except _RETRY_ERRORS:
+            if attempt == retries:
+                raise
+            time.sleep(backoff_delay(attempt))
+            continue
+        if response.status_code not in RETRY_STATUS or attempt == retries:
+            return response
+        time.sleep(backoff_delay(attempt, response.headers.get("retry-after")))
+
+
+@contextlib.contextmanager
+def stream_with_retry(client, method, url, retries=HTTP_RETRIES, **kwargs):
+    """流式请求：只在连接阶段出错或收到 429/503 时重试，拿到可用的响应后交给调用方逐块读取
+
+    读取超时、连接中途断开等错误直接抛出，不会重新发送请求；
+    响应交给调用方之后（已经开始接收正文）也不再重试。
+    """
+    for attempt in range(retries + 1):
+        try:
+            response = client.send(client.build_request(method, url, **kwargs), stream=True)
+        except _CONNECT_ERRORS:
+            if attempt == retries:
+                raise
+            time.sleep(backoff_delay(attempt))
+            continue
+        if response.status_code in STREAM_RETRY_STATUS and attempt < retries:
+            retry_after = response.headers.get("retry-after")
+            response.close()
+            time.sleep(backoff_delay(attempt, retry_after))
+            continue
+        try:
+            yield response
+        finally:
+            response.close()
+        return
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# 磁盘缓存目录，多个 Streamlit worker 指向同一目录即可共享
+CACHE_DIR = os.environ.get(
+    "AUG_UML_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aug_uml_cache")
+)
+# 进程内缓存的字节上限
+MEMORY_CACHE_MAX_BYTES = int(os.environ.get("AUG_UML_MEMORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# 记录渲染失败（语法错误）的键的数量上限
+FAILED_CACHE_MAX_ENTRIES = 1024
+
+
+def normalize_source(uml_code):
+    """规范化 PlantUML 源码：统一换行符，去掉行尾空白和首尾空行"""
+    text = uml_code.replace('\r\n', '\n').replace('\r', '\n')
+    return '\n'.join(line.rstrip() for line in text.split('\n')).strip()
+
+
+def source_hash(uml_code):
+    """规范化源码的内容哈希"""
+    return hashlib.sha256(normalize_source(uml_code).encode('utf-8')).hexdigest()
+
+
+def cache_key(uml_code, format='png'):
+    """缓存键：源码哈希 + 输出格式"""
+    return f"{source_hash(uml_code)}.{format}"
+
+
+class MemoryCache:
+    """按字节数淘汰的进程内 LRU 缓存"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self._items[key] = data
+            self.nbytes += len(data)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+
+class DiskCache:
+    """以缓存键为文件名的磁盘缓存，写入使用临时文件 + 原子替换"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, data):
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp_')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(key))
+        except OSError as e:
+            print(f"写入磁盘缓存失败: {str(e)}")
+
+
+class RenderCache:
+    """两级渲染缓存：先查内存，再查磁盘，磁盘命中后回填内存"""
+
+    def __init__(self, memory_max_bytes=MEMORY_CACHE_MAX_BYTES, directory=CACHE_DIR):
+        self.memory = MemoryCache(memory_max_bytes)
+        self.disk = DiskCache(directory)
+        # 渲染失败的键只记在内存里，源码不变时不再重复请求
+        self._failed = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        data = self.memory.get(key)
+        if data is None:
+            data = self.disk.get(key)
+            if data is not None:
+                self.memory.put(key, data)
+        return data
+
+    def contains(self, key):
+        """是否已有该键的内容（只检查是否存在，不读取磁盘文件）"""
+        return self.memory.get(key) is not None or self.disk.contains(key)
+
+    def put(self, key, data):
+        self.memory.put(key, data)
+        self.disk.put(key, data)
+
+    def mark_failed(self, key):
+        with self._lock:
+            self._failed[key] = True
+            if len(self._failed) > FAILED_CACHE_MAX_ENTRIES:
+                self._failed.popitem(last=False)
+
+    def is_failed(self, key):
+        with self._lock:
+            return key in self._failed
+
+
+render_cache = RenderCache()
@@ -1,10 +1,203 @@
-import requests
-import base64
 from plantuml import PlantUML
+import functools
+import os
+import queue
 import re
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from utils.http_client import request_with_retry, shared_client
+from utils.render_cache import render_cache, cache_key, source_hash
+from utils.uml_ast import parse_uml
+
+# 渲染后端：http（PlantUML 服务器）或 local（常驻本地 plantuml.jar 进程）
+PLANTUML_BACKEND = os.environ.get("AUG_PLANTUML_BACKEND", "http")
+# local 后端使用的 plantuml.jar 路径与单次渲染超时（秒）
+PLANTUML_JAR = os.environ.get(
+    "AUG_PLANTUML_JAR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "puml_serve", "plantuml.jar")
+)
+PLANTUML_TIMEOUT = float(os.environ.get("AUG_PLANTUML_TIMEOUT", "30"))
+# 批量渲染时的并发线程数
+RENDER_WORKERS = int(os.environ.get("AUG_RENDER_WORKERS", "8"))
+# 非确定性的渲染失败（超时、服务器不可用）之后，多久内不再自动重试（秒）
+RENDER_ERROR_COOLDOWN = float(os.environ.get("AUG_RENDER_ERROR_COOLDOWN", "30"))
+# 代码编辑模式下，最后一次修改之后等待多久（秒）没有新的修改才开始渲染
+PREVIEW_DEBOUNCE = float(os.environ.get("AUG_PREVIEW_DEBOUNCE", "0.6"))
+
+# 支持的输出格式：png、svg 与 txt（ASCII 字符图）
+RENDER_FORMATS = ("png", "svg", "txt")
+# 预览使用的格式：框线类图表的 SVG 通常比 PNG 小得多，PNG 只在下载时按需渲染
+PREVIEW_FORMAT = os.environ.get("AUG_PREVIEW_FORMAT", "svg")
 
 # 初始化 PlantUML
-plantuml = PlantUML(url='http://www.plantuml.com/plantuml/png/')
+plantuml = PlantUML(url=os.environ.get("AUG_PLANTUML_URL", 'http://www.plantuml.com/plantuml/png/'))
+
+
+class RenderError(Exception):
+    """渲染失败且结果确定（如语法错误），重试也不会成功"""
+
+
+class RenderBackend:
+    """渲染后端接口"""
+
+    def get_url(self, uml_code, format='png'):
+        """返回可直接访问的图片 URL，没有则返回 None"""
+        return None
+
+    def render(self, uml_code, format='png'):
+        """渲染并返回图片字节"""
+        raise NotImplementedError
+
+
+class HttpRenderBackend(RenderBackend):
+    """通过 HTTP 请求 PlantUML 服务器（plantuml.com 或 puml_serve）渲染"""
+
+    _FORMAT_PATH_RE = re.compile(r"/(?:png|svg|txt)/?$")
+
+    def __init__(self, server):
+        self.server = server
+        # 服务器根地址（去掉配置中末尾的 /png/ 等格式路径），按输出格式拼接
+        self.root = self._FORMAT_PATH_RE.sub("", server.url).rstrip("/")
+        # 进程内共享的连接池，复用 keep-alive 连接
+        self.client = shared_client()
+
+    def get_url(self, uml_code, format='png'):
+        encoded = self.server.get_url(uml_code)[len(self.server.url):]
+        return f"{self.root}/{format}/{encoded}"
+
+    def render(self, uml_code, format='png'):
+        url = self.get_url(uml_code, format)
+        print(f"PlantUML URL: {url}")  # 打印 URL
+        
+        # 连接失败与 5xx 会退避重试
+        response = request_with_retry(self.client, "GET", url, timeout=PLANTUML_TIMEOUT)
+        print(f"HTTP 状态码: {response.status_code}")  # 打印状态码
+        
+        if response.status_code == 200:
+            return response.content
+        
+        print(f"请求失败: {response.text}")  # 打印失败原因
+        # 只有 400（语法错误）的结果是确定的；408、429 等是暂时性错误，冷却后可以重试
+        if response.status_code == 400:
+            raise RenderError(response.text)
+        raise RuntimeError(f"PlantUML 服务器返回 {response.status_code}")
+
+
+class LocalRenderBackend(RenderBackend):
+    """常驻的本地 plantuml.jar 进程（-pipe 模式），通过 stdin/stdout 传输图表
+
+    每种输出格式一个 JVM 进程，避免每张图都启动 JVM，也没有网络往返。
+    """
+
+    DELIMITER = b"___AUG_PLANTUML_DELIMITER___"
+    _ENDUML_RE = re.compile(r"^[ \t]*@enduml\b.*$", re.IGNORECASE | re.MULTILINE)
+
+    def __init__(self, jar_path, java="java", timeout=PLANTUML_TIMEOUT):
+        self.jar_path = jar_path
+        self.java = java
+        self.timeout = timeout
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def _start(self, format):
+        process = subprocess.Popen(
+            [
+                self.java, "-Djava.awt.headless=true", "-jar", self.jar_path,
+                "-pipe", "-pipeNoStderr",
+                "-pipedelimitor", self.DELIMITER.decode(),
+                "-charset", "UTF-8", f"-t{format}"
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        # 后台线程持续读取 stdout，主线程可以带超时地等待输出
+        chunks = queue.Queue()
+
+        def pump():
+            while True:
+                chunk = process.stdout.read1(65536)
+                chunks.put(chunk)
+                if not chunk:
+                    break
+
+        threading.Thread(target=pump, daemon=True).start()
+        print(f"已启动本地 PlantUML 进程 (pid={process.pid}, format={format})")
+        return {"process": process, "chunks": chunks, "buffer": b"", "lock": threading.Lock()}
+
+    def _get_process(self, format):
+        with self._lock:
+            state = self._processes.get(format)
+            if state is None or state["process"].poll() is not None:
+                state = self._start(format)
+                self._processes[format] = state
+            return state
+
+    def _kill(self, format, state):
+        state["process"].kill()
+        with self._lock:
+            if self._processes.get(format) is state:
+                del self._processes[format]
+
+    def render(self, uml_code, format='png'):
+        # pipe 模式遇到 @enduml 才会输出，缺少时进程会一直等待
+        end = self._ENDUML_RE.search(uml_code)
+        if end is None:
+            raise RenderError("缺少 @enduml")
+        # 每个 @startuml 块各输出一张图，多出的输出会错位到之后的请求上；
+        # 与 PlantUML 服务器一致，只渲染第一个块
+        uml_code = uml_code[:end.end()]
+        
+        state = self._get_process(format)
+        with state["lock"]:
+            try:
+                state["process"].stdin.write(uml_code.encode('utf-8') + b"\n")
+                state["process"].stdin.flush()
+                data = self._read_until_delimiter(state)
+                if state["buffer"].strip():
+                    raise RuntimeError("本地 PlantUML 输出与请求不对应")
+            except Exception:
+                # 进程崩溃、卡住或输出错位，丢弃缓冲区，下次调用时重新启动
+                state["buffer"] = b""
+                self._kill(format, state)
+                raise
+        
+        if data.startswith(b"ERROR"):
+            raise RenderError(data.decode('utf-8', errors='replace'))
+        return data
+
+    def _read_until_delimiter(self, state):
+        buffer = state["buffer"]
+        while self.DELIMITER not in buffer:
+            try:
+                chunk = state["chunks"].get(timeout=self.timeout)
+            except queue.Empty:
+                raise TimeoutError("本地 PlantUML 渲染超时")
+            if not chunk:
+                raise RuntimeError("本地 PlantUML 进程已退出")
+            buffer += chunk
+        data, _, rest = buffer.partition(self.DELIMITER)
+        state["buffer"] = rest.lstrip(b"\r\n")
+        return data.rstrip(b"\r\n")
+
+
+_render_backend = None
+_render_backend_lock = threading.Lock()
+
+
+def get_render_backend():
+    """按 AUG_PLANTUML_BACKEND 创建（并复用）渲染后端"""
+    global _render_backend
+    with _render_backend_lock:
+        if _render_backend is None:
+            if PLANTUML_BACKEND == "local":
+                _render_backend = LocalRenderBackend(PLANTUML_JAR)
+            else:
+                _render_backend = HttpRenderBackend(plantuml)
+        return _render_backend
 
 def create_usecase_template():
     """创建用例图的基本模板"""
@@ -31,166 +224,193 @@ skinparam maxMessageSize 200
 
 def get_existing_participants(code):
     """从 PlantUML 代码中提取现有的参与者和 actor"""
-    participants = []
-    lines = code.split('\n')
-    for line in lines:
-        line = line.strip()
-        # 检查所有可能的参与者类型
-        if any(line.startswith(prefix) for prefix in [
-            'participant ', 'actor ', 'boundary ', 
-            'control ', 'entity ', 'database '
-        ]):
-            # 提取参与者类型
-            participant_type = line.split(' ')[0]
-            
-            # 处理带引号的名称
-            name_match = re.search(r'"([^"]+)"', line)
-            if name_match:
-                original_name = name_match.group(1)
-                
-                # 检查是否有别名
-                if ' as ' in line:
-                    # 别名在 as 之后
-                    alias = line.split(' as ')[-1].strip()
-                    participants.append((original_name, participant_type))
-                else:
-                    participants.append((original_name, participant_type))
-            else:
-                # 处理不带引号的情况
-                parts = line.split(' ')
-                if len(parts) >= 2:
-                    name = parts[1].strip()
-                    participants.append((name, participant_type))
-    
-    return participants
+    return [(p.name, p.kind) for p in parse_uml(code).participants]
 
 def get_name_mapping(code):
     """获取名称映射（别名到原始名称）"""
-    name_map = {}
-    lines = code.split('\n')
-    for line in lines:
-        line = line.strip()
-        # 检查所有可能的参与者类型
-        if any(line.startswith(prefix) for prefix in [
-            'participant ', 'actor ', 'boundary ', 
-            'control ', 'entity ', 'database '
-        ]):
-            # 提取带引号的名称
-            name_match = re.search(r'"([^"]+)"', line)
-            if name_match and ' as ' in line:
-                original_name = name_match.group(1)
-                alias = line.split(' as ')[-1].strip()
-                name_map[alias] = original_name
-    return name_map
+    return dict(parse_uml(code).name_map)
 
 
 
 def get_uml_diagram(uml_code, format='png'):
-    """生成 PlantUML 图表并返回 URL 和原始数据"""
+    """生成 PlantUML 图表，返回 URL 与缓存键（图片数据通过 render_cache 或图片服务获取）"""
     try:
-        print("开始生成 UML 图...")  # 打印开始
-        url = plantuml.get_url(uml_code)
-        print(f"PlantUML URL: {url}")  # 打印 URL
-        
-
-        
-        response = requests.get(url)
-        print(f"HTTP 状态码: {response.status_code}")  # 打印状态码
+        backend = get_render_backend()
+        key = cache_key(uml_code, format)
         
-        if response.status_code == 200:
-            result = {
-                'url': url,
-                'data': base64.b64encode(response.content).decode('utf-8'),
-                'format': format
-            }
+        # 源码未变化时直接使用缓存，不重新渲染
+        content = render_cache.get(key)
+        if content is None:
+            if render_cache.is_failed(key):
+                return None
+            
+            print("开始生成 UML 图...")  # 打印开始
+            try:
+                content = backend.render(uml_code, format)
+            except RenderError as e:
+                print(f"渲染失败: {str(e)}")
+                # 确定性的失败，记住它避免重复渲染
+                render_cache.mark_failed(key)
+                return None
+            
+            if format == 'svg':
+                content = minify_svg(content)
+            render_cache.put(key, content)
             print("图像生成成功")  # 打印成功
-            return result
         
-        print(f"请求失败: {response.text}")  # 打印失败原因
-        return None
+        return _diagram_result(backend, uml_code, format)
     except Exception as e:
         print(f"生成图表错误: {str(e)}")  # 打印错误
         return None
 
+_SVG_SOURCE_RE = re.compile(rb"<\?plantuml-src [^?]*\?>")
+# 一次扫描：文本节点中的空白（如 <tspan> 之间的空格）以及样式、脚本内容都有意义，整段原样保留；
+# 其余部分去掉注释和标签之间的空白
+_SVG_MINIFY_RE = re.compile(
+    rb"(<(text|tspan|style|script)\b.*?</\2\s*>)|<!--.*?-->|(?<=>)\s+(?=<)",
+    re.DOTALL
+)
+
+
+def minify_svg(content):
+    """去掉 PlantUML 嵌入的源码、注释以及标签之间的空白，文本、样式和脚本元素的内容不动"""
+    content = _SVG_SOURCE_RE.sub(b"", content)
+    return _SVG_MINIFY_RE.sub(lambda match: match.group(1) or b"", content).strip()
+
+
+def _diagram_result(backend, uml_code, format):
+    """图片本身留在渲染缓存中，结果里只有缓存键和地址，页面通过图片服务按键加载"""
+    key = cache_key(uml_code, format)
+    # 记下源码，图片服务可以按同一哈希按需渲染其他格式（如下载用的 PNG）
+    source_key = cache_key(uml_code, 'puml')
+    if render_cache.get(source_key) is None:
+        render_cache.put(source_key, uml_code.encode('utf-8'))
+    return {
+        'url': backend.get_url(uml_code, format),
+        'hash': source_hash(uml_code),
+        'key': key,
+        'format': format
+    }
+
+_render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="uml-render")
+# 正在渲染的图表：同一份源码在渲染完成前再次请求时复用同一个 Future
+_inflight = {}
+# 最近一次非确定性失败的时间，冷却期内 peek_uml_diagram 不会重新提交
+_recent_errors = {}
+_inflight_lock = threading.Lock()
+
+
+def _forget(key, done):
+    """渲染结束：移出 _inflight，并记录或清除非确定性失败"""
+    with _inflight_lock:
+        if _inflight.get(key) is done:
+            del _inflight[key]
+        if done.cancelled():
+            return
+        if done.result() is None and not render_cache.is_failed(key):
+            _recent_errors[key] = time.monotonic()
+        else:
+            _recent_errors.pop(key, None)
+
+
+def submit_render(uml_code, format='png'):
+    """在后台线程中渲染图表（结果写入渲染缓存），返回 Future"""
+    key = cache_key(uml_code, format)
+    if render_cache.contains(key) or render_cache.is_failed(key):
+        # 已有结果或确定失败：不占用渲染线程，直接返回已完成的 Future
+        future = Future()
+        future.set_result(get_uml_diagram(uml_code, format))
+        return future
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is not None:
+            return future
+        future = _render_executor.submit(get_uml_diagram, uml_code, format)
+        _inflight[key] = future
+    # 必须在释放锁之后注册：任务已完成时回调在当前线程立即执行，而回调要获取同一把锁
+    future.add_done_callback(functools.partial(_forget, key))
+    return future
+
+
+def peek_uml_diagram(uml_code, format='png', submit=True):
+    """不阻塞地获取图表，返回 (状态, 结果)
+
+    状态为 ready（结果可用）、failed（渲染失败）或 pending（已在后台渲染，稍后再查）。
+    submit 为 False 时只查看结果，不提交新的渲染（例如仍在防抖等待中）。
+    """
+    key = cache_key(uml_code, format)
+    content = render_cache.get(key)
+    if content is not None:
+        return 'ready', _diagram_result(get_render_backend(), uml_code, format)
+    if render_cache.is_failed(key):
+        return 'failed', None
+    with _inflight_lock:
+        failed_at = _recent_errors.get(key)
+    if failed_at is not None and time.monotonic() - failed_at < RENDER_ERROR_COOLDOWN:
+        return 'failed', None
+    if submit:
+        future = submit_render(uml_code, format)
+    else:
+        with _inflight_lock:
+            future = _inflight.get(key)
+    if future is None or not future.done() or future.cancelled():
+        return 'pending', None
+    result = future.result()
+    return ('ready', result) if result else ('failed', None)
+
+
+class DebouncedRenderer:
+    """合并同一编辑器（slot）的连续修改，安静期内没有新的修改才提交渲染
+
+    新的修改只取消尚未触发的计时器。已经提交的渲染不取消：_inflight 中的 Future
+    可能同时被其他会话或 blob 服务等待；旧版本的结果照常写入缓存，
+    预览只查询最新源码的缓存键，过期的结果自然被丢弃。
+    """
+
+    def __init__(self, delay=PREVIEW_DEBOUNCE):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._timers = {}
+
+    def schedule(self, slot, uml_code, format='png'):
+        key = cache_key(uml_code, format)
+        with self._lock:
+            timer = self._timers.pop(slot, None)
+            if timer is not None:
+                timer.cancel()
+            if render_cache.get(key) is not None or render_cache.is_failed(key):
+                return
+            timer = threading.Timer(self.delay, self._fire, (slot, uml_code, format))
+            timer.daemon = True
+            self._timers[slot] = timer
+            timer.start()
+
+    def _fire(self, slot, uml_code, format):
+        with self._lock:
+            # 计时器已被更新的修改取代
+            if self._timers.get(slot) is not threading.current_thread():
+                return
+            del self._timers[slot]
+        submit_render(uml_code, format)
+
+    def scheduled(self, slot):
+        """该 slot 是否还在等待安静期结束"""
+        with self._lock:
+            return slot in self._timers
+
+
 def get_existing_classes(code):
     """从 PlantUML 代码中提取现有的类名"""
-    classes = []
-    lines = code.split('\n')
-    for line in lines:
-        line = line.strip()
-        if line.startswith('class '):
-            class_name = line.split(' ')[1].split('{')[0].split('<')[0].strip()
-            classes.append(class_name)
-    return classes 
+    return [c.name for c in parse_uml(code).classes if c.kind == 'class']
 
 def get_diagram_type(code):
     """检测 UML 图表类型"""
-    code_lower = code.lower()
-    if '@startuml' not in code_lower:
-        return None
-    
-    # 类图特征
-    has_class = 'class ' in code_lower and '{' in code_lower
-    
-    # 时序图特征
-    has_participant = any(keyword in code_lower for keyword in ['participant ','boundary ', 'control ', 'entity ', 'database ','alt'])
-    has_message = '->' in code_lower or '<-' in code_lower
-    
-    # 用例图特征
-    has_usecase = 'usecase ' in code_lower or 'rectangle' in code_lower
-    
-    # 判断图表类型
-    if has_class:
-        return "class"
-    elif has_participant and has_message:
-        return "sequence"
-    elif has_usecase:
-        return "usecase"
-    
-    return None
+    return parse_uml(code).diagram_type
 
 def get_existing_actors(code):
     """从 PlantUML 代码中提取现有的 Actor"""
-    actors = []
-    lines = code.split('\n')
-    for line in lines:
-        line = line.strip()
-        if line.startswith('actor '):
-            # 处理带 as 的情况
-            parts = line.split(' as ')
-            if len(parts) == 2:
-                # 提取原始名称（���能带引号）
-                first_part = parts[0].split(' ', 1)
-                if len(first_part) >= 2:
-                    actor_name = first_part[1].strip('"')
-                    actors.append(actor_name)
-            else:
-                # 处理不带 as 的情况
-                parts = line.split(' ', 2)
-                if len(parts) >= 2:
-                    actor_name = parts[1].strip('"')
-                    actors.append(actor_name)
-    return actors
+    return [a.name for a in parse_uml(code).actors]
 
 def get_existing_usecases(code):
     """从 PlantUML 代码中提取现有的用例"""
-    usecases = []
-    lines = code.split('\n')
-    for line in lines:
-        line = line.strip()
-        if line.startswith('usecase '):
-            # 处理带 as 的情况
-            parts = line.split(' as ')
-            if len(parts) == 2:
-                # 提取原始名称（可能带引号）
-                first_part = parts[0].split(' ', 1)
-                if len(first_part) >= 2:
-                    usecase_name = first_part[1].strip('"')
-                    usecases.append(usecase_name)
-            else:
-                # 处理不带 as 的情况
-                match = re.search(r'usecase\s*"([^"]+)"', line)
-                if match:
-                    usecase_name = match.group(1)
-                    usecases.append(usecase_name)
-    return usecases
\ No newline at end of file
+    return [u.name for u in parse_uml(code).usecases]
@@ -0,0 +1,416 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+# 解析结果缓存的条目上限
+PARSE_CACHE_MAX_ENTRIES = 256
+
+PARTICIPANT_KEYWORDS = ['participant', 'actor', 'boundary', 'control', 'entity', 'database']
+CLASS_KEYWORDS = ['abstract class', 'class', 'interface', 'enum', 'abstract']
+VISIBILITY_CHARS = ['+', '-', '#']
+
+# 关系/消息的端点：带引号的名称、(用例)、:Actor:、普通标识符
+_OPERAND = r'(?:"[^"]+"|\([^)]+\)|:[^:\s][^:]*:|[\w.$]+)'
+# 箭头：至少包含一个 - 或 .，两端可带箭头符号；o/x 只在不与名称相连时视为箭头符号
+_ARROW_HEAD = r'(?:[<>|*#+^}{/\\]|(?<!\w)[ox](?!\w))*'
+_ARROW = (
+    _ARROW_HEAD
+    + r'[-.]+(?:\[[^\]]*\][-.]*)?(?:(?:up|down|left|right|u|d|l|r)[-.]+)?'
+    + r'(?:[<>|*#+^}{/\\]|[ox](?!\w))*'
+)
+_RELATION_RE = re.compile(
+    rf'^(?P<source>{_OPERAND})\s*'
+    rf'(?:"(?P<source_mult>[^"]*)"\s*)?'
+    rf'(?P<arrow>{_ARROW})\s*'
+    rf'(?:"(?P<target_mult>[^"]*)"\s*)?'
+    rf'(?P<target>{_OPERAND})'
+    rf'\s*(?::\s*(?P<label>.*))?$'
+)
+_SEPARATOR_RE = re.compile(r'^[-.=_]{2,}')
+# 浮动注释 note "text" as N1 只占一行
+_FLOATING_NOTE_RE = re.compile(r'^note\s+"[^"]*"\s+as\s+\S+$')
+_QUOTED_RE = re.compile(r'"[^"]*"')
+# 多行注释块只由 end note（或 endnote）结束
+_END_NOTE_RE = re.compile(r'^end\s?note$')
+
+
+def _unquote(name):
+    """去掉端点两侧的引号、括号或冒号"""
+    if len(name) >= 2 and (name[0], name[-1]) in (('"', '"'), ('(', ')'), (':', ':')):
+        return name[1:-1]
+    return name
+
+
+class Member:
+    """类的属性或方法"""
+    __slots__ = ('visibility', 'name', 'type', 'params', 'is_method', 'line')
+
+    def __init__(self, visibility, name, type_, params, is_method, line):
+        self.visibility = visibility
+        self.name = name
+        self.type = type_
+        self.params = params
+        self.is_method = is_method
+        self.line = line
+
+    def to_dict(self):
+        """转换为编辑器使用的字典格式"""
+        if self.is_method:
+            return {
+                "visibility": self.visibility,
+                "name": self.name,
+                "return_type": self.type,
+                "params": self.params
+            }
+        return {"visibility": self.visibility, "name": self.name, "type": self.type}
+
+
+class ClassDef:
+    """类定义；line/end 为定义块起止行号（end 为 None 表示没有类体）"""
+    __slots__ = ('kind', 'name', 'members', 'line', 'end')
+
+    def __init__(self, kind, name, line):
+        self.kind = kind
+        self.name = name
+        self.members = []
+        self.line = line
+        self.end = None
+
+    @property
+    def attributes(self):
+        return [m for m in self.members if not m.is_method]
+
+    @property
+    def methods(self):
+        return [m for m in self.members if m.is_method]
+
+
+class Relationship:
+    """带箭头的连线：类图/用例图中的关系，或时序图中的消息"""
+    __slots__ = ('source', 'arrow', 'target', 'label', 'source_mult', 'target_mult', 'line', 'text')
+
+    def __init__(self, source, arrow, target, label, source_mult, target_mult, line, text):
+        self.source = source
+        self.arrow = arrow
+        self.target = target
+        self.label = label
+        self.source_mult = source_mult
+        self.target_mult = target_mult
+        self.line = line
+        self.text = text
+
+
+class Participant:
+    """时序图参与者（participant/actor/boundary/control/entity/database）"""
+    __slots__ = ('kind', 'name', 'alias', 'line')
+
+    def __init__(self, kind, name, alias, line):
+        self.kind = kind
+        self.name = name
+        self.alias = alias
+        self.line = line
+
+
+class Element:
+    """用例图中的 actor 或 usecase"""
+    __slots__ = ('kind', 'name', 'alias', 'line')
+
+    def __init__(self, kind, name, alias, line):
+        self.kind = kind
+        self.name = name
+        self.alias = alias
+        self.line = line
+
+
+class Note:
+    """注释块；单行注释的 end 与 line 相同"""
+    __slots__ = ('text', 'line', 'end')
+
+    def __init__(self, text, line, end):
+        self.text = text
+        self.line = line
+        self.end = end
+
+
+class Diagram:
+    """一张 PlantUML 图的结构化表示"""
+    __slots__ = (
+        'source_hash', 'lines', 'diagram_type', 'classes', 'relationships',
+        'participants', 'actors', 'usecases', 'notes', 'name_map', 'open_block'
+    )
+
+    def __init__(self, source_hash, lines):
+        self.source_hash = source_hash
+        self.lines = lines
+        self.diagram_type = None
+        self.classes = []
+        self.relationships = []
+        self.participants = []
+        self.actors = []
+        self.usecases = []
+        self.notes = []
+        # 参与者别名 -> 原始名称
+        self.name_map = {}
+        # 源码结束时仍有未闭合的类体或注释块
+        self.open_block = False
+
+    @property
+    def messages(self):
+        """时序图中的消息（带文本的连线）"""
+        return [r for r in self.relationships if r.label is not None]
+
+    def get_class(self, name):
+        return next((c for c in self.classes if c.name == name), None)
+
+    def aliases_of(self, name):
+        """某个元素的所有标识符（原始名称及别名）"""
+        names = {name}
+        for node in self.participants + self.actors + self.usecases:
+            if node.name == name and node.alias:
+                names.add(node.alias)
+        return names
+
+
+def detect_diagram_type(code):
+    """根据关键字检测图表类型（class / sequence / usecase）"""
+    code_lower = code.lower()
+    if '@startuml' not in code_lower:
+        return None
+
+    # 类图特征
+    has_class = 'class ' in code_lower and '{' in code_lower
+
+    # 时序图特征
+    has_participant = any(keyword in code_lower for keyword in ['participant ','boundary ', 'control ', 'entity ', 'database ','alt'])
+    has_message = '->' in code_lower or '<-' in code_lower
+
+    # 用例图特征
+    has_usecase = 'usecase ' in code_lower or 'rectangle' in code_lower
+
+    if has_class:
+        return "class"
+    elif has_participant and has_message:
+        return "sequence"
+    elif has_usecase:
+        return "usecase"
+    return None
+
+
+def _parse_member(item, line):
+    vis = item[0] if item[0] in VISIBILITY_CHARS else '+'
+    body = item[1:] if item[0] in VISIBILITY_CHARS else item
+    if '(' in body:
+        open_idx = body.index('(')
+        close_idx = body.find(')', open_idx)
+        if close_idx < 0:
+            close_idx = len(body)
+        rest = body[close_idx + 1:]
+        return_type = rest.split(':', 1)[1].strip() if ':' in rest else ""
+        return Member(vis, body[:open_idx].strip(), return_type, body[open_idx + 1:close_idx], True, line)
+    if ':' in body:
+        name, type_ = body.split(':', 1)
+        return Member(vis, name.strip(), type_.strip(), "", False, line)
+    return Member(vis, body.strip(), "", "", False, line)
+
+
+def _parse_named(stripped):
+    """解析 `keyword "名称" as 别名` 形式的声明，返回 (名称, 别名)"""
+    alias = stripped.split(' as ')[-1].strip() if ' as ' in stripped else None
+    name_match = re.search(r'"([^"]+)"', stripped)
+    if name_match:
+        return name_match.group(1), alias
+    head = stripped.split(' as ')[0] if alias else stripped
+    parts = head.split(' ', 2)
+    return (parts[1].strip().strip('"') if len(parts) >= 2 else ''), alias
+
+
+def _scan(diagram, lines, start, stop):
+    """解析 lines[start:stop]（start 处不在类体或注释块内），节点追加到 diagram；
+    返回结束时是否仍有未闭合的类体或注释块"""
+    current_class = None
+    current_note = None
+
+    for i in range(start, stop):
+        stripped = lines[i].strip()
+        if not stripped or stripped.startswith("'"):
+            continue
+
+        # 多行注释块
+        if current_note is not None:
+            if _END_NOTE_RE.match(stripped):
+                current_note.end = i
+                current_note = None
+            else:
+                current_note.text += ('\n' if current_note.text else '') + stripped
+            continue
+
+        # 类体
+        if current_class is not None:
+            if stripped == '}':
+                current_class.end = i
+                current_class = None
+            elif not _SEPARATOR_RE.match(stripped):
+                current_class.members.append(_parse_member(stripped, i))
+            continue
+
+        keyword = stripped.split(' ')[0]
+
+        class_kind = next((k for k in CLASS_KEYWORDS if stripped.startswith(k + ' ')), None)
+        if class_kind is not None:
+            rest = stripped[len(class_kind) + 1:]
+            name = rest.split(' ')[0].split('{')[0].split('<')[0].strip()
+            class_def = ClassDef(class_kind, name, i)
+            diagram.classes.append(class_def)
+            if '{' in stripped and not stripped.endswith('}'):
+                current_class = class_def
+            elif '{' in stripped:
+                class_def.end = i
+            continue
+
+        if keyword in PARTICIPANT_KEYWORDS and ' ' in stripped:
+            name, alias = _parse_named(stripped)
+            quoted = re.search(r'"([^"]+)"', stripped) is not None
+            if not quoted:
+                name = stripped.split(' ')[1].strip()
+            diagram.participants.append(Participant(keyword, name, alias, i))
+            if keyword == 'actor':
+                diagram.actors.append(Element('actor', _parse_named(stripped)[0], alias, i))
+            continue
+
+        if keyword == 'usecase':
+            name, alias = _parse_named(stripped)
+            diagram.usecases.append(Element('usecase', name, alias, i))
+            continue
+
+        if keyword == 'note':
+            # 目标之后带 ':' 的注释（引号内的 ':' 不算）和浮动注释是单行的，
+            # 其余（如 note as N1、note right of "Big Class"）开启多行注释块
+            if ':' in _QUOTED_RE.sub('', stripped) or _FLOATING_NOTE_RE.match(stripped):
+                diagram.notes.append(Note(stripped, i, i))
+            else:
+                current_note = Note(stripped, i, None)
+                diagram.notes.append(current_note)
+            continue
+
+        match = _RELATION_RE.match(stripped)
+        if match and match.group('arrow'):
+            diagram.relationships.append(Relationship(
+                _unquote(match.group('source')),
+                match.group('arrow'),
+                _unquote(match.group('target')),
+                match.group('label'),
+                match.group('source_mult'),
+                match.group('target_mult'),
+                i,
+                stripped
+            ))
+
+    return current_class is not None or current_note is not None
+
+
+def _name_map(diagram):
+    """带引号名称的参与者：别名 -> 原始名称"""
+    return {
+        p.alias: p.name for p in diagram.participants
+        if p.alias and re.search(r'"([^"]+)"', diagram.lines[p.line])
+    }
+
+
+def _parse(code, source_hash):
+    lines = code.split('\n')
+    diagram = Diagram(source_hash, lines)
+    diagram.open_block = _scan(diagram, lines, 0, len(lines))
+    diagram.name_map = _name_map(diagram)
+    diagram.diagram_type = detect_diagram_type(code)
+    return diagram
+
+
+_parse_cache = OrderedDict()
+_parse_lock = threading.Lock()
+
+_NODE_LISTS = ('classes', 'relationships', 'participants', 'actors', 'usecases', 'notes')
+
+
+def _source_hash(code):
+    return hashlib.sha1(code.encode('utf-8')).hexdigest()
+
+
+def _cached(source_hash):
+    with _parse_lock:
+        diagram = _parse_cache.get(source_hash)
+        if diagram is not None:
+            _parse_cache.move_to_end(source_hash)
+        return diagram
+
+
+def _cache_put(diagram):
+    with _parse_lock:
+        _parse_cache[diagram.source_hash] = diagram
+        if len(_parse_cache) > PARSE_CACHE_MAX_ENTRIES:
+            _parse_cache.popitem(last=False)
+    return diagram
+
+
+def parse_uml(code):
+    """把 PlantUML 源码解析为 Diagram；按源码哈希缓存，同一份源码只解析一次
+
+    返回的 Diagram 在多次调用间共享，调用方不应修改它。
+    """
+    source_hash = _source_hash(code)
+    diagram = _cached(source_hash)
+    if diagram is not None:
+        return diagram
+    return _cache_put(_parse(code, source_hash))
+
+
+def _shift(node, delta):
+    """行号平移 delta 后的节点副本（原节点属于共享的 Diagram，不能修改）"""
+    if delta == 0:
+        return node
+    moved = object.__new__(type(node))
+    for slot in type(node).__slots__:
+        setattr(moved, slot, getattr(node, slot))
+    moved.line += delta
+    if isinstance(node, (ClassDef, Note)) and node.end is not None:
+        moved.end += delta
+    if isinstance(node, ClassDef):
+        moved.members = [_shift(member, delta) for member in node.members]
+    return moved
+
+
+def parse_edited(diagram, code, lines, spans):
+    """由编辑前的解析结果增量得到编辑后源码的 Diagram，并放入解析缓存
+
+    lines 为 code 按行拆分的结果；spans 为编辑前行号下的 (start, end, 新行数)，
+    表示 [start, end) 行被替换为新行数的行。只重新解析覆盖这些行的最小范围
+    （被修改的类体、注释块整体重新解析），之前的节点原样复用，之后的节点只平移行号。
+    编辑前后源码末尾有未闭合的块时退回到完整解析。
+    """
+    source_hash = _source_hash(code)
+    cached = _cached(source_hash)
+    if cached is not None:
+        return cached
+    if diagram.open_block or not spans:
+        return _cache_put(_parse(code, source_hash))
+
+    lo = min(start for start, _, _ in spans)
+    hi = max(end for _, end, _ in spans)
+    delta = sum(length - (end - start) for start, end, length in spans)
+    # 编辑落在类体或注释块内时，整个块都要重新解析
+    for node in diagram.classes + diagram.notes:
+        end = node.end if node.end is not None else node.line
+        if node.line < hi and end >= lo:
+            lo = min(lo, node.line)
+            hi = max(hi, end + 1)
+
+    edited = Diagram(source_hash, lines)
+    for name in _NODE_LISTS:
+        getattr(edited, name).extend(n for n in getattr(diagram, name) if n.line < lo)
+    if _scan(edited, lines, lo, hi + delta):
+        return _cache_put(_parse(code, source_hash))
+    for name in _NODE_LISTS:
+        getattr(edited, name).extend(_shift(n, delta) for n in getattr(diagram, name) if n.line >= hi)
+    edited.name_map = _name_map(edited)
+    edited.diagram_type = detect_diagram_type(code)
+    return _cache_put(edited)
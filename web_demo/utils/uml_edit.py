@@ -0,0 +1,338 @@
+"""可视化编辑的修改接口
+
+每个编辑操作描述为受影响行范围的补丁（Patch），定位依赖 parse_uml 缓存的语法树，
+不再由各个编辑器逐行扫描、重建源码；补丁统一在缓存的行列表上拼接出新源码。
+编辑结果带有实际改动的行范围，语法树据此只重新解析改动所在的部分。
+"""
+from utils.uml_ast import parse_edited, parse_uml, _RELATION_RE
+
+
+class Patch:
+    """把 [start, end) 行替换为 lines（start == end 表示插入）"""
+    __slots__ = ('start', 'end', 'lines')
+
+    def __init__(self, start, end, lines):
+        self.start = start
+        self.end = end
+        self.lines = lines
+
+
+class EditResult:
+    """编辑结果：新源码、是否实际应用了补丁，以及改动的行范围
+
+    spans 为编辑前行号下的 (start, end, 新行数)，按行号排序。
+    """
+    __slots__ = ('code', 'changed', 'spans')
+
+    def __init__(self, code, changed, spans=()):
+        self.code = code
+        self.changed = changed
+        self.spans = spans
+
+
+def apply_patches(code, patches):
+    """把一组互不重叠的补丁应用到源码上，并把增量解析的语法树放入解析缓存"""
+    if not patches:
+        return EditResult(code, False)
+    diagram = parse_uml(code)
+    lines = diagram.lines
+    new_lines = []
+    spans = []
+    prev = 0
+    for patch in sorted(patches, key=lambda p: (p.start, p.end)):
+        if patch.start < prev:
+            raise ValueError(f"补丁行范围重叠: {patch.start} < {prev}")
+        # 补丁中的行可能自带换行符，按行拆开以保持行号与源码一致
+        patch_lines = [part for line in patch.lines for part in line.split('\n')]
+        new_lines.extend(lines[prev:patch.start])
+        new_lines.extend(patch_lines)
+        spans.append((patch.start, patch.end, len(patch_lines)))
+        prev = patch.end
+    new_lines.extend(lines[prev:])
+    new_code = '\n'.join(new_lines)
+    parse_edited(diagram, new_code, new_lines, spans)
+    return EditResult(new_code, True, spans)
+
+
+def _end_index(lines):
+    """@enduml 所在行号，新内容默认插入在它之前"""
+    return next((i for i, line in enumerate(lines) if '@enduml' in line.lower()), len(lines))
+
+
+def _insert_before_end(code, text):
+    lines = parse_uml(code).lines
+    pos = _end_index(lines)
+    return apply_patches(code, [Patch(pos, pos, text.split('\n'))])
+
+
+def _delete_lines(code, line_numbers):
+    """删除给定行号；相邻行合并为一个补丁"""
+    patches = []
+    for i in sorted(set(line_numbers)):
+        if patches and patches[-1].end == i:
+            patches[-1].end = i + 1
+        else:
+            patches.append(Patch(i, i + 1, []))
+    return apply_patches(code, patches)
+
+
+def _block_lines(node):
+    end = node.end if node.end is not None else node.line
+    return range(node.line, end + 1)
+
+
+# ===== 类图 =====
+
+def _class_text(class_name, attributes, methods):
+    new_class = f"\nclass {class_name} {{\n"
+
+    # Add attributes
+    for attr in attributes:
+        if attr["name"].strip():
+            new_class += f"  {attr['visibility']}{attr['name']}"
+            if attr["type"].strip():
+                new_class += f": {attr['type']}"
+            new_class += "\n"
+
+    # Add methods
+    for method in methods:
+        if method["name"].strip():
+            new_class += f"  {method['visibility']}{method['name']}"
+            new_class += "("
+            if method["params"].strip():
+                new_class += method["params"]
+            new_class += ")"
+            if method["return_type"].strip():
+                new_class += f": {method['return_type']}"
+            new_class += "\n"
+
+    new_class += "}\n"
+    return new_class
+
+
+def add_class(code, class_name, attributes, methods):
+    return _insert_before_end(code, _class_text(class_name, attributes, methods))
+
+
+def _rename_endpoint(line, old_name, new_name):
+    """把关系行中等于 old_name 的端点改名，保留原有缩进、引号和其余文本"""
+    indent = line[:len(line) - len(line.lstrip())]
+    stripped = line.strip()
+    match = _RELATION_RE.match(stripped)
+    if not match:
+        return line
+    # 从后往前替换，前面的偏移量不受影响
+    for group in ('target', 'source'):
+        operand = match.group(group)
+        if operand.strip('"') != old_name:
+            continue
+        start, end = match.span(group)
+        replacement = f'"{new_name}"' if operand.startswith('"') else new_name
+        stripped = stripped[:start] + replacement + stripped[end:]
+    return indent + stripped
+
+
+def modify_class(code, class_name, new_class_name, attributes, methods):
+    """原位替换类定义块，并把引用该类的关系改名"""
+    diagram = parse_uml(code)
+    class_def = diagram.get_class(class_name)
+    if class_def is None:
+        return add_class(code, new_class_name, attributes, methods)
+
+    block = _block_lines(class_def)
+    new_class = _class_text(new_class_name, attributes, methods).strip('\n')
+    patches = [Patch(block.start, block.stop, new_class.split('\n'))]
+    if new_class_name != class_name:
+        for relationship in diagram.relationships:
+            if class_name in (relationship.source, relationship.target):
+                line = diagram.lines[relationship.line]
+                renamed = _rename_endpoint(line, class_name, new_class_name)
+                if renamed != line:
+                    patches.append(Patch(relationship.line, relationship.line + 1, [renamed]))
+    return apply_patches(code, patches)
+
+
+def delete_class(code, class_name):
+    """删除类定义块及所有引用它的关系；类不存在时返回 None"""
+    diagram = parse_uml(code)
+    class_def = diagram.get_class(class_name)
+    if class_def is None:
+        return None
+    skip_lines = set(_block_lines(class_def))
+    skip_lines.update(
+        r.line for r in diagram.relationships
+        if class_name in (r.source, r.target)
+    )
+    return _delete_lines(code, skip_lines)
+
+
+def add_relationship(code, relation_str):
+    """在最后一个类定义之后、第一个游离的属性/方法之前插入关系"""
+    diagram = parse_uml(code)
+    lines = diagram.lines
+
+    # Class definition start and end positions
+    class_positions = [(c.line, c.end) for c in diagram.classes if c.end is not None]
+
+    # Find the first independent attribute or method definition position (outside class definitions)
+    method_start_pos = len(lines)
+    for i, line in enumerate(lines):
+        line_stripped = line.strip()
+        # Ensure not inside any class definition
+        if not any(start <= i <= end for start, end in class_positions):
+            if (line_stripped.startswith('+') or
+                line_stripped.startswith('-') or
+                line_stripped.startswith('#')) or \
+               ('(' in line_stripped and ')' in line_stripped):
+                method_start_pos = i
+                break
+
+    # Choose appropriate insertion position: after the last class definition, but before the first independent method/attribute
+    if class_positions:
+        last_class_end = max(pos[1] for pos in class_positions)
+        insert_pos = min(last_class_end + 1, method_start_pos)
+
+        # Ensure insertion position not inside any class
+        while any(start <= insert_pos <= end for start, end in class_positions):
+            insert_pos = max(pos[1] + 1 for pos in class_positions if pos[1] >= insert_pos)
+    else:
+        insert_pos = _end_index(lines)
+
+    return apply_patches(code, [Patch(insert_pos, insert_pos, relation_str.split('\n'))])
+
+
+def delete_relationship(code, relation_text):
+    """删除与 relation_text（忽略空白差异）相同的关系行"""
+    normalized = ' '.join(relation_text.split())
+    diagram = parse_uml(code)
+    return _delete_lines(code, [
+        r.line for r in diagram.relationships
+        if ' '.join(r.text.split()) == normalized
+    ])
+
+
+# ===== 时序图 =====
+
+def add_participant(code, participant_type, participant_name, description=''):
+    participant_str = f'\n{participant_type} "{participant_name}"'
+    if description.strip():
+        participant_str += f' as {participant_name.replace(" ", "_")}\n'
+        participant_str += f'note over {participant_name.replace(" ", "_")}: {description}\n'
+    else:
+        participant_str += '\n'
+    return _insert_before_end(code, participant_str)
+
+
+def delete_participant(code, participant_name):
+    """删除参与者定义、其上的注释、相关消息以及 activate/deactivate 行"""
+    diagram = parse_uml(code)
+
+    # Get all possible identifiers for the participant (original name and aliases)
+    participant_aliases = diagram.aliases_of(participant_name)
+    participant_aliases |= {alias.replace(" ", "_") for alias in participant_aliases}
+
+    skip_lines = set()
+    # Participant definition lines
+    skip_lines.update(
+        p.line for p in diagram.participants
+        if p.name in participant_aliases or p.alias in participant_aliases
+    )
+    # Note blocks over the participant
+    for note in diagram.notes:
+        header = diagram.lines[note.line].strip()
+        if header.startswith('note over') and any(alias in header for alias in participant_aliases):
+            skip_lines.update(_block_lines(note))
+    # Message lines
+    skip_lines.update(
+        r.line for r in diagram.relationships
+        if r.source in participant_aliases or r.target in participant_aliases
+    )
+    # Activate/deactivate lines
+    for i, line in enumerate(diagram.lines):
+        parts = line.strip().split(None, 1)
+        if (len(parts) == 2 and parts[0] in ('activate', 'deactivate')
+                and parts[1].strip('"') in participant_aliases):
+            skip_lines.add(i)
+
+    return _delete_lines(code, skip_lines)
+
+
+def add_message(code, source, arrow, target, message_text, activate=False, deactivate=False):
+    message_lines = []
+    if activate:
+        message_lines.append(f'activate "{target}"')
+    message_lines.append(f'"{source}" {arrow} "{target}": {message_text}')
+    if deactivate:
+        message_lines.append(f'deactivate "{target}"')
+    return _insert_before_end(code, '\n'.join(message_lines))
+
+
+def delete_line(code, line_number):
+    """删除单行（消息、关系等）"""
+    return _delete_lines(code, [line_number])
+
+
+# ===== 用例图 =====
+
+def _element_text(keyword, name, description):
+    element_str = f'\n{keyword} "{name}"'
+    if description.strip():
+        element_str += f' as {name.replace(" ", "_")}\n'
+        element_str += f'note right of {name.replace(" ", "_")}\n'
+        element_str += f'  {description}\n'
+        element_str += 'end note\n'
+    else:
+        element_str += '\n'
+    return element_str
+
+
+def add_actor(code, actor_name, description=''):
+    return _insert_before_end(code, _element_text('actor', actor_name, description))
+
+
+def add_usecase(code, usecase_name, description=''):
+    return _insert_before_end(code, _element_text('usecase', usecase_name, description))
+
+
+def add_usecase_relation(code, relation):
+    return _insert_before_end(code, relation)
+
+
+def delete_actor(code, actor_name):
+    """删除参与者定义及引用它的关系"""
+    diagram = parse_uml(code)
+    actor_aliases = diagram.aliases_of(actor_name)
+
+    # Actor definition lines and relationships that reference the actor
+    skip_lines = {a.line for a in diagram.actors if a.name in actor_aliases or a.alias in actor_aliases}
+    skip_lines.update(
+        r.line for r in diagram.relationships
+        if r.source in actor_aliases or r.target in actor_aliases
+    )
+    return _delete_lines(code, skip_lines)
+
+
+def delete_usecase(code, usecase_name):
+    """删除用例定义、相关关系以及附在它上面的注释"""
+    diagram = parse_uml(code)
+
+    # Get all possible identifiers for the use case (original name and aliases)
+    usecase_aliases = diagram.aliases_of(usecase_name)
+
+    # Use case definition lines
+    skip_lines = {
+        u.line for u in diagram.usecases
+        if u.name in usecase_aliases or u.alias in usecase_aliases
+    }
+    # Relationship lines
+    skip_lines.update(
+        r.line for r in diagram.relationships
+        if r.source in usecase_aliases or r.target in usecase_aliases
+    )
+    # Note blocks
+    for note in diagram.notes:
+        header = diagram.lines[note.line].strip()
+        if any(alias in header for alias in usecase_aliases):
+            skip_lines.update(_block_lines(note))
+
+    return _delete_lines(code, skip_lines)